@@ -0,0 +1,232 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os, re, json, time, hashlib, tarfile, tempfile
+
+from six.moves.urllib import error, request
+
+import carbin.util as util
+
+
+def get_key(**kwargs):
+    return hashlib.sha256(json.dumps(kwargs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# The environment cmake reads when it configures, which changes what gets built
+CONFIGURE_ENVIRONMENT = [
+    'CC', 'CXX', 'FC', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'FFLAGS', 'LDFLAGS',
+    'CMAKE_PREFIX_PATH', 'CMAKE_INCLUDE_PATH', 'CMAKE_LIBRARY_PATH', 'CMAKE_PROGRAM_PATH',
+    'CMAKE_FRAMEWORK_PATH', 'CMAKE_APPBUNDLE_PATH', 'PKG_CONFIG_PATH'
+]
+
+
+def get_environment():
+    return {var: os.environ[var] for var in CONFIGURE_ENVIRONMENT if var in os.environ}
+
+
+# The compilers cmake will pick: the ones set by the toolchain, or else the
+# ones from the environment
+def get_compilers(toolchain):
+    for lang, var, default in [('C', 'CC', 'cc'), ('CXX', 'CXX', 'c++')]:
+        m = re.search(r'set\(CMAKE_{}_COMPILER "([^"]*)"'.format(lang), toolchain)
+        yield m.group(1) if m else os.environ.get(var, default)
+
+
+def get_compiler_id(compiler):
+    exe = util.which(compiler, throws=False)
+    if not exe: return compiler
+    try:
+        out, err = util.cmd([exe, '--version'], capture='all')
+    except util.BuildError:
+        out = b''
+    return os.path.realpath(exe) + ':' + hashlib.sha256(out or b'').hexdigest()
+
+
+# The least recently used blobs are removed once the cache takes more than
+# size, with the time each blob was stored or restored kept in its metadata
+class ArtifactCache:
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size = size
+
+    def get_path(self, key):
+        return os.path.join(self.path, key + '.tar.gz')
+
+    def get_meta_path(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def has(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def keys(self):
+        for f in sorted(util.ls(self.path, os.path.isfile)):
+            if f.endswith('.tar.gz'): yield f[:-len('.tar.gz')]
+
+    def get_meta(self, key):
+        try:
+            with open(self.get_meta_path(key)) as f: return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_meta(self, key, meta):
+        util.mkdir(self.path)
+        with open(self.get_meta_path(key), 'w') as f: json.dump(meta, f)
+
+    def index(self):
+        return dict((key, self.get_meta(key)) for key in self.keys())
+
+    def store(self, key, install_dir, name=None):
+        util.mkdir(self.path)
+        # Pack into a temporary file so other builds never see a partial archive
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            with tarfile.open(tmp, 'w:gz') as tar:
+                for entry in sorted(os.listdir(install_dir)):
+                    tar.add(os.path.join(install_dir, entry), arcname=entry)
+            os.rename(tmp, self.get_path(key))
+        except:
+            os.remove(tmp)
+            raise
+        self.write_meta(key, {
+            'name': name,
+            'size': os.path.getsize(self.get_path(key)),
+            'sha256': util.hash_file(self.get_path(key), 'sha256'),
+            'used': time.time()
+        })
+        self.evict(current=key)
+        return self.get_path(key)
+
+    def evict(self, current=None):
+        if self.size is None: return
+        blobs = []
+        for key in self.keys():
+            meta = self.get_meta(key)
+            size = meta.get('size') or os.path.getsize(self.get_path(key))
+            blobs.append((meta.get('used', 0), size, key))
+        total = 0
+        for used, size, key in sorted(blobs, reverse=True):
+            total = total + size
+            if total <= self.size or key == current: continue
+            util.delete_file(self.get_path(key))
+            util.delete_file(self.get_meta_path(key))
+
+    # A blob can come from a remote cache, so it's extracted like any other
+    # downloaded archive, which keeps its members inside install_dir
+    def restore(self, key, install_dir):
+        f = self.get_path(key)
+        if not os.path.exists(f): return False
+        import carbin.tarball as tarball
+        util.delete_dir(install_dir)
+        try:
+            tarball.extract(f, install_dir)
+        except (IOError, OSError):
+            # Evicted by another build since it was found
+            if os.path.exists(f): raise
+            util.delete_dir(install_dir)
+            return False
+        self.write_meta(key, util.merge(self.get_meta(key), {'used': time.time()}))
+        return True
+
+
+def get_local_cache():
+    return ArtifactCache(util.ARTIFACT_CACHE or util.get_cache_path('artifacts'), size=util.ARTIFACT_CACHE_SIZE)
+
+
+# A remote cache is a plain HTTP server: blobs/<key>.tar.gz holds the packed
+# trees and index.json maps each key to its name and size. Any server that
+# accepts PUT and serves the files back with GET can be used.
+class RemoteCache:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def get_url(self, *paths):
+        return '/'.join([self.url] + list(paths))
+
+    def get_blob_url(self, key):
+        return self.get_url('blobs', key + '.tar.gz')
+
+    def open(self, url, data=None, method=None):
+        req = request.Request(url, data=data)
+        if method: req.get_method = lambda: method
+        return request.urlopen(req)
+
+    def index(self):
+        try:
+            return json.loads(self.open(self.get_url('index.json')).read().decode('utf-8'))
+        except error.HTTPError as e:
+            if e.code == 404: return {}
+            raise
+
+    def put(self, key, f):
+        with open(f, 'rb') as blob:
+            self.open(self.get_blob_url(key), data=blob.read(), method='PUT').close()
+
+    def put_index(self, index):
+        self.open(self.get_url('index.json'), data=json.dumps(index, sort_keys=True).encode('utf-8'),
+                  method='PUT').close()
+
+    # Downloads the blob into the local cache, returns False when the remote
+    # doesn't have it. The blob is only kept when it matches the sha256 its
+    # entry in the index was pushed with, from meta or else the index.
+    def get(self, key, cache, meta=None):
+        if meta is None: meta = self.index().get(key)
+        if not meta: return False
+        if not meta.get('sha256'): raise util.BuildError("No sha256 for {0} in the remote cache".format(key))
+        try:
+            response = self.open(self.get_blob_url(key))
+        except error.HTTPError as e:
+            if e.code == 404: return False
+            raise
+        util.mkdir(cache.path)
+        fd, tmp = tempfile.mkstemp(dir=cache.path, suffix='.tmp')
+        h = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in util.read_chunks(response):
+                    h.update(chunk)
+                    f.write(chunk)
+            if h.hexdigest() != meta['sha256']:
+                raise util.BuildError("The sha256 of {0} from the remote cache doesn't match".format(key))
+            os.rename(tmp, cache.get_path(key))
+        finally:
+            response.close()
+            if os.path.exists(tmp): os.remove(tmp)
+        cache.write_meta(key, util.merge(meta, {'used': time.time()}))
+        cache.evict(current=key)
+        return True
+
+    def push(self, cache):
+        index = self.index()
+        pushed = []
+        for key in cache.keys():
+            if key in index: continue
+            meta = dict((k, v) for k, v in cache.get_meta(key).items() if k != 'used')
+            # Blobs stored before their sha256 was recorded
+            if not meta.get('sha256'): meta['sha256'] = util.hash_file(cache.get_path(key), 'sha256')
+            self.put(key, cache.get_path(key))
+            index[key] = meta
+            pushed.append(key)
+        # The index is merged again right before writing it, to keep entries
+        # pushed by others in the meantime
+        if pushed: self.put_index(util.merge(self.index(), index))
+        return pushed
+
+    def pull(self, cache, keys=None):
+        pulled = []
+        for key, meta in self.index().items():
+            if cache.has(key) or (keys and key not in keys): continue
+            if self.get(key, cache, meta): pulled.append(key)
+        return pulled
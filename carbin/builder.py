@@ -13,17 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import click, os, multiprocessing, six
+import click, os, sys, contextlib, six
 
 import carbin.util as util
 
 
 class Builder:
-    def __init__(self, prefix, top_dir, exists=False):
+    def __init__(self, prefix, top_dir, exists=False, keep=False):
         self.prefix = prefix
         self.top_dir = top_dir
         self.build_dir = self.get_path('build')
         self.exists = exists
+        self.keep = keep
+        self.max_jobs = None
+        self.peak_rss = 0
         self.cmake_original_file = '__carbin_original_cmake_file__.cmake'
 
     def get_path(self, *args):
@@ -35,8 +38,23 @@ class Builder:
     def is_make_generator(self):
         return os.path.exists(self.get_build_path('Makefile'))
 
+    def is_ninja_generator(self):
+        return os.path.exists(self.get_build_path('build.ninja'))
+
+    # The generator an existing build directory was configured with, since
+    # cmake can't switch generators in place
+    def get_cached_generator(self):
+        cache = self.get_build_path('CMakeCache.txt')
+        if not os.path.exists(cache): return None
+        for line in open(cache):
+            if line.startswith('CMAKE_GENERATOR:'): return line.split('=', 1)[1].strip()
+        return None
+
+    def get_jobs(self):
+        return self.max_jobs or self.prefix.build_jobs
+
     def cmake(self, options=None, use_toolchain=False, **kwargs):
-        if use_toolchain: return self.prefix.cmd.cmake(options=util.merge({'-DCMAKE_TOOLCHAIN_FILE': self.prefix.toolchain}, options), **kwargs)
+        if use_toolchain: return self.prefix.cmd.cmake(options=util.merge({'-DCMAKE_TOOLCHAIN_FILE': self.prefix.get_toolchain()}, options), **kwargs)
         else: return self.prefix.cmd.cmake(options=options, **kwargs)
 
     def show_log(self, log):
@@ -53,55 +71,112 @@ class Builder:
             out, err = self.cmake(args=['--build', self.build_dir, '--target', 'help'], capture='out')
         except:
             pass
+        ninja = self.is_ninja_generator()
         for line in (out or '').splitlines():
-            if line.startswith(six.b('... ')):
+            if ninja and six.b(': ') in line:
+                yield line.split(six.b(': '))[0]
+            elif line.startswith(six.b('... ')):
                 yield line[4:]
 
-    def fetch(self, url, hash=None, copy=False, insecure=False):
+    def fetch(self, url, hash=None, copy=False, insecure=False, progress=True):
         self.prefix.log("fetch:", url)
         if insecure: url = url.replace('https', 'http')
-        f = util.retrieve_url(url, self.top_dir, copy=copy, insecure=insecure, hash=hash)
+        # A kept tree fetches next to its sources, which are then updated in
+        # place so the build directory can be reused
+        dst = self.get_path('fetch') if self.keep else self.top_dir
+        if self.keep:
+            util.delete_dir(dst)
+            util.mkdir(dst)
+        f = util.retrieve_url(url, dst, copy=copy, insecure=insecure, hash=hash, progress=progress,
+                              extract=True)
         if os.path.isfile(f):
             click.echo("Extracting archive {0} ...".format(f))
-            util.extract_ar(archive=f, dst=self.top_dir)
-        return next(util.get_dirs(self.top_dir))
+            util.extract_ar(archive=f, dst=dst)
+        src_dir = next(util.get_dirs(dst))
+        if not self.keep or os.path.islink(src_dir): return src_dir
+        util.sync_dir(src_dir, self.get_path('src'))
+        util.delete_dir(dst)
+        return self.get_path('src')
 
-    def configure(self, src_dir, defines=None, generator=None, install_prefix=None, test=True, variant=None):
+    def configure(self, src_dir, defines=None, generator=None, install_prefix=None, test=True, variant=None,
+                  deps=None):
         self.prefix.log("configure")
         util.mkdir(self.build_dir)
         args = [
             src_dir, 
             '-DCARBIN_CMAKE_DIR={}'.format(util.carbin_dir('cmake')), 
-            '-DCARBIN_CMAKE_ORIGINAL_SOURCE_FILE={}'.format(os.path.join(src_dir, self.cmake_original_file))
+            '-DCARBIN_CMAKE_ORIGINAL_SOURCE_FILE={}'.format(os.path.join(src_dir, self.cmake_original_file)),
+            '-DCARBIN_BUILD_JOBS={}'.format(self.get_jobs())
         ]
+        if self.prefix.get_jobserver() is not None:
+            args.append('-DCARBIN_PYTHON_EXECUTABLE={}'.format(sys.executable))
         for d in defines or []:
             args.append('-D{0}'.format(d))
+        if generator is None: generator = self.get_cached_generator() or self.prefix.get_default_generator()
         if generator is not None: args = ['-G', generator] + args
         if self.prefix.verbose: args.extend(['-DCMAKE_VERBOSE_MAKEFILE=On'])
         if test: args.extend(['-DBUILD_TESTING=On'])
         else: args.extend(['-DBUILD_TESTING=Off'])
         args.extend(['-DCMAKE_BUILD_TYPE={}'.format(variant or 'Release')])
         if install_prefix is not None: args.extend(['-DCMAKE_INSTALL_PREFIX=' + install_prefix])
+        cache = self.prefix.get_configure_cache()
+        if cache:
+            import carbin.configure_cache as configure_cache
+            args.extend(configure_cache.seed(cache, self.build_dir))
         try:
             self.cmake(args=args, cwd=self.build_dir, use_toolchain=True)
         except:
             self.show_logs()
             raise
+        if cache: configure_cache.update(cache, self.build_dir, deps or [])
 
     def build(self, target=None, variant=None, cwd=None):
         self.prefix.log("build")
         args = ['--build', self.build_dir]
         if variant is not None: args.extend(['--config', variant])
         if target is not None: args.extend(['--target', target])
-        if self.is_make_generator(): 
-            args.extend(['--', '-j', str(multiprocessing.cpu_count())])
+        js = self.prefix.get_jobserver()
+        if js is None:
+            self.run_build(args, jobs=self.get_jobs(), cwd=cwd)
+        # ninja doesn't read the jobserver, so it always gets an explicit -j
+        elif self.get_jobs() >= self.prefix.build_jobs and not self.is_ninja_generator():
+            # make takes its jobs from the jobserver, on top of the slot held here
+            with js.slot():
+                self.run_build(args, cwd=cwd, env=js.get_env(), pass_fds=js.get_fds())
+        else:
+            # A build limited to fewer jobs runs its own -j, using only the
+            # tokens it could take. The jobserver is still passed on, so the
+            # make, b2 or meson a recipe starts takes its jobs from it too.
+            with self.jobs() as n:
+                self.run_build(args, jobs=n, cwd=cwd, env=js.get_env(), pass_fds=js.get_fds())
+
+    def run_build(self, args, jobs=None, **kwargs):
+        if self.is_make_generator():
+            args = args + ['--']
+            if jobs: args.extend(['-j', str(jobs)])
+            if self.prefix.keep_going: args.append('-k')
             if self.prefix.verbose: args.append('VERBOSE=1')
-        self.cmake(args=args, cwd=cwd)
+        elif self.is_ninja_generator():
+            args = args + ['--']
+            if jobs: args.extend(['-j', str(jobs)])
+            if self.prefix.keep_going: args.extend(['-k', '0'])
+            if self.prefix.verbose: args.extend(['-v', '-d', 'stats'])
+        usage = []
+        self.cmake(args=args, usage=usage, **kwargs)
+        self.peak_rss = max([self.peak_rss] + usage)
+
+    @contextlib.contextmanager
+    def jobs(self):
+        js = self.prefix.get_jobserver()
+        if js is None: yield self.get_jobs()
+        else:
+            with js.tokens(self.get_jobs()) as n: yield n
 
     def test(self, variant=None):
         self.prefix.log("test")
         if 'check' in self.targets():
             self.build(target='check', variant=variant or 'Release')
         else:
-            self.prefix.cmd.ctest((self.prefix.verbose and ['-VV'] or []) + ['-C', variant] +
-                                  ['-j', str(multiprocessing.cpu_count())] + ['--output-on-failure'], cwd=self.build_dir)
+            with self.jobs() as n:
+                self.prefix.cmd.ctest((self.prefix.verbose and ['-VV'] or []) + ['-C', variant] +
+                                      ['-j', str(n)] + ['--output-on-failure'], cwd=self.build_dir)
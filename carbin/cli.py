@@ -16,9 +16,7 @@
 import click, os, functools, sys
 
 from carbin import __version__
-from carbin.prefix import CarbinPrefix
-from carbin.prefix import PackageBuild
-from carbin.creater import Creater
+from carbin.package import PackageBuild
 import carbin.util as util
 
 aliases = {
@@ -45,6 +43,22 @@ def get_build_type(debug, release, build_type):
     return build_types[0]
 
 
+def get_default_file():
+    if os.path.exists('dev-carbin_deps.txt'):
+        return 'dev-carbin_deps.txt'
+    else:
+        return 'carbin_deps.txt'
+
+
+def get_pkg_builds(prefix, pkgs, file, define, cmake, variant):
+    if not file and not pkgs: file = get_default_file()
+    pbs = [PackageBuild(pkg, cmake=cmake, variant=variant) for pkg in pkgs]
+    for pbu in util.flat([prefix.from_file(file), pbs]):
+        pb = pbu.merge_defines(define)
+        pb.variant = variant
+        yield pb
+
+
 class AliasedGroup(click.Group):
     def get_command(self, ctx, cmd_name):
         rv = click.Group.get_command(self, ctx, cmd_name)
@@ -61,23 +75,33 @@ class AliasedGroup(click.Group):
 @click.option('-v', '--verbose', is_flag=True, envvar='VERBOSE', help="Enable verbose mode")
 @click.option('-B', '--build-path', envvar='CARBIN_BUILD_PATH',
               help='Set the path for the build directory to use when building the package')
+@click.option('--build-jobs', type=int, envvar='CARBIN_BUILD_JOBS',
+              help='Set the total number of compile jobs shared by all builds')
+@click.option('--max-mem', envvar='CARBIN_MAX_MEM', help='Set the memory budget for building, eg 16G')
 @click.pass_context
-def cli(ctx, prefix, verbose, build_path):
+def cli(ctx, prefix, verbose, build_path, build_jobs, max_mem):
     ctx.obj = {}
     if prefix: ctx.obj['PREFIX'] = prefix
     if verbose: ctx.obj['VERBOSE'] = verbose
     if build_path: ctx.obj['BUILD_PATH'] = build_path
+    if build_jobs: ctx.obj['BUILD_JOBS'] = build_jobs
+    if max_mem: ctx.obj['MAX_MEM'] = util.parse_size(max_mem)
 
 
 def use_prefix(f):
     @click.option('-p', '--prefix', help='Set prefix used to install packages')
     @click.option('-v', '--verbose', is_flag=True, help="Enable verbose mode")
     @click.option('-B', '--build-path', help='Set the path for the build directory to use when building the package')
+    @click.option('--build-jobs', type=int, help='Set the total number of compile jobs shared by all builds')
+    @click.option('--max-mem', help='Set the memory budget for building, eg 16G')
     @click.pass_obj
     @functools.wraps(f)
-    def w(obj, prefix, verbose, build_path, *args, **kwargs):
+    def w(obj, prefix, verbose, build_path, build_jobs, max_mem, *args, **kwargs):
+        # Imported here so commands that don't use a prefix start faster
+        from carbin.prefix import CarbinPrefix
         p = CarbinPrefix(prefix or obj.get('PREFIX'), verbose or obj.get('VERBOSE'),
-                         build_path or obj.get('BUILD_PATH'))
+                         build_path or obj.get('BUILD_PATH'), build_jobs or obj.get('BUILD_JOBS'),
+                         util.parse_size(max_mem) or obj.get('MAX_MEM'))
         f(p, *args, **kwargs)
 
     return w
@@ -92,6 +116,7 @@ def use_prefix(f):
 @click.option('--requirements', is_flag=True, help="Create test Dir")
 @click.option('--upgrade', is_flag=True, help="Create test Dir")
 def create_command(prefix, name, test, examples, benchmark, requirements, upgrade):
+    from carbin.creater import Creater
     c = Creater(prefix, name, test, examples, benchmark, requirements)
     if upgrade:
         c.upgrade_carbin()
@@ -113,11 +138,20 @@ def create_command(prefix, name, test, examples, benchmark, requirements, upgrad
 @click.option('-D', '--define', multiple=True, help="Extra configuration variables to pass to CMake")
 @click.option('--shared', is_flag=True, help="Set toolchain to build shared libraries by default")
 @click.option('--static', is_flag=True, help="Set toolchain to build static libraries by default")
-def init_command(prefix, toolchain, cc, cxx, cflags, cxxflags, ldflags, std, define, shared, static):
+@click.option('--compiler-cache', 'compiler_cache_name', type=click.Choice(['auto', 'ccache', 'sccache', 'none']),
+              help="Compile through ccache or sccache, auto picks whichever is installed")
+def init_command(prefix, toolchain, cc, cxx, cflags, cxxflags, ldflags, std, define, shared, static,
+                 compiler_cache_name):
     """ Initialize install directory """
     if shared and static:
         click.echo("ERROR: shared and static are not supported together")
         sys.exit(1)
+    import carbin.compiler_cache as compiler_cache
+    try:
+        launcher = compiler_cache.find(compiler_cache_name)
+    except util.BuildError as e:
+        click.echo("ERROR: {}".format(e))
+        sys.exit(1)
     defines = util.to_define_dict(define)
     if shared: defines['BUILD_SHARED_LIBS'] = 'On'
     if static: defines['BUILD_SHARED_LIBS'] = 'Off'
@@ -130,7 +164,8 @@ def init_command(prefix, toolchain, cc, cxx, cflags, cxxflags, ldflags, std, def
         cxxflags=cxxflags,
         ldflags=ldflags,
         std=std,
-        defines=defines)
+        defines=defines,
+        launcher=launcher)
 
 
 @cli.command(name='install')
@@ -147,23 +182,129 @@ def init_command(prefix, toolchain, cc, cxx, cflags, cxxflags, ldflags, std, def
 @click.option('--release', is_flag=True, help="Install release version")
 @click.option('--build-type', help="Install custom version [Release, Debug, RelWithDebInfo or other cmake build type]")
 @click.option('--insecure', is_flag=True, help="Don't use https urls")
+@click.option('-J', '--jobs', type=int, envvar='CARBIN_JOBS',
+              help="Resolve all dependencies first and then build up to this many packages concurrently")
+@click.option('--fetch-jobs', type=int, envvar='CARBIN_FETCH_JOBS',
+              help="Number of sources to download in the background at once when building with --jobs")
+@click.option('--remote-cache', envvar='CARBIN_REMOTE_CACHE', help="Get prebuilt packages from this remote cache url")
+@click.option('--keep-build', is_flag=True, envvar='CARBIN_KEEP_BUILDS',
+              help="Keep the build tree of each package so updates only rebuild what changed")
+@click.option('-k', '--keep-going', is_flag=True, help="Keep building other targets after one fails")
+@click.option('--locked', is_flag=True, help="Install the urls and digests recorded in carbin.lock")
 @click.argument('pkgs', nargs=-1, type=click.STRING)
 def install_command(prefix, pkgs, define, file, test, test_all, update, generator, cmake, debug, release, build_type,
-                    insecure):
+                    insecure, jobs, fetch_jobs, remote_cache, keep_build, keep_going, locked):
     """ Install packages """
+    if locked:
+        import carbin.lockfile as lockfile
+        with prefix.try_("Failed to read lock file"):
+            prefix.locked = lockfile.read(lockfile.get_path(file))
+    if remote_cache:
+        from carbin.artifacts import RemoteCache
+        prefix.remote = RemoteCache(remote_cache)
+    if keep_build: prefix.keep_builds = True
+    prefix.keep_going = keep_going
     variant = get_build_type(debug, release, build_type)
-    if not file and not pkgs:
-        if os.path.exists('dev-carbin_deps.txt'):
-            file = 'dev-carbin_deps.txt'
-        else:
-            file = 'carbin_deps.txt'
-    pbs = [PackageBuild(pkg, cmake=cmake, variant=variant) for pkg in pkgs]
-    for pbu in util.flat([prefix.from_file(file), pbs]):
-        pb = pbu.merge_defines(define)
-        pb.variant = variant
-        with prefix.try_("Failed to build package {}".format(pb.to_name()), on_fail=lambda: prefix.remove(pb)):
-            click.echo(
-                prefix.install(pb, test=test, test_all=test_all, update=update, generator=generator, insecure=insecure))
+    pbs = get_pkg_builds(prefix, pkgs, file, define, cmake, variant)
+    with prefix.compiler_cache_stats():
+        if jobs:
+            pbs = list(pbs)
+            with prefix.try_("Failed to build packages {}".format(', '.join(pb.to_name() for pb in pbs))):
+                for msg in prefix.install_all(pbs, jobs=jobs, test=test, test_all=test_all, update=update,
+                                              generator=generator, insecure=insecure, fetch_jobs=fetch_jobs):
+                    click.echo(msg)
+            return
+        for pb in pbs:
+            with prefix.try_("Failed to build package {}".format(pb.to_name()), on_fail=lambda: prefix.remove(pb)):
+                click.echo(prefix.install(pb, test=test, test_all=test_all, update=update, generator=generator,
+                                          insecure=insecure))
+
+
+@cli.command(name='plan')
+@use_prefix
+@click.option('-U', '--update', is_flag=True, help="Plan to update packages")
+@click.option('-t', '--test', is_flag=True, help="Include the dependencies needed to test the packages")
+@click.option('--test-all', is_flag=True, help="Include the dependencies needed to test all packages")
+@click.option('-f', '--file', default=None, help="Plan packages listed in the file")
+@click.option('-D', '--define', multiple=True, help="Extra configuration variables to pass to CMake")
+@click.option('-X', '--cmake', help='Set cmake file to use to build project')
+@click.option('--debug', is_flag=True, help="Plan debug version")
+@click.option('--release', is_flag=True, help="Plan release version")
+@click.option('--build-type', help="Plan custom version [Release, Debug, RelWithDebInfo or other cmake build type]")
+@click.option('--insecure', is_flag=True, help="Don't use https urls")
+@click.argument('pkgs', nargs=-1, type=click.STRING)
+def plan_command(prefix, pkgs, define, file, test, test_all, update, cmake, debug, release, build_type, insecure):
+    """ Show the build graph of packages without installing them """
+    variant = get_build_type(debug, release, build_type)
+    pbs = list(get_pkg_builds(prefix, pkgs, file, define, cmake, variant))
+    with prefix.try_("Failed to resolve packages {}".format(', '.join(pb.to_name() for pb in pbs))):
+        with prefix.resolve(pbs, test=test, test_all=test_all, update=update, insecure=insecure) as graph:
+            for node in graph.sorted():
+                deps = [graph.nodes[dep].pb.to_name() for dep in node.deps]
+                line = "{0} ({1})".format(node.pb.to_name(), node.action)
+                if deps: line = line + " <- " + ', '.join(deps)
+                click.echo(line)
+
+
+@cli.command(name='lock')
+@use_prefix
+@click.option('-f', '--file', default=None, help="Lock packages listed in the file")
+@click.option('--insecure', is_flag=True, help="Don't use https urls")
+@click.argument('pkgs', nargs=-1, type=click.STRING)
+def lock_command(prefix, pkgs, file, insecure):
+    """ Record the resolved url and digest of packages and their dependencies in carbin.lock """
+    if not file and not pkgs: file = get_default_file()
+    pbs = [PackageBuild(pkg) for pkg in pkgs]
+    pbs = list(util.flat([prefix.from_file(file), pbs]))
+    import carbin.lockfile as lockfile
+    path = lockfile.get_path(file)
+    with prefix.try_("Failed to lock packages {}".format(', '.join(pb.to_name() for pb in pbs))):
+        lockfile.write(path, prefix.lock(pbs, insecure=insecure))
+    click.echo("Wrote {}".format(path))
+
+
+@cli.group(name='cache')
+def cache_command():
+    """ Share prebuilt packages through a remote cache """
+    pass
+
+
+@cache_command.command(name='push')
+@click.option('-r', '--remote', envvar='CARBIN_REMOTE_CACHE', required=True, help="Url of the remote cache")
+def cache_push_command(remote):
+    """ Upload the locally cached packages missing from the remote cache """
+    import carbin.artifacts as artifacts
+    cache = artifacts.get_local_cache()
+    for key in artifacts.RemoteCache(remote).push(cache):
+        click.echo("Pushed {0} ({1})".format(cache.get_meta(key).get('name'), key))
+
+
+@cache_command.command(name='pull')
+@click.option('-r', '--remote', envvar='CARBIN_REMOTE_CACHE', required=True, help="Url of the remote cache")
+@click.argument('keys', nargs=-1, type=click.STRING)
+def cache_pull_command(remote, keys):
+    """ Download packages from the remote cache """
+    import carbin.artifacts as artifacts
+    cache = artifacts.get_local_cache()
+    for key in artifacts.RemoteCache(remote).pull(cache, keys):
+        click.echo("Pulled {0} ({1})".format(cache.get_meta(key).get('name'), key))
+
+
+@cache_command.command(name='serve')
+@click.option('-d', '--dir', 'root', default='.', help="Directory to store the cache in")
+@click.option('--host', default='', help="Address to listen on")
+@click.option('--port', type=int, default=8080, help="Port to listen on")
+def cache_serve_command(root, host, port):
+    """ Run a remote cache server """
+    from carbin.server import CacheServer
+    server = CacheServer(root, host=host, port=port)
+    click.echo("Serving {0} on {1}".format(server.root, server.get_url()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 @cli.command(name='ignore')
@@ -190,10 +331,12 @@ def ignore_command(prefix, pkgs):
 @click.option('--debug', is_flag=True, help="Build debug version")
 @click.option('--release', is_flag=True, help="Build release version")
 @click.option('--build-type', help="Install custom version [Release, Debug, RelWithDebInfo or other cmake build type]")
+@click.option('-k', '--keep-going', is_flag=True, help="Keep building other targets after one fails")
 @click.argument('pkg', nargs=1, default='.', type=click.STRING)
 def build_command(prefix, pkg, define, test, configure, clean, path, yes, target, generator, debug, release,
-                  build_type):
+                  build_type, keep_going):
     """ Build package """
+    prefix.keep_going = keep_going
     pb = PackageBuild(pkg).merge_defines(define)
     pb.variant = get_build_type(debug, release, build_type)
     with prefix.try_("Failed to build package {}".format(pb.to_name())):
@@ -5,9 +5,6 @@ enable_language(C CXX)
 
 include(CTest)
 
-include(ProcessorCount)
-ProcessorCount(AUTOTOOLS_JOBS)
-
 find_program(MAKE_EXE make)
 if(NOT MAKE_EXE)
     message(FATAL_ERROR "Make build system not installed.")
@@ -33,6 +30,27 @@ function(exec)
         message(FATAL_ERROR "Process failed: ${ARGN}")
     endif()
 endfunction()
+if(CARBIN_BUILD_JOBS)
+    set(PREAMBLE_JOBS ${CARBIN_BUILD_JOBS})
+else()
+    include(ProcessorCount)
+    ProcessorCount(PREAMBLE_JOBS)
+endif()
+# When built by carbin, build tools that take a -j flag are started through
+# carbin so their jobs come out of carbin's jobserver
+if(CARBIN_PYTHON_EXECUTABLE)
+    set(JOBS_LAUNCHER ${CARBIN_PYTHON_EXECUTABLE} -m carbin.jobserver ${PREAMBLE_JOBS})
+    set(JOBS_FLAG)
+else()
+    set(JOBS_LAUNCHER)
+    set(JOBS_FLAG -j ${PREAMBLE_JOBS})
+endif()
+# A recursive make shares the jobserver of the make running the build
+if(CMAKE_GENERATOR STREQUAL "Unix Makefiles")
+    set(MAKE_JOBS_COMMAND "$(MAKE)")
+else()
+    set(MAKE_JOBS_COMMAND ${JOBS_LAUNCHER} ${MAKE_EXE} ${JOBS_FLAG})
+endif()
 if(CMAKE_CROSSCOMPILING)
     set(PREFIX_PATH ${CMAKE_FIND_ROOT_PATH})
 else()
@@ -154,9 +172,18 @@ macro(preamble PREFIX)
         list(APPEND ${PREFIX}_BASE_ENV_COMMAND "PKG_CONFIG_LIBDIR=${${PREFIX}_PKG_CONFIG_PATH}")
     endif()
 
+    # Compile through the same launcher, such as ccache, as cmake does
+    foreach(LANG C CXX)
+        set(${PREFIX}_${LANG}_COMPILER "${CMAKE_${LANG}_COMPILER}")
+        if(CMAKE_${LANG}_COMPILER_LAUNCHER)
+            string(REPLACE ";" " " ${PREFIX}_${LANG}_LAUNCHER "${CMAKE_${LANG}_COMPILER_LAUNCHER}")
+            set(${PREFIX}_${LANG}_COMPILER "${${PREFIX}_${LANG}_LAUNCHER} ${CMAKE_${LANG}_COMPILER}")
+        endif()
+    endforeach()
+
     set(${PREFIX}_ENV_COMMAND ${${PREFIX}_BASE_ENV_COMMAND}
-        "CC=${CMAKE_C_COMPILER}"
-        "CXX=${CMAKE_CXX_COMPILER}"
+        "CC=${${PREFIX}_C_COMPILER}"
+        "CXX=${${PREFIX}_CXX_COMPILER}"
         "CFLAGS=${${PREFIX}_C_FLAGS}"
         "CXXFLAGS=${${PREFIX}_CXX_FLAGS}"
         "LDFLAGS=${${PREFIX}_LINK_FLAGS}") 
@@ -202,15 +229,40 @@ endif()
 
 message(STATUS "Configure options: ${CONFIGURE_OPTIONS}")
 
+# Start from the results other packages found with the same toolchain, and
+# configure again without them if that fails
+if(CARBIN_AUTOTOOLS_CACHE_FILE)
+    # Copied without configure_file, so updating the shared cache doesn't
+    # make cmake configure the package again
+    if(EXISTS ${CARBIN_AUTOTOOLS_CACHE_FILE} AND NOT EXISTS ${BUILD_DIR}/config.cache)
+        execute_process(COMMAND ${CMAKE_COMMAND} -E copy ${CARBIN_AUTOTOOLS_CACHE_FILE} ${BUILD_DIR}/config.cache)
+    endif()
+    execute_process(COMMAND ${AUTOTOOLS_ENV_COMMAND} ${CMAKE_CURRENT_SOURCE_DIR}/configure
+        --prefix=${CMAKE_INSTALL_PREFIX}
+        --cache-file=${BUILD_DIR}/config.cache
+        ${CONFIGURE_OPTIONS}
+        WORKING_DIRECTORY ${BUILD_DIR}
+        RESULT_VARIABLE AUTOTOOLS_CONFIGURE_RESULT)
+    if(NOT AUTOTOOLS_CONFIGURE_RESULT EQUAL 0)
+        message(STATUS "Configure failed with the cached results, retrying without them")
+        file(REMOVE ${BUILD_DIR}/config.cache)
+        exec(COMMAND ${AUTOTOOLS_ENV_COMMAND} ${CMAKE_CURRENT_SOURCE_DIR}/configure
+            --prefix=${CMAKE_INSTALL_PREFIX}
+            --cache-file=${BUILD_DIR}/config.cache
+            ${CONFIGURE_OPTIONS}
+            WORKING_DIRECTORY ${BUILD_DIR})
+    endif()
+else()
 # TODO: Check flags of configure script
 exec(COMMAND ${AUTOTOOLS_ENV_COMMAND} ${CMAKE_CURRENT_SOURCE_DIR}/configure
     --prefix=${CMAKE_INSTALL_PREFIX}
     ${CONFIGURE_OPTIONS}
     WORKING_DIRECTORY ${BUILD_DIR})
+endif()
 
 add_custom_target(autotools ALL
-    COMMAND ${MAKE_EXE} -j ${AUTOTOOLS_JOBS}
-    COMMENT "${MAKE_EXE} -j ${AUTOTOOLS_JOBS}"
+    COMMAND ${MAKE_JOBS_COMMAND}
+    COMMENT "${MAKE_EXE} -j ${PREAMBLE_JOBS}"
     VERBATIM
     WORKING_DIRECTORY ${BUILD_DIR}
 )
@@ -5,9 +5,6 @@ enable_language(C CXX)
 
 include(CTest)
 
-include(ProcessorCount)
-ProcessorCount(B2_JOBS)
-
 # preamble
 set(PATH_SEP ":")
 if(CMAKE_HOST_WIN32)
@@ -26,6 +23,27 @@ function(exec)
         message(FATAL_ERROR "Process failed: ${ARGN}")
     endif()
 endfunction()
+if(CARBIN_BUILD_JOBS)
+    set(PREAMBLE_JOBS ${CARBIN_BUILD_JOBS})
+else()
+    include(ProcessorCount)
+    ProcessorCount(PREAMBLE_JOBS)
+endif()
+# When built by carbin, build tools that take a -j flag are started through
+# carbin so their jobs come out of carbin's jobserver
+if(CARBIN_PYTHON_EXECUTABLE)
+    set(JOBS_LAUNCHER ${CARBIN_PYTHON_EXECUTABLE} -m carbin.jobserver ${PREAMBLE_JOBS})
+    set(JOBS_FLAG)
+else()
+    set(JOBS_LAUNCHER)
+    set(JOBS_FLAG -j ${PREAMBLE_JOBS})
+endif()
+# A recursive make shares the jobserver of the make running the build
+if(CMAKE_GENERATOR STREQUAL "Unix Makefiles")
+    set(MAKE_JOBS_COMMAND "$(MAKE)")
+else()
+    set(MAKE_JOBS_COMMAND ${JOBS_LAUNCHER} ${MAKE_EXE} ${JOBS_FLAG})
+endif()
 if(CMAKE_CROSSCOMPILING)
     set(PREFIX_PATH ${CMAKE_FIND_ROOT_PATH})
 else()
@@ -147,9 +165,18 @@ macro(preamble PREFIX)
         list(APPEND ${PREFIX}_BASE_ENV_COMMAND "PKG_CONFIG_LIBDIR=${${PREFIX}_PKG_CONFIG_PATH}")
     endif()
 
+    # Compile through the same launcher, such as ccache, as cmake does
+    foreach(LANG C CXX)
+        set(${PREFIX}_${LANG}_COMPILER "${CMAKE_${LANG}_COMPILER}")
+        if(CMAKE_${LANG}_COMPILER_LAUNCHER)
+            string(REPLACE ";" " " ${PREFIX}_${LANG}_LAUNCHER "${CMAKE_${LANG}_COMPILER_LAUNCHER}")
+            set(${PREFIX}_${LANG}_COMPILER "${${PREFIX}_${LANG}_LAUNCHER} ${CMAKE_${LANG}_COMPILER}")
+        endif()
+    endforeach()
+
     set(${PREFIX}_ENV_COMMAND ${${PREFIX}_BASE_ENV_COMMAND}
-        "CC=${CMAKE_C_COMPILER}"
-        "CXX=${CMAKE_CXX_COMPILER}"
+        "CC=${${PREFIX}_C_COMPILER}"
+        "CXX=${${PREFIX}_CXX_COMPILER}"
         "CFLAGS=${${PREFIX}_C_FLAGS}"
         "CXXFLAGS=${${PREFIX}_CXX_FLAGS}"
         "LDFLAGS=${${PREFIX}_LINK_FLAGS}") 
@@ -292,7 +319,6 @@ set(BOOST_BUILD_FLAGS "" CACHE STRING "Additional flags to pass to boost build")
 set(BUILD_FLAGS
     -q
     ${B2_VERBOSE_FLAG}
-    -j ${B2_JOBS}
     --ignore-site-config
     --user-config=${B2_CONFIG}
     --build-dir=${B2_BUILD_DIR}
@@ -320,15 +346,15 @@ set(BUILD_FLAGS
 string(REPLACE ";" " " BUILD_FLAGS_STR "${BUILD_FLAGS}")
 
 add_custom_target(boost ALL
-    COMMAND ${B2_ENV_COMMAND} ${B2_EXE} ${BUILD_FLAGS}
-    COMMENT "${B2_EXE} ${BUILD_FLAGS_STR}"
+    COMMAND ${B2_ENV_COMMAND} ${JOBS_LAUNCHER} ${B2_EXE} ${BUILD_FLAGS} ${JOBS_FLAG}
+    COMMENT "${B2_EXE} -j ${PREAMBLE_JOBS} ${BUILD_FLAGS_STR}"
     VERBATIM
     WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
 )
 
 add_custom_target(boost_install
-    COMMAND ${B2_ENV_COMMAND} ${B2_EXE} ${BUILD_FLAGS} install
-    COMMENT "${B2_EXE} ${BUILD_FLAGS_STR} install"
+    COMMAND ${B2_ENV_COMMAND} ${JOBS_LAUNCHER} ${B2_EXE} ${BUILD_FLAGS} install ${JOBS_FLAG}
+    COMMENT "${B2_EXE} -j ${PREAMBLE_JOBS} ${BUILD_FLAGS_STR} install"
     VERBATIM
     WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
 )
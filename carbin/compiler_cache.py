@@ -0,0 +1,70 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os, re, json
+
+import carbin.util as util
+
+
+def find(name):
+    if name is None or name == 'none': return None
+    if name == 'auto':
+        for launcher in ['ccache', 'sccache']:
+            exe = util.which(launcher, throws=False)
+            if exe: return exe
+        return None
+    exe = util.which(name, throws=False)
+    if not exe: raise util.BuildError("Compiler cache not found: {}".format(name))
+    return exe
+
+
+def is_sccache(exe):
+    return os.path.basename(exe).startswith('sccache')
+
+
+# The launcher written into the toolchain by carbin init
+def read_launcher(toolchain):
+    if not os.path.exists(toolchain): return None
+    m = re.search(r'set\(CARBIN_COMPILER_LAUNCHER "([^"]*)"', open(toolchain).read())
+    return m.group(1) if m else None
+
+
+# Every prefix shares one cache directory, unless the user picked their own
+def get_env(exe):
+    var, name = ('SCCACHE_DIR', 'sccache') if is_sccache(exe) else ('CCACHE_DIR', 'ccache')
+    return {var: os.environ.get(var) or util.get_cache_path(name)}
+
+
+# Returns the number of hits and misses so far, or None when the launcher
+# can't report them
+def get_stats(exe):
+    try:
+        if is_sccache(exe):
+            out, err = util.cmd([exe, '--show-stats', '--stats-format', 'json'], env=get_env(exe), capture='out')
+            stats = json.loads(out.decode('utf-8'))['stats']
+            return (sum(stats['cache_hits']['counts'].values()), sum(stats['cache_misses']['counts'].values()))
+        out, err = util.cmd([exe, '--print-stats'], env=get_env(exe), capture='out')
+        stats = dict(line.split('\t', 1) for line in out.decode('utf-8').splitlines() if '\t' in line)
+        hits = int(stats.get('direct_cache_hit', 0)) + int(stats.get('preprocessed_cache_hit', 0))
+        return (hits, int(stats.get('cache_miss', 0)))
+    except (util.BuildError, OSError, ValueError, KeyError):
+        return None
+
+
+def format_stats(before, after):
+    hits, misses = after[0] - before[0], after[1] - before[1]
+    total = hits + misses
+    if total == 0: return "Compiler cache: no compilations"
+    return "Compiler cache: {0} hits, {1} misses ({2:.0f}% hit rate)".format(hits, misses, 100.0 * hits / total)
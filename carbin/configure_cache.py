@@ -0,0 +1,165 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os, re, glob, json, shutil, threading
+
+import carbin.util as util
+
+# The results every package configured with the same toolchain would find
+# again: cmake's compiler detection, and the entries of autoconf's cache for
+# the compiler and the tools it found. The results of checks for headers,
+# functions, libraries and types are not shared, since they depend on the
+# flags, include directories and libraries each package sets for them. Only
+# positive results are kept, and a result two packages disagree on is
+# dropped. Each result also records the dependencies of every package that
+# found it, since a tool can come from one of them.
+AUTOCONF_ENTRY = re.compile(r'^((?:ac|am|lt)_cv_\w+)=\$\{\1=(.*)\}$')
+AUTOCONF_TOOLCHAIN = re.compile(r'^(?:ac_cv_(?:prog_|path_|c_compiler_gnu$|cxx_compiler_gnu$|objext$|exeext$|build$|host$|'
+                                r'target$)|am_cv_|lt_cv_)')
+PLATFORM_FILES = ['CMakeSystem.cmake', 'CMake*Compiler.cmake', 'CMakeDetermineCompilerABI_*.bin']
+# Found by the compiler detection, but only stored in the cmake cache
+PLATFORM_ENTRIES = ['CMAKE_EXECUTABLE_FORMAT']
+
+lock = threading.Lock()
+
+
+def read_cmake_cache(path):
+    help = []
+    for line in open(path):
+        line = line.rstrip('\n')
+        if line.startswith('//'):
+            help.append(line[2:])
+            continue
+        if ':' in line and '=' in line and not line.startswith('#'):
+            name, rest = line.split(':', 1)
+            vtype, value = rest.split('=', 1)
+            yield name, vtype, value, ' '.join(help)
+        help = []
+
+
+def get_autoconf_checks(cache):
+    if not os.path.exists(cache): return
+    for line in open(cache):
+        m = AUTOCONF_ENTRY.match(line.strip())
+        if not m or not AUTOCONF_TOOLCHAIN.match(m.group(1)): continue
+        if m.group(2).strip('\'"') in ['', 'no']: continue
+        yield m.group(1), line.strip()
+
+
+def merge(checks, results, found, deps):
+    for name, value in results:
+        if name not in checks: checks[name] = value
+        elif checks[name] != value: checks[name] = None
+        found[name] = sorted(set(found.get(name, deps)) & set(deps))
+
+
+def write_atomic(path, content):
+    tmp = path + '.tmp.{0}'.format(os.getpid())
+    with open(tmp, 'w') as f: f.write(content)
+    os.rename(tmp, path)
+
+
+def get_platform_entries(cache):
+    if not os.path.exists(cache): return
+    for name, vtype, value, help in read_cmake_cache(cache):
+        if name in PLATFORM_ENTRIES and value: yield name, [help, value]
+
+
+# Lets cmake load the seeded compiler detection instead of running it
+def render_init(platform):
+    lines = ['set(CMAKE_PLATFORM_INFO_INITIALIZED 1 CACHE INTERNAL "")']
+    for name, (help, x) in sorted(platform.items()):
+        lines.append('set({0} {1} CACHE INTERNAL {2})'.format(name, util.quote(x), util.quote(help)))
+    return '\n'.join(lines) + '\n'
+
+
+def render_autoconf(checks):
+    return ''.join(line + '\n' for name, line in sorted(checks.items()) if line is not None)
+
+
+# Copies the compiler detection into a build directory that hasn't been
+# configured yet, and returns the arguments that pass the cached checks
+def seed(d, build_dir):
+    platform = os.path.join(d, 'platform')
+    if os.path.isdir(platform) and not os.path.exists(os.path.join(build_dir, 'CMakeCache.txt')):
+        for version in os.listdir(platform):
+            dst = os.path.join(build_dir, 'CMakeFiles', version)
+            util.mkdir(dst)
+            for f in os.listdir(os.path.join(platform, version)):
+                if not os.path.exists(os.path.join(dst, f)): shutil.copy2(os.path.join(platform, version, f), dst)
+    args = []
+    init = os.path.join(d, 'init.cmake')
+    if os.path.exists(init): args.extend(['-C', init])
+    # Autotools packages always keep a cache, which is how the shared one
+    # gets its first entries
+    args.append('-DCARBIN_AUTOTOOLS_CACHE_FILE={}'.format(os.path.join(d, 'config.cache')))
+    return args
+
+
+def save_platform(d, build_dir):
+    for src in glob.glob(os.path.join(build_dir, 'CMakeFiles', '[0-9]*')):
+        dst = os.path.join(d, 'platform', os.path.basename(src))
+        for pattern in PLATFORM_FILES:
+            for f in glob.glob(os.path.join(src, pattern)):
+                target = os.path.join(dst, os.path.basename(f))
+                if os.path.exists(target): continue
+                util.mkdir(dst)
+                shutil.copy2(f, target + '.tmp')
+                os.rename(target + '.tmp', target)
+
+
+def write(d, checks):
+    autoconf = checks.get('autoconf', {})
+    write_atomic(os.path.join(d, 'checks.json'), json.dumps(checks, indent=4, sort_keys=True))
+    if os.path.isdir(os.path.join(d, 'platform')):
+        write_atomic(os.path.join(d, 'init.cmake'), render_init(checks.get('platform', {})))
+    if any(line is not None for line in autoconf.values()):
+        write_atomic(os.path.join(d, 'config.cache'), render_autoconf(autoconf))
+    elif os.path.exists(os.path.join(d, 'config.cache')):
+        os.remove(os.path.join(d, 'config.cache'))
+
+
+# Adds what a successful configure found, with the dependencies of the
+# package, to the cache
+def update(d, build_dir, deps):
+    with lock:
+        util.mkdir(d)
+        save_platform(d, build_dir)
+        checks = util.read_json(os.path.join(d, 'checks.json')) or {}
+        platform = checks.setdefault('platform', {})
+        for name, value in get_platform_entries(os.path.join(build_dir, 'CMakeCache.txt')): platform.setdefault(name, value)
+        merge(checks.setdefault('autoconf', {}), get_autoconf_checks(os.path.join(build_dir, 'build', 'config.cache')),
+              checks.setdefault('deps', {}), deps)
+        write(d, checks)
+
+
+# Drops the results found by packages that depend on the package from the
+# cache of every toolchain. The compiler detection doesn't depend on the
+# installed packages, so it is kept.
+def remove_package(root, fname):
+    with lock:
+        for key in util.ls(root, os.path.isdir):
+            d = os.path.join(root, key)
+            checks = util.read_json(os.path.join(d, 'checks.json'))
+            if not checks: continue
+            found = checks.setdefault('deps', {})
+            results = checks.get('autoconf', {})
+            removed = False
+            for name in list(results):
+                if name in found and fname not in found[name]: continue
+                del results[name]
+                found.pop(name, None)
+                removed = True
+            if removed: write(d, checks)
@@ -0,0 +1,228 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os, re, json, threading, contextlib
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+import carbin.util as util
+from six.moves.urllib import parse
+
+# An edge is recorded for each package that depends on another, the same as
+# the files in pkg/<package>/deps
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT PRIMARY KEY,
+    url TEXT,
+    version TEXT,
+    config TEXT,
+    linked INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS deps (
+    package TEXT NOT NULL,
+    dependent TEXT NOT NULL,
+    PRIMARY KEY (package, dependent)
+);
+CREATE INDEX IF NOT EXISTS deps_dependent ON deps (dependent);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+DEPENDENTS = '''
+WITH RECURSIVE found(name) AS (
+    SELECT ?
+    UNION SELECT deps.dependent FROM deps JOIN found ON deps.package = found.name
+)
+SELECT packages.name FROM found JOIN packages ON packages.name = found.name
+WHERE packages.linked AND (? OR packages.name != ?) ORDER BY packages.name
+'''
+
+DEPENDENCIES = '''
+WITH RECURSIVE found(name) AS (
+    SELECT ?
+    UNION SELECT deps.package FROM deps JOIN found ON deps.dependent = found.name
+)
+SELECT packages.name FROM found JOIN packages ON packages.name = found.name
+WHERE packages.linked AND packages.name != ? ORDER BY packages.name
+'''
+
+
+def is_supported():
+    return sqlite3 is not None
+
+
+def get_version(url):
+    m = re.search(r'/archive/(?:refs/tags/)?([^/]+?)\.(?:tar\.\w+|tgz|zip)$', url or '')
+    return m.group(1) if m else None
+
+
+def get_mtime(path):
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+
+# The mtimes of the directories, and of each package's directory and deps
+# directory in them, so an edge added or removed by hand is seen too
+def get_stamp(*dirs):
+    stamp = []
+    for d in dirs:
+        packages = sorted(util.ls(d, os.path.isdir))
+        stamp.append([get_mtime(d)] + [[name, get_mtime(os.path.join(d, name)), get_mtime(os.path.join(d, name, 'deps'))]
+                                       for name in packages])
+    return json.dumps(stamp)
+
+
+# The installed packages and the edges between them, so listing and
+# following dependencies doesn't walk the pkg directories. It is checked
+# against those directories and their deps directories, from their mtimes,
+# when it's opened, and is rebuilt when they were changed without it, such as
+# by an older carbin or by hand. So it has to be opened before a command
+# changes them.
+class PackageDB:
+    def __init__(self, path, pkg_dir, unlink_dir):
+        self.path = path
+        self.pkg_dir = pkg_dir
+        self.unlink_dir = unlink_dir
+        self.conn = None
+        self.read_only = False
+        self.lock = threading.Lock()
+
+    def is_current(self, conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+        return row is not None and row[0] == get_stamp(self.pkg_dir, self.unlink_dir)
+
+    def connect(self, write=True):
+        if self.conn is not None and self.read_only and write:
+            self.conn.close()
+            self.conn = None
+        if self.conn is None:
+            util.mkdir(os.path.dirname(self.path))
+            self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.read_only = False
+            with self.conn:
+                self.conn.executescript(SCHEMA)
+                if not self.is_current(self.conn): self.rebuild()
+        return self.conn
+
+    def open(self):
+        with self.lock: self.connect()
+
+    # Opens the database without changing it, returns False when it doesn't
+    # exist or is out of date
+    def open_read_only(self):
+        with self.lock:
+            if self.conn is not None: return True
+            if not os.path.exists(self.path): return False
+            conn = sqlite3.connect('file:{}?mode=ro'.format(parse.quote(self.path.replace(os.sep, '/'))), uri=True,
+                                   timeout=60, check_same_thread=False)
+            try:
+                current = self.is_current(conn)
+            except sqlite3.Error:
+                current = False
+            if not current:
+                conn.close()
+                return False
+            self.conn = conn
+            self.read_only = True
+            return True
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None: self.conn.close()
+            self.conn = None
+
+    # Keeps the url, version and config of the packages still installed
+    def rebuild(self):
+        found = {}
+        for d, linked in [(self.pkg_dir, 1), (self.unlink_dir, 0)]:
+            for name in util.ls(d, os.path.isdir): found[name] = (linked, os.path.join(d, name, 'deps'))
+        for name in [row[0] for row in self.conn.execute('SELECT name FROM packages')]:
+            if name not in found: self.conn.execute('DELETE FROM packages WHERE name = ?', (name,))
+        self.conn.execute('DELETE FROM deps')
+        for name, (linked, deps_dir) in found.items():
+            self.conn.execute('INSERT OR IGNORE INTO packages (name) VALUES (?)', (name,))
+            self.conn.execute('UPDATE packages SET linked = ? WHERE name = ?', (linked, name))
+            for dependent in util.ls(deps_dir, os.path.isfile):
+                self.conn.execute('INSERT OR IGNORE INTO deps VALUES (?, ?)', (name, dependent))
+        self.write_stamp()
+
+    def write_stamp(self):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (get_stamp(self.pkg_dir, self.unlink_dir),))
+
+    # Each change is written with the mtimes of the directories after it, so
+    # changes this process made to them since it opened the database aren't
+    # mistaken for changes made without it
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                yield conn
+                self.write_stamp()
+
+    def query(self, sql, *args):
+        with self.lock:
+            return [row[0] for row in self.connect(write=False).execute(sql, args)]
+
+    def add(self, name, url=None, config=None):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, 1)',
+                         (name, url, get_version(url), json.dumps(config, sort_keys=True) if config else None))
+
+    def set_linked(self, name, linked):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO packages (name) VALUES (?)', (name,))
+            conn.execute('UPDATE packages SET linked = ? WHERE name = ?', (1 if linked else 0, name))
+
+    def remove(self, name):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM packages WHERE name = ?', (name,))
+            conn.execute('DELETE FROM deps WHERE package = ?', (name,))
+
+    def add_edge(self, package, dependent):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO deps VALUES (?, ?)', (package, dependent))
+
+    def get(self, name):
+        with self.lock:
+            row = self.connect(write=False).execute('SELECT url, version, config, linked FROM packages WHERE name = ?',
+                                         (name,)).fetchone()
+        if row is None: return None
+        return {'url': row[0], 'version': row[1], 'config': json.loads(row[2]) if row[2] else None,
+                'linked': bool(row[3])}
+
+    def packages(self):
+        return self.query('SELECT name FROM packages WHERE linked ORDER BY name')
+
+    # The linked packages that depend on name, directly or through others
+    def dependents(self, name, recursive=True, top=True):
+        if recursive: return self.query(DEPENDENTS, name, top, name)
+        found = self.query('SELECT name FROM packages WHERE name = ? AND linked', name) if top else []
+        return found + self.query(
+            'SELECT packages.name FROM deps JOIN packages ON packages.name = deps.dependent '
+            'WHERE deps.package = ? AND packages.linked ORDER BY packages.name', name)
+
+    # The unlinked packages name depends on directly, found from the index on
+    # dependent instead of the deps of every unlinked package
+    def unlinked_dependencies(self, name):
+        return self.query('SELECT packages.name FROM deps JOIN packages ON packages.name = deps.package '
+                          'WHERE deps.dependent = ? AND NOT packages.linked ORDER BY packages.name', name)
+
+    def dependencies(self, name):
+        return self.query(DEPENDENCIES, name, name)
@@ -0,0 +1,83 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import collections
+
+import carbin.util as util
+
+
+class PackageNode:
+    def __init__(self, pb, track=True, test=False, update=False):
+        self.pb = pb
+        self.key = pb.to_fname()
+        self.test = test
+        self.update = update
+        # One of 'build', 'link' or 'skip'
+        self.action = 'build'
+        self.builder = None
+        self.src_dir = None
+        # Future of the background download, if the source is being prefetched
+        self.fetching = None
+        self.deps = []
+        # Every (pb, track) this package was requested with, so each parent gets recorded
+        self.refs = [(pb, track)]
+
+    def add_dep(self, node):
+        if node.key not in self.deps: self.deps.append(node.key)
+
+    def add_ref(self, pb, track=True):
+        self.refs.append((pb, track))
+
+
+class PackageGraph:
+    def __init__(self):
+        self.nodes = collections.OrderedDict()
+
+    # A package is found by its name, since packages with the same name would
+    # be installed into the same directory, and packages with different names
+    # are never merged even when they come from the same source
+    def get(self, pb):
+        return self.nodes.get(pb.to_fname())
+
+    def add(self, node):
+        self.nodes[node.key] = node
+        return node
+
+    def sorted(self):
+        result = []
+        visited = set()
+        visiting = []
+
+        def visit(node):
+            if node.key in visited: return
+            if node.key in visiting:
+                cycle = visiting[visiting.index(node.key):] + [node.key]
+                raise util.BuildError("Circular dependency: " + ' -> '.join(cycle))
+            visiting.append(node.key)
+            for dep in node.deps:
+                visit(self.nodes[dep])
+            visiting.pop()
+            visited.add(node.key)
+            result.append(node)
+
+        for node in self:
+            visit(node)
+        return result
+
+    def __iter__(self):
+        return iter(list(self.nodes.values()))
+
+    def __len__(self):
+        return len(self.nodes)
@@ -0,0 +1,123 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os, sys, select, shutil, tempfile, contextlib, subprocess
+
+# The jobserver is a named pipe holding one byte per job that may run. It is
+# handed to make with the usual MAKEFLAGS so every make started by carbin,
+# and any make they start recursively, draws from the same tokens. Tools that
+# don't speak the protocol (ctest, b2) take tokens through JobClient instead.
+JOBSERVER_ENV = 'CARBIN_JOBSERVER'
+
+
+def is_supported():
+    return hasattr(os, 'mkfifo') and hasattr(os, 'set_blocking')
+
+
+class JobClient:
+    def __init__(self, path):
+        self.path = path
+        # Opening a fifo read-write never blocks, and non-blocking reads let
+        # us take extra tokens only when they are free
+        self.fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+    def try_acquire(self):
+        try:
+            return os.read(self.fd, 1) or None
+        except (BlockingIOError, InterruptedError):
+            return None
+
+    def acquire(self):
+        while True:
+            token = self.try_acquire()
+            if token: return token
+            select.select([self.fd], [], [])
+
+    def release(self, token):
+        os.write(self.fd, token)
+
+    @contextlib.contextmanager
+    def slot(self):
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    # Takes as many tokens as are free, up to limit, and yields the number of
+    # jobs that can run. Unless the caller already holds a job slot (such as
+    # a command run by make) this waits for at least one token.
+    @contextlib.contextmanager
+    def tokens(self, limit, held=0):
+        tokens = [] if held else [self.acquire()]
+        while held + len(tokens) < limit:
+            token = self.try_acquire()
+            if not token: break
+            tokens.append(token)
+        try:
+            yield held + len(tokens)
+        finally:
+            for token in tokens: self.release(token)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class JobServer(JobClient):
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.dir = tempfile.mkdtemp(prefix='carbin-jobserver-')
+        path = os.path.join(self.dir, 'fifo')
+        os.mkfifo(path)
+        JobClient.__init__(self, path)
+        # Blocking descriptors for make, which expects an anonymous pipe
+        self.read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        os.set_blocking(self.read_fd, True)
+        self.write_fd = os.open(path, os.O_WRONLY)
+        os.write(self.write_fd, b'+' * jobs)
+
+    def get_env(self):
+        return {
+            'MAKEFLAGS': '-j{0} --jobserver-auth={1},{2}'.format(self.jobs, self.read_fd, self.write_fd),
+            JOBSERVER_ENV: self.path
+        }
+
+    def get_fds(self):
+        return (self.read_fd, self.write_fd)
+
+    def close(self):
+        for fd in [self.read_fd, self.write_fd]: os.close(fd)
+        JobClient.close(self)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def get_client():
+    path = os.environ.get(JOBSERVER_ENV)
+    if path and os.path.exists(path): return JobClient(path)
+    return None
+
+
+# Runs a command that takes a -j flag from a make recipe, with its own job
+# slot plus whatever the jobserver has free, eg: python -m carbin.jobserver 8 b2
+def main(args):
+    limit = int(args[0])
+    client = get_client()
+    if client is None: return subprocess.call(args[1:] + ['-j{}'.format(limit)])
+    with client.tokens(limit, held=1) as n:
+        return subprocess.call(args[1:] + ['-j{}'.format(n)])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,56 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os, re, json
+
+import carbin.util as util
+
+LOCK_FILE = 'carbin.lock'
+VERSION = 1
+
+GITHUB_ARCHIVE = re.compile(r'^https?://github\.com/([^/]+/[^/]+)/archive/(.+?)\.tar\.gz$')
+
+
+# The lock file lives next to the file the packages are listed in
+def get_path(file=None):
+    return os.path.join(os.path.dirname(os.path.abspath(file)) if file else os.getcwd(), LOCK_FILE)
+
+
+def read(path):
+    data = util.read_json(path)
+    if data is None: raise util.BuildError("Lock file not found: {}, run carbin lock".format(path))
+    if data.get('version') != VERSION:
+        raise util.BuildError("Unsupported lock file version {0}: {1}".format(data.get('version'), path))
+    return data.get('packages', {})
+
+
+def write(path, packages):
+    with open(path, 'w') as f:
+        json.dump({'version': VERSION, 'packages': packages}, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+
+# Returns the url with a github branch replaced by the commit it points to,
+# and the commit or tag the url is pinned to
+def resolve_url(url, insecure=False):
+    m = GITHUB_ARCHIVE.match(url)
+    if m is None: return url, None
+    repo, ref = m.groups()
+    if util.is_pinned_url(url): return url, ref.split('/')[-1]
+    response = util.open_url('https://api.github.com/repos/{0}/commits/{1}'.format(repo, ref), insecure=insecure,
+                             headers={'Accept': 'application/vnd.github.sha'})
+    sha = response.read().decode('utf-8').strip()
+    if not re.match(r'^[0-9a-f]{40}$', sha): raise util.BuildError("Failed to resolve {0} of {1}".format(ref, repo))
+    return 'https://github.com/{0}/archive/{1}.tar.gz'.format(repo, sha), sha
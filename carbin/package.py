@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import base64, copy, argparse, six, hashlib
+import base64, copy, os, shlex, six, hashlib
 
 
 def encode_url(url):
@@ -74,7 +74,7 @@ def fname_to_pkg(fname):
 
 class PackageBuild:
     def __init__(self, pkg_src=None, define=None, parent=None, test=False, hash=None, build=None, cmake=None,
-                 variant=None, requirements=None, file=None, ignore_requirements=None):
+                 variant=None, requirements=None, file=None, ignore_requirements=None, recipe=None):
         self.pkg_src = pkg_src
         self.define = define or []
         self.parent = parent
@@ -86,6 +86,13 @@ class PackageBuild:
         self.requirements = requirements
         self.ignore_requirements = ignore_requirements
         self.file = file
+        self.recipe = recipe
+
+    def clone(self):
+        result = copy.copy(self)
+        result.define = list(self.define)
+        if isinstance(self.pkg_src, PackageSource): result.pkg_src = copy.copy(self.pkg_src)
+        return result
 
     def merge_defines(self, defines):
         result = copy.copy(self)
@@ -98,11 +105,9 @@ class PackageBuild:
             result.define.extend(other.define)
         else:
             result.define = other.define
-        for field in dir(self):
-            if not callable(getattr(self, field)) and not field.startswith("__") and not field in ['define', 'pkg_src']:
-                x = getattr(self, field)
-                y = getattr(other, field)
-                setattr(result, field, y or x)
+        for field, x in vars(self).items():
+            if not field in ['define', 'pkg_src']:
+                setattr(result, field, getattr(other, field) or x)
         return result
 
     def of(self, parent):
@@ -125,14 +130,93 @@ class PackageBuild:
             return self.pkg_src
 
 
+PKG_BUILD_OPTIONS = {
+    '-D': ('define', True),
+    '--define': ('define', True),
+    '-H': ('hash', True),
+    '--hash': ('hash', True),
+    '-X': ('cmake', True),
+    '--cmake': ('cmake', True),
+    '-f': ('file', True),
+    '--file': ('file', True),
+    '-t': ('test', False),
+    '--test': ('test', False),
+    '-b': ('build', False),
+    '--build': ('build', False),
+    '--ignore-requirements': ('ignore_requirements', False)
+}
+
+
+def get_long_option(arg):
+    if arg in PKG_BUILD_OPTIONS: return arg
+    found = [option for option in PKG_BUILD_OPTIONS if option.startswith('--') and option.startswith(arg)]
+    return found[0] if len(found) == 1 else arg
+
+
+# Accepts the same arguments argparse did, such as -DX=1, --define=X=1, -tb
+# and unambiguous prefixes of long options, without building a parser for
+# every line
 def parse_pkg_build_tokens(args):
-    parser = argparse.ArgumentParser()
-    parser.add_argument('pkg_src', nargs='?')
-    parser.add_argument('-D', '--define', action='append', default=[])
-    parser.add_argument('-H', '--hash')
-    parser.add_argument('-X', '--cmake')
-    parser.add_argument('-f', '--file')
-    parser.add_argument('-t', '--test', action='store_true')
-    parser.add_argument('-b', '--build', action='store_true')
-    parser.add_argument('--ignore-requirements', action='store_true')
-    return parser.parse_args(args=args, namespace=PackageBuild())
+    pb = PackageBuild()
+    args = list(reversed(args))
+    while args:
+        arg = args.pop()
+        if not arg.startswith('-') or arg == '-':
+            if pb.pkg_src is not None: raise ValueError("Unexpected argument: {}".format(arg))
+            pb.pkg_src = arg
+            continue
+        value = None
+        if arg.startswith('--'):
+            if '=' in arg: arg, value = arg.split('=', 1)
+            arg = get_long_option(arg)
+        elif len(arg) > 2:
+            arg, value = arg[:2], arg[2:]
+        if arg not in PKG_BUILD_OPTIONS: raise ValueError("Unknown option: {}".format(arg))
+        field, takes_value = PKG_BUILD_OPTIONS[arg]
+        if not takes_value:
+            if value is not None and arg.startswith('--'): raise ValueError("Option {} doesn't take a value".format(arg))
+            if value is not None: args.append('-' + value)
+            setattr(pb, field, True)
+            continue
+        if value is None:
+            if not args: raise ValueError("Option {} needs a value".format(arg))
+            value = args.pop()
+        if field == 'define': pb.define.append(value)
+        else: setattr(pb, field, value)
+    return pb
+
+
+# Most lines have no quotes or escapes, and don't need shlex. Like shlex, a
+# comment starts at any # outside of quotes.
+def split_line(line):
+    if any(c in line for c in '\\\'"'): return shlex.split(line, comments=True)
+    return line.split('#', 1)[0].split()
+
+
+def parse_lines(lines):
+    cache_line = ""
+    for line in lines:
+        if str.endswith(line, '\\\n'):
+            if line.lstrip().startswith('#'):
+                continue
+            cache_line = cache_line + line.strip('\\\n')
+            continue
+        cache_line = cache_line + line
+        tokens = split_line(cache_line)
+        cache_line = ""
+        if len(tokens) > 0: yield parse_pkg_build_tokens(tokens)
+
+
+parse_cache = {}
+
+
+# The records of a file are parsed once for each version of it, and cloned
+# for every caller since resolving them changes them in place
+def parse_file(file):
+    st = os.stat(file)
+    path = os.path.abspath(file)
+    stamp = (st.st_mtime_ns, st.st_size)
+    if path not in parse_cache or parse_cache[path][0] != stamp:
+        with open(file) as f:
+            parse_cache[path] = (stamp, list(parse_lines(f)))
+    return [pb.clone() for pb in parse_cache[path][1]]
@@ -13,13 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import os, shutil, shlex, six, inspect, click, contextlib, sys, functools, re
+import os, shutil, six, inspect, click, contextlib, sys, functools, re, threading, atexit, json, time
 
+import carbin.compiler_cache as compiler_cache
 from carbin.builder import Builder
+from carbin.graph import PackageGraph
+from carbin.graph import PackageNode
 from carbin.package import fname_to_pkg
 from carbin.package import PackageSource
 from carbin.package import PackageBuild
-from carbin.package import parse_pkg_build_tokens
+import carbin.package as package
 import carbin.util as util
 from carbin.types import returns
 from carbin.types import params
@@ -119,14 +122,165 @@ def find_cmake(p, start):
 
 PACKAGE_SOURCE_TYPES = (six.string_types, PackageSource, PackageBuild)
 
+MANIFEST_MODE = '# install-mode: '
+
 
 class CarbinPrefix:
-    def __init__(self, prefix, verbose=False, build_path=None):
+    def __init__(self, prefix, verbose=False, build_path=None, build_jobs=None, max_mem=None):
         self.prefix = os.path.abspath(prefix or 'carbin')
         self.verbose = verbose
         self.build_path_var = build_path
+        self.build_jobs = build_jobs or util.BUILD_JOBS
+        self.jobserver = None
+        self.jobserver_lock = threading.Lock()
+        self.max_mem = max_mem or util.MAX_MEM
+        self.mem_used = 0
+        self.mem_cond = threading.Condition()
+        self.artifacts = None
+        self.compiler_id = None
+        self.remote = None
+        self.keep_builds = util.KEEP_BUILDS
+        self.keep_going = False
+        self.locked = None
+        self.build_trees_size = util.BUILD_TREES_SIZE
+        self.active_builds = set()
+        self.builds_lock = threading.Lock()
+        self.db = None
+        self.load_lock = threading.Lock()
+        self.recipes = None
         self.cmd = util.Commander(paths=[self.get_path('bin')], env=self.get_env(), verbose=self.verbose)
-        self.toolchain = self.write_cmake()
+        self.toolchain = None
+
+    # One jobserver is shared by every build started from this prefix, so
+    # building packages concurrently never runs more than build_jobs jobs
+    def get_jobserver(self):
+        import carbin.jobserver as jobserver
+        if not jobserver.is_supported(): return None
+        with self.jobserver_lock:
+            if self.jobserver is None:
+                self.jobserver = jobserver.JobServer(self.build_jobs)
+                atexit.register(self.jobserver.close)
+        return self.jobserver
+
+    # What only some commands use is loaded when they first need it, so
+    # commands like list and pkg-config start faster
+    def get_db(self):
+        with self.load_lock:
+            if self.db is None:
+                import carbin.db as db
+                self.db = db.PackageDB(self.get_private_path('packages.db'), self.get_package_directory(),
+                                       self.get_unlink_directory()) if db.is_supported() else False
+            return self.db
+
+    def get_recipes(self):
+        with self.load_lock:
+            if self.recipes is None:
+                from carbin.recipes import RecipeIndex
+                self.recipes = RecipeIndex(self.get_recipe_paths())
+            return self.recipes
+
+    def get_artifacts(self):
+        if self.artifacts is None:
+            import carbin.artifacts as artifacts
+            self.artifacts = artifacts.get_local_cache()
+        return self.artifacts
+
+    def get_remote(self):
+        if self.remote is None and util.REMOTE_CACHE:
+            from carbin.artifacts import RemoteCache
+            self.remote = RemoteCache(util.REMOTE_CACHE)
+        return self.remote
+
+    def get_mem_file(self):
+        return self.get_private_path('memory.json')
+
+    def read_mem_history(self):
+        try:
+            with open(self.get_mem_file()) as f: return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    # Peak RSS of one compile job, as observed the last time pb was built
+    def get_job_mem(self, pb):
+        return self.read_mem_history().get(pb.to_fname(), util.JOB_MEM)
+
+    def record_job_mem(self, pb, rss):
+        with self.mem_cond:
+            history = self.read_mem_history()
+            history[pb.to_fname()] = rss
+            util.mkdir(self.get_private_path())
+            with open(self.get_mem_file(), 'w') as f: json.dump(history, f, indent=4, sort_keys=True)
+
+    def get_build_jobs(self, pb):
+        if not self.max_mem: return self.build_jobs
+        return max(1, min(self.build_jobs, self.max_mem // self.get_job_mem(pb)))
+
+    # Waits until the memory pb's build needs is free, so the budget also
+    # limits how many packages build at once, and yields its job count
+    @contextlib.contextmanager
+    def reserve_mem(self, pb):
+        jobs = self.get_build_jobs(pb)
+        need = min(self.max_mem or 0, jobs * self.get_job_mem(pb))
+        with self.mem_cond:
+            # A package bigger than the budget still builds once nothing else is
+            while self.mem_used and self.mem_used + need > self.max_mem: self.mem_cond.wait()
+            self.mem_used += need
+        try:
+            yield jobs
+        finally:
+            with self.mem_cond:
+                self.mem_used -= need
+                self.mem_cond.notify_all()
+
+    def get_compiler_id(self):
+        if self.compiler_id is None:
+            toolchain = open(self.get_toolchain()).read()
+            import carbin.artifacts as artifacts
+            self.compiler_id = [artifacts.get_compiler_id(c) for c in artifacts.get_compilers(toolchain)]
+        return self.compiler_id
+
+    # Packages configured with the same toolchain share their compiler
+    # detection and check results
+    def get_configure_cache(self):
+        if not util.USE_CONFIGURE_CACHE: return None
+        import carbin.artifacts as artifacts
+        key = artifacts.get_key(toolchain=open(self.get_toolchain()).read(), compiler=self.get_compiler_id())
+        return self.get_private_path('configure-cache', key)
+
+    def get_artifact_file(self, pb):
+        return self.get_package_directory(pb.to_fname(), 'artifact')
+
+    def read_artifact_key(self, pb):
+        f = self.get_artifact_file(pb)
+        if os.path.exists(f): return open(f).read().strip()
+        return pb.to_fname()
+
+    # Covers everything that goes into the installed tree, including the
+    # builds of its dependencies
+    def get_artifact_key(self, pb, src_dir, generator=None):
+        deps = [self.read_artifact_key(dep)
+                for dep, transient in self.deps_of(pb, src_dir, ignore_requirements=pb.ignore_requirements)]
+        import carbin.artifacts as artifacts
+        return artifacts.get_key(
+            name=pb.to_fname(),
+            source=pb.hash or util.hash_dir(src_dir, cache=util.get_cache_path('source-digests', pb.to_fname() + '.json')),
+            cmake=pb.cmake and util.hash_file(pb.cmake, 'sha256'),
+            define=pb.define,
+            variant=pb.variant,
+            generator=generator,
+            toolchain=open(self.get_toolchain()).read(),
+            compiler=self.get_compiler_id(),
+            environment=artifacts.get_environment(),
+            deps=sorted(deps)
+        )
+
+    # A remote cache that can't be reached only means the package gets built
+    def pull_artifact(self, key):
+        try:
+            return self.remote.get(key, self.get_artifacts())
+        except Exception as e:
+            click.echo("WARNING: Failed to get {0} from remote cache {1}: {2}".format(key, self.remote.url, e))
+            return False
 
     def log(self, *args):
         if self.verbose: click.secho(' '.join([str(arg) for arg in args]), bold=True)
@@ -136,10 +290,32 @@ class CarbinPrefix:
             raise util.BuildError('ASSERTION FAILURE: ', ' '.join([str(arg) for arg in args]))
 
     def get_env(self):
-        return {
+        env = {
             'LD_LIBRARY_PATH': self.get_path('lib'),
             'PKG_CONFIG_PATH': self.pkg_config_path()
         }
+        launcher = compiler_cache.read_launcher(self.get_private_path('carbin.cmake'))
+        if launcher: env.update(compiler_cache.get_env(launcher))
+        return env
+
+    def get_default_generator(self):
+        if util.USE_NINJA and util.which('ninja', throws=False): return 'Ninja'
+        return None
+
+    # Reports the hits and misses of the compiler cache over the block
+    @contextlib.contextmanager
+    def compiler_cache_stats(self):
+        launcher = compiler_cache.read_launcher(self.get_toolchain())
+        before = compiler_cache.get_stats(launcher) if launcher else None
+        yield
+        after = compiler_cache.get_stats(launcher) if before else None
+        if after: click.echo(compiler_cache.format_stats(before, after))
+
+    # The toolchain is only written once a command needs it, so commands that
+    # just read the prefix, like list and pkg-config, leave it untouched
+    def get_toolchain(self):
+        if self.toolchain is None: self.toolchain = self.write_cmake()
+        return self.toolchain
 
     def write_cmake(self, always_write=False, **kwargs):
         return util.mkfile(self.get_private_path(), 'carbin.cmake', self.generate_cmake_toolchain(**kwargs),
@@ -148,7 +324,7 @@ class CarbinPrefix:
     @returns(inspect.isgenerator)
     @util.yield_from
     def generate_cmake_toolchain(self, toolchain=None, cc=None, cxx=None, cflags=None, cxxflags=None, ldflags=None,
-                                 std=None, defines=None):
+                                 std=None, defines=None, launcher=None):
         set_ = cmake_set
         if_ = cmake_if
         else_ = cmake_else
@@ -171,6 +347,10 @@ class CarbinPrefix:
                   )
         if cxx: yield set_('CMAKE_CXX_COMPILER', cxx)
         if cc: yield set_('CMAKE_C_COMPILER', cc)
+        if launcher:
+            yield set_('CARBIN_COMPILER_LAUNCHER', launcher)
+            for lang in ['C', 'CXX']:
+                yield set_('CMAKE_{}_COMPILER_LAUNCHER'.format(lang), launcher, cache='STRING')
         if std:
             yield if_('NOT "${CMAKE_CXX_COMPILER_ID}" STREQUAL "MSVC"',
                       set_('CMAKE_CXX_STD_FLAG', "-std={}".format(std))
@@ -208,7 +388,7 @@ class CarbinPrefix:
         return self.get_path('etc', 'carbin', *paths)
 
     def get_recipe_paths(self):
-        return [self.get_public_path('recipes')]
+        return util.RECIPE_PATH + [self.get_public_path('recipes')]
 
     def get_builder_path(self, *paths):
         if self.build_path_var:
@@ -217,14 +397,48 @@ class CarbinPrefix:
             return self.get_private_path('build', *paths)
 
     @contextlib.contextmanager
-    def create_builder(self, name, tmp=False):
+    def create_builder(self, name, tmp=False, keep=False):
         pre = ''
         if tmp: pre = 'tmp-'
+        if keep: pre = 'keep-'
         d = self.get_builder_path(pre + name)
         exists = os.path.exists(d)
         util.mkdir(d)
-        yield Builder(self, d, exists)
+        if keep:
+            with self.builds_lock: self.active_builds.add(d)
+        try:
+            yield Builder(self, d, exists, keep=keep)
+        finally:
+            if keep:
+                with self.builds_lock: self.active_builds.discard(d)
         if tmp: shutil.rmtree(d, ignore_errors=True)
+        if keep:
+            util.write_to(os.path.join(d, 'usage.json'),
+                          [json.dumps({'size': util.get_dir_size(d), 'used': time.time()})])
+            self.evict_builds(current=d)
+
+    # Packages are built in a kept tree, which is reused when they are updated
+    def create_install_builder(self, pb):
+        if self.keep_builds: return self.create_builder(pb.to_fname(), keep=True)
+        return self.create_builder(pb.pkg_src.get_hash(), tmp=True)
+
+    # Removes the least recently used build trees until they fit in
+    # build_trees_size, without touching the trees in use
+    def evict_builds(self, current=None):
+        trees = []
+        for name in util.ls(self.get_builder_path(), os.path.isdir):
+            if not name.startswith('keep-'): continue
+            d = self.get_builder_path(name)
+            usage = util.read_json(os.path.join(d, 'usage.json')) or {}
+            trees.append((usage.get('used', 0), usage.get('size') or util.get_dir_size(d), d))
+        total = 0
+        for used, size, d in sorted(trees, reverse=True):
+            total = total + size
+            if total <= self.build_trees_size: continue
+            with self.builds_lock:
+                if d == current or d in self.active_builds: continue
+                self.log("evict build tree:", d)
+                shutil.rmtree(d, ignore_errors=True)
 
     def get_package_directory(self, *dirs):
         return self.get_private_path('pkg', *dirs)
@@ -246,10 +460,8 @@ class CarbinPrefix:
 
     def parse_src_recipe(self, name, url):
         p, v = parse_src_name(url)
-        for rpath in self.get_recipe_paths():
-            rp = os.path.normcase(os.path.join(rpath, p, v or ''))
-            if os.path.exists(rp):
-                return PackageSource(name=name or p, recipe=rp)
+        rp = self.get_recipes().find(os.path.join(p, v or ''))
+        if rp: return PackageSource(name=name or p, recipe=rp)
         return None
 
     def parse_src_github(self, name, url):
@@ -281,22 +493,38 @@ class CarbinPrefix:
             pkg.pkg_src = self.parse_pkg_src(pkg.pkg_src, start, no_recipe)
             if pkg.pkg_src.recipe: pkg = self.from_recipe(pkg.pkg_src.recipe, pkg)
             if pkg.cmake: pkg.cmake = find_cmake(pkg.cmake, start)
-            return pkg
         else:
             pkg_src = self.parse_pkg_src(pkg, start, no_recipe)
             if pkg_src.recipe:
-                return self.from_recipe(pkg_src.recipe, pkg_src.name)
+                pkg = self.from_recipe(pkg_src.recipe, pkg_src.name)
             else:
-                return PackageBuild(pkg_src)
-
-    def from_recipe(self, recipe, pkg=None, name=None):
+                pkg = PackageBuild(pkg_src)
+        if no_recipe: return pkg
+        return self.apply_lock(pkg)
+
+    # With a lock file, every package comes from the url and digest it
+    # recorded, so nothing is looked up again
+    def apply_lock(self, pb):
+        if self.locked is None: return pb
+        entry = self.locked.get(pb.to_fname())
+        if entry is None: raise util.BuildError("Package {} is not in the lock file, run carbin lock".format(pb.to_name()))
+        pb.pkg_src.url = entry['url']
+        if entry.get('sha256') and not pb.hash: pb.hash = 'sha256:' + entry['sha256']
+        return pb
+
+    def load_recipe(self, recipe):
         recipe_pkg = os.path.join(recipe, "package.txt")
         util.ensure_exists(recipe_pkg)
         p = next(iter(self.from_file(recipe_pkg, no_recipe=True)))
         self.check(lambda: p.pkg_src is not None)
+        p.recipe = recipe
         requirements = os.path.join(recipe, "carbin_deps.txt")
         if os.path.exists(requirements): p.requirements = requirements
         p.pkg_src.recipe = None
+        return p
+
+    def from_recipe(self, recipe, pkg=None, name=None):
+        p = self.get_recipes().get_package(recipe, self.load_recipe)
         # Use original name
         if pkg:
             p.pkg_src.name = pkg.pkg_src.name
@@ -317,37 +545,78 @@ class CarbinPrefix:
         start = os.path.dirname(file)
         if url is not None and url.startswith('file://'):
             start = url[7:]
-        with open(file) as f:
-            self.log("parse file: " + file)
-            cache_line = ""
-            for line in f.readlines():
-                if str.endswith(line, '\\\n'):
-                    if line.lstrip().startswith('#'):
-                        continue
-                    cache_line = cache_line + line.strip('\\\n')
-                    continue
-                cache_line = cache_line + line
-                tokens = shlex.split(cache_line, comments=True)
-                cache_line = ""
-                if len(tokens) > 0:
-                    pb = parse_pkg_build_tokens(tokens)
-                    ps = self.from_file(util.actual_path(pb.file, start), no_recipe=no_recipe) if pb.file else [
-                        self.parse_pkg_build(pb, start=start, no_recipe=no_recipe)]
-                    for p in ps: yield p
-
-    def write_parent(self, pb, track=True):
-        if track and pb.parent is not None: util.mkfile(self.get_deps_directory(pb.to_fname()), pb.parent, pb.parent)
-
-    def install_deps(self, pb, d, test=False, test_all=False, generator=None, insecure=False,
-                     ignore_requirements=False):
-        req_txt = os.path.join(d, 'carbin_deps.txt') if not ignore_requirements else None
+        self.log("parse file: " + file)
+        for pb in package.parse_file(file):
+            ps = self.from_file(util.actual_path(pb.file, start), no_recipe=no_recipe) if pb.file else [
+                self.parse_pkg_build(pb, start=start, no_recipe=no_recipe)]
+            for p in ps: yield p
+
+    # The database checks the package directories when it's opened, so it's
+    # opened before they are changed
+    def open_db(self):
+        db = self.get_db()
+        if db: db.open()
+        return db
+
+    def write_parent(self, pb, track=True, fname=None):
+        if track and pb.parent is not None:
+            fname = fname or pb.to_fname()
+            db = self.open_db()
+            util.mkfile(self.get_deps_directory(fname), pb.parent, pb.parent)
+            if db: db.add_edge(fname, pb.parent)
+
+    def deps_of(self, pb, d, test=False, test_all=False, ignore_requirements=False):
+        req_txt = os.path.join(d, 'carbin_deps.txt') if d and not ignore_requirements else None
         for dependent in self.from_file(pb.requirements or req_txt, pb.pkg_src.url):
             transient = dependent.test or dependent.build
             testing = test or test_all
             installable = not dependent.test or dependent.test == testing
-            if installable:
-                self.install(dependent.of(pb), test_all=test_all, generator=generator, track=not transient,
-                             insecure=insecure)
+            if installable: yield dependent.of(pb), transient
+
+    def install_deps(self, pb, d, test=False, test_all=False, generator=None, insecure=False,
+                     ignore_requirements=False):
+        deps = list(self.deps_of(pb, d, test=test, test_all=test_all, ignore_requirements=ignore_requirements))
+        for dependent, transient in deps:
+            self.install(dependent, test_all=test_all, generator=generator, track=not transient, insecure=insecure)
+        return [dependent.to_fname() for dependent, transient in deps]
+
+    # Pins the source of every package and its dependencies, including the
+    # ones only needed by tests, to a url that can't change and its digest
+    def lock(self, pbs, insecure=False):
+        entries = {}
+        pending = list(pbs)
+        with self.create_builder('lock', tmp=True) as builder:
+            while pending:
+                pb = self.parse_pkg_build(pending.pop(0))
+                fname = pb.to_fname()
+                if fname in entries: continue
+                self.log("lock:", pb.to_name())
+                import carbin.lockfile as lockfile
+                url, ref = lockfile.resolve_url(pb.pkg_src.url, insecure=insecure)
+                local_dir = url.startswith('file://') and os.path.isdir(url[7:])
+                src_dir = url[7:] if local_dir else None
+                digest = None
+                if not local_dir:
+                    dst = util.mkdir(builder.get_path(fname))
+                    # Downloaded as install fetches it, while the lock keeps the url given
+                    download_url = url.replace('https', 'http') if insecure else url
+                    f = util.retrieve_url(download_url, dst, insecure=insecure, hash=pb.hash, progress=False)
+                    digest = util.get_digest(f, 'sha256')
+                    if not (pb.requirements or pb.ignore_requirements):
+                        util.extract_ar(archive=f, dst=builder.get_path(fname, 'src'))
+                        src_dir = next(util.get_dirs(builder.get_path(fname, 'src')))
+                pb.pkg_src.url = url
+                deps = list(self.deps_of(pb, src_dir, test_all=True, ignore_requirements=pb.ignore_requirements))
+                entries[fname] = {
+                    'name': pb.to_name(),
+                    'url': url,
+                    'ref': ref,
+                    'sha256': digest,
+                    'recipe': pb.recipe,
+                    'deps': sorted(set(dep.to_fname() for dep, transient in deps))
+                }
+                pending.extend(dep for dep, transient in deps)
+        return entries
 
     @returns(six.string_types)
     @params(pb=PACKAGE_SOURCE_TYPES, test=bool, test_all=bool, update=bool, track=bool)
@@ -355,7 +624,6 @@ class CarbinPrefix:
         pb = self.parse_pkg_build(pb)
         pkg_dir = self.get_package_directory(pb.to_fname())
         unlink_dir = self.get_unlink_directory(pb.to_fname())
-        install_dir = self.get_package_directory(pb.to_fname(), 'install')
         # If its been unlinked, then link it in
         if os.path.exists(unlink_dir):
             if update:
@@ -370,45 +638,228 @@ class CarbinPrefix:
                 self.remove(pb)
             else:
                 return "Package {} already installed".format(pb.to_name())
-        with self.create_builder(pb.pkg_src.get_hash(), tmp=True) as builder:
+        with self.create_install_builder(pb) as builder:
             # Fetch package
             src_dir = builder.fetch(pb.pkg_src.url, pb.hash, (pb.cmake != None), insecure=insecure)
             # Install any dependencies first
-            self.install_deps(pb, src_dir, test=test, test_all=test_all, generator=generator, insecure=insecure,
-                              ignore_requirements=pb.ignore_requirements)
-            # Setup cmake file
-            if pb.cmake:
-                target = os.path.join(src_dir, 'CMakeLists.txt')
-                if os.path.exists(target):
-                    os.rename(target, os.path.join(src_dir, builder.cmake_original_file))
-                shutil.copyfile(pb.cmake, target)
+            deps = self.install_deps(pb, src_dir, test=test, test_all=test_all, generator=generator, insecure=insecure,
+                                     ignore_requirements=pb.ignore_requirements)
+            self.install_source(builder, pb, src_dir, test=test, test_all=test_all, generator=generator, deps=deps)
+        self.write_parent(pb, track=track)
+        return "Successfully installed {}".format(pb.to_name())
+
+    def install_source(self, builder, pb, src_dir, test=False, test_all=False, generator=None, deps=None):
+        db = self.open_db()
+        install_dir = self.get_package_directory(pb.to_fname(), 'install')
+        # A package being tested is always built, so its tests run
+        key = None
+        if util.USE_ARTIFACT_CACHE and not (test or test_all):
+            key = self.get_artifact_key(pb, src_dir, generator=generator)
+            if not self.get_artifacts().has(key) and self.get_remote() is not None: self.pull_artifact(key)
+        if key and self.get_artifacts().restore(key, install_dir):
+            click.echo("Using cached build of {}".format(pb.to_name()))
+        else:
+            self.build_source(builder, pb, src_dir, install_dir, test=test, test_all=test_all, generator=generator,
+                              deps=deps)
+            if key: self.get_artifacts().store(key, install_dir, name=pb.to_name())
+        if key: util.write_to(self.get_artifact_file(pb), [key])
+        self.link_install(pb.to_fname())
+        if db:
+            db.add(pb.to_fname(), url=pb.pkg_src.url,
+                   config={'define': pb.define, 'variant': pb.variant, 'cmake': pb.cmake, 'hash': pb.hash,
+                           'artifact': key})
+
+    def build_source(self, builder, pb, src_dir, install_dir, test=False, test_all=False, generator=None,
+                     deps=None):
+        # Setup cmake file
+        if pb.cmake:
+            target = os.path.join(src_dir, 'CMakeLists.txt')
+            if os.path.exists(target):
+                os.rename(target, os.path.join(src_dir, builder.cmake_original_file))
+            shutil.copyfile(pb.cmake, target)
+        with self.reserve_mem(pb) as jobs:
+            builder.max_jobs = jobs
             # Configure and build
             builder.configure(src_dir, defines=pb.define, generator=generator, install_prefix=install_dir, test=test,
-                              variant=pb.variant)
+                              variant=pb.variant, deps=deps)
             builder.build(variant=pb.variant)
+            if builder.peak_rss: self.record_job_mem(pb, builder.peak_rss)
             # Run tests if enabled
             if test or test_all: builder.test(variant=pb.variant)
             # Install
             builder.build(target='install', variant=pb.variant)
-            if util.USE_SYMLINKS:
-                util.symlink_dir(install_dir, self.prefix)
+
+    def fetch_node(self, node, insecure=False):
+        if node.src_dir is None:
+            if node.fetching is not None:
+                node.src_dir = node.fetching.result()
             else:
-                util.copy_dir(install_dir, self.prefix)
-        self.write_parent(pb, track=track)
-        return "Successfully installed {}".format(pb.to_name())
+                pb = node.pb
+                node.src_dir = node.builder.fetch(pb.pkg_src.url, pb.hash, (pb.cmake != None), insecure=insecure)
+        return node.src_dir
+
+    def prefetch_node(self, executor, node, insecure=False):
+        if node.action == 'build' and node.src_dir is None and node.fetching is None:
+            pb = node.pb
+            node.fetching = executor.submit(node.builder.fetch, pb.pkg_src.url, pb.hash, (pb.cmake != None),
+                                            insecure=insecure, progress=False)
+
+    def has_deps_in_source(self, pb):
+        if pb.requirements or pb.ignore_requirements: return False
+        url = pb.pkg_src.url
+        return not (url.startswith('file://') and os.path.isdir(url[7:]))
+
+    def get_deps_dir(self, node, insecure=False):
+        pb = node.pb
+        if pb.requirements or pb.ignore_requirements: return None
+        # The requirements are inside the archive so it has to be fetched now
+        if self.has_deps_in_source(pb): return self.fetch_node(node, insecure=insecure)
+        return pb.pkg_src.get_src_dir()
+
+    def add_node(self, graph, stack, pb, test=False, update=False, track=True):
+        pb = self.parse_pkg_build(pb)
+        node = graph.get(pb)
+        if node is not None:
+            if node.pb.pkg_src.get_hash() != pb.pkg_src.get_hash():
+                click.echo("WARNING: Package {} is requested from different sources, using {}".format(
+                    pb.to_name(), node.pb.pkg_src.url or node.pb.pkg_src.recipe))
+            node.add_ref(pb, track=track)
+            return node, False
+        node = graph.add(PackageNode(pb, track=track, test=test, update=update))
+        if not update and os.path.exists(self.get_unlink_directory(pb.to_fname())):
+            node.action = 'link'
+        elif not update and os.path.exists(self.get_package_directory(pb.to_fname())):
+            node.action = 'skip'
+        else:
+            node.builder = stack.enter_context(self.create_install_builder(pb))
+        return node, True
+
+    # Nodes are added a level at a time so the sources of siblings are
+    # downloaded together before their own requirements are read
+    def resolve_nodes(self, graph, stack, executor, nodes, test_all=False, insecure=False, prefetch=False):
+        for node in nodes:
+            if prefetch or self.has_deps_in_source(node.pb): self.prefetch_node(executor, node, insecure=insecure)
+        for node in nodes:
+            if node.action != 'build': continue
+            pb = node.pb
+            children = []
+            for dependent, transient in self.deps_of(pb, self.get_deps_dir(node, insecure=insecure), test=node.test,
+                                                     test_all=test_all, ignore_requirements=pb.ignore_requirements):
+                child, new = self.add_node(graph, stack, dependent, track=not transient)
+                node.add_dep(child)
+                if new: children.append(child)
+            self.resolve_nodes(graph, stack, executor, children, test_all=test_all, insecure=insecure,
+                               prefetch=prefetch)
+
+    @contextlib.contextmanager
+    def resolve(self, pbs, test=False, test_all=False, update=False, insecure=False, prefetch=False,
+                fetch_jobs=None):
+        from concurrent import futures
+        with contextlib.ExitStack() as stack:
+            graph = PackageGraph()
+            executor = futures.ThreadPoolExecutor(max_workers=fetch_jobs or util.FETCH_JOBS)
+            try:
+                roots = []
+                for pb in pbs:
+                    node, new = self.add_node(graph, stack, pb, test=test, update=update)
+                    if new: roots.append(node)
+                self.resolve_nodes(graph, stack, executor, roots, test_all=test_all, insecure=insecure,
+                                   prefetch=prefetch)
+                yield graph
+            finally:
+                # Don't start any more downloads, but let running ones finish before the builders are removed
+                for node in graph:
+                    if node.fetching is not None: node.fetching.cancel()
+                executor.shutdown(wait=True)
+
+    def install_node(self, node, test_all=False, generator=None, insecure=False):
+        pb = node.pb
+        if node.action == 'link':
+            self.link(pb)
+            msg = "Linking package {}"
+        elif node.action == 'skip':
+            msg = "Package {} already installed"
+        else:
+            if node.update:
+                util.delete_dir(self.get_unlink_directory(pb.to_fname()))
+                if os.path.exists(self.get_package_directory(pb.to_fname())): self.remove(pb)
+            try:
+                src_dir = self.fetch_node(node, insecure=insecure)
+                self.install_source(node.builder, pb, src_dir, test=node.test, test_all=test_all,
+                                    generator=generator, deps=node.deps)
+            except:
+                self.remove(pb)
+                raise
+            msg = "Successfully installed {}"
+        # The parents are only recorded under the package that was installed
+        for ref, track in node.refs:
+            self.write_parent(ref, track=track, fname=node.key)
+        return msg.format(pb.to_name())
+
+    def install_all(self, pbs, jobs=None, test=False, test_all=False, generator=None, update=False, insecure=False,
+                    fetch_jobs=None):
+        with self.resolve(pbs, test=test, test_all=test_all, update=update, insecure=insecure, prefetch=True,
+                          fetch_jobs=fetch_jobs) as graph:
+            from carbin.scheduler import Scheduler
+            scheduler = Scheduler(jobs)
+            for node in graph.sorted():
+                scheduler.add(node.key, functools.partial(self.install_node, node, test_all=test_all,
+                                                          generator=generator, insecure=insecure), node.deps)
+            for key, msg in scheduler.run():
+                yield msg
 
     @returns(six.string_types)
     @params(pb=PACKAGE_SOURCE_TYPES)
     def ignore(self, pb):
         pb = self.parse_pkg_build(pb)
         pkg_dir = self.get_package_directory(pb.to_fname())
+        db = self.open_db()
         # If package doesn't exist
         if not os.path.exists(pkg_dir):
             util.mkfile(pkg_dir, "ignore", "ignore")
+            if db: db.add(pb.to_fname(), url=pb.pkg_src.url, config={'ignore': True})
             return "Ignore package {}".format(pb.to_name())
         else:
             return "Package {} already installed".format(pb.to_name())
 
+    # Everything that decides how a build directory is configured
+    # Every dependency as it was parsed, so changes to included deps files and
+    # to the recipes they name are seen too
+    def get_requirements_key(self, pb, src_dir, test=False):
+        digest = lambda f: f and os.path.exists(f) and util.hash_file(f, 'sha256')
+        result = []
+        for dependent, transient in self.deps_of(pb, src_dir, test=test):
+            result.append({
+                'fname': dependent.to_fname(),
+                'url': dependent.pkg_src.url,
+                'hash': dependent.hash,
+                'define': dependent.define,
+                'cmake': digest(dependent.cmake),
+                'requirements': digest(dependent.requirements),
+                'transient': transient
+            })
+        return result
+
+    def get_build_fingerprint(self, pb, src_dir, generator=None, test=False):
+        import carbin.artifacts as artifacts
+        return artifacts.get_key(
+            requirements=self.get_requirements_key(pb, src_dir, test=test),
+            cmake=pb.cmake and util.hash_file(pb.cmake, 'sha256'),
+            define=pb.define,
+            variant=pb.variant,
+            generator=generator,
+            test=test,
+            toolchain=open(self.get_toolchain()).read()
+        )
+
+    # The dependencies are checked again only when the fingerprint changes or
+    # one of them has been removed from the prefix
+    def is_fingerprint_current(self, builder, fingerprint):
+        if not builder.exists or not os.path.exists(builder.get_build_path('CMakeCache.txt')): return False
+        last = util.read_json(builder.get_path('fingerprint.json'))
+        if not last or last.get('key') != fingerprint: return False
+        return all(os.path.exists(self.get_package_directory(dep)) for dep in last.get('deps', []))
+
     @params(pb=PACKAGE_SOURCE_TYPES, test=bool)
     def build(self, pb, test=False, target=None, generator=None):
         pb = self.parse_pkg_build(pb)
@@ -418,11 +869,33 @@ class CarbinPrefix:
         elif os.path.exists(os.path.join(src_dir, 'carbin_deps.txt')):
             pb.requirements = os.path.join(src_dir, 'carbin_deps.txt')
         with self.create_builder(pb.to_fname()) as builder:
-            # Install any dependencies first
-            self.install_deps(pb, src_dir, generator=generator, test=test)
-            # Configure and build
-            if not builder.exists: builder.configure(src_dir, defines=pb.define, generator=generator, test=test,
-                                                     variant=pb.variant)
+            fingerprint = self.get_build_fingerprint(pb, src_dir, generator=generator, test=test)
+            if not self.is_fingerprint_current(builder, fingerprint):
+                self.log("build: fingerprint changed, configuring")
+                last = util.read_json(builder.get_path('fingerprint.json')) or {}
+                util.delete_file(builder.get_path('fingerprint.json'))
+                # Install any dependencies first
+                deps = self.install_deps(pb, src_dir, generator=generator, test=test)
+                # The cache is kept, with any changes made by build --configure,
+                # and the defines are passed over it. It is only started again
+                # when a define was removed, since cmake would keep its value,
+                # or when the generator changed, since cmake can't switch it.
+                current_generator = generator or builder.get_cached_generator()
+                removed = [d for d in last.get('define', []) if d not in pb.define]
+                if last.get('generator') != generator:
+                    if last: click.echo("WARNING: The generator changed, removing the build directory {}".format(
+                        builder.build_dir))
+                    util.delete_dir(builder.build_dir)
+                    current_generator = generator
+                elif removed and os.path.exists(builder.get_build_path('CMakeCache.txt')):
+                    click.echo("WARNING: Removing the cmake cache since these defines were removed: {}".format(
+                        ' '.join(removed)))
+                    util.delete_file(builder.get_build_path('CMakeCache.txt'))
+                builder.configure(src_dir, defines=pb.define, generator=current_generator, test=test,
+                                  variant=pb.variant, deps=deps)
+                util.write_to(builder.get_path('fingerprint.json'), [json.dumps({
+                    'key': fingerprint, 'generator': generator, 'define': pb.define, 'deps': deps
+                })])
             builder.build(variant=pb.variant, target=target)
             # Run tests if enabled
             if test: builder.test(variant=pb.variant)
@@ -447,6 +920,51 @@ class CarbinPrefix:
         elif 'cmake-gui' in self.cmd:
             self.cmd.cmake_gui([src_dir], cwd=self.build_path(pb))
 
+    def get_manifest_file(self, fname):
+        return self.get_package_directory(fname, 'manifest.txt')
+
+    # The manifest starts with the mode the paths were placed with, so they
+    # are removed the same way even when CARBIN_INSTALL_MODE has changed since
+    def write_manifest(self, fname, mode, paths):
+        with open(self.get_manifest_file(fname), 'w') as f:
+            f.write(MANIFEST_MODE + mode + '\n')
+            f.writelines(path + '\n' for path in paths)
+
+    def read_manifest(self, fname):
+        mode = util.INSTALL_MODE
+        paths = []
+        for line in open(self.get_manifest_file(fname)):
+            line = line.rstrip('\n')
+            if not paths and line.startswith(MANIFEST_MODE): mode = line[len(MANIFEST_MODE):]
+            elif line.strip(): paths.append(line)
+        return mode, paths
+
+    # Places the installed tree into the prefix, recording every path so it
+    # can be removed without scanning the prefix
+    def link_install(self, fname):
+        install_dir = self.get_package_directory(fname, 'install')
+        if util.INSTALL_MODE not in util.INSTALL_MODES:
+            raise util.BuildError("Unknown install mode: {}".format(util.INSTALL_MODE))
+        if util.INSTALL_MODE == 'symlink': paths = util.symlink_dir(install_dir, self.prefix)
+        else: paths = util.copy_dir(install_dir, self.prefix, mode=util.INSTALL_MODE)
+        self.write_manifest(fname, util.INSTALL_MODE, paths)
+        if self.recipes: self.recipes.reset()
+
+    def unlink_install(self, fname):
+        install_dir = self.get_package_directory(fname, 'install')
+        manifest = self.get_manifest_file(fname)
+        if os.path.exists(manifest):
+            mode, paths = self.read_manifest(fname)
+            util.rm_manifest(self.prefix, paths, src=install_dir, links=mode == 'symlink')
+        # Installed before manifests were written
+        elif util.INSTALL_MODE == 'symlink':
+            util.rm_symlink_from(install_dir, self.prefix)
+            util.rm_empty_dirs(self.prefix)
+        else:
+            util.rm_dup_dir(install_dir, self.prefix, remove_both=False)
+            util.rm_empty_dirs(self.prefix)
+        if self.recipes: self.recipes.reset()
+
     @params(pkg=PACKAGE_SOURCE_TYPES)
     def remove(self, pkg):
         self.unlink(pkg, delete=True)
@@ -457,38 +975,43 @@ class CarbinPrefix:
         pkg_dir = self.get_package_directory(pkg.to_fname())
         unlink_dir = self.get_unlink_directory(pkg.to_fname())
         self.log("Unlink:", pkg_dir)
+        db = self.open_db()
         if os.path.exists(pkg_dir):
-            if util.USE_SYMLINKS:
-                util.rm_symlink_from(os.path.join(pkg_dir, 'install'), self.prefix)
-            else:
-                util.rm_dup_dir(os.path.join(pkg_dir, 'install'), self.prefix, remove_both=False)
-            util.rm_empty_dirs(self.prefix)
+            self.unlink_install(pkg.to_fname())
+            # What was found in the package's files may no longer be there
+            if os.path.exists(self.get_private_path('configure-cache')):
+                import carbin.configure_cache as configure_cache
+                configure_cache.remove_package(self.get_private_path('configure-cache'), pkg.to_fname())
             if delete:
                 util.delete_dir(pkg_dir)
+                if db: db.remove(pkg.to_fname())
             else:
                 util.mkdir(self.get_unlink_directory())
                 os.rename(pkg_dir, unlink_dir)
+                if db: db.set_linked(pkg.to_fname(), False)
 
     @params(pkg=PACKAGE_SOURCE_TYPES)
     def link(self, pkg):
         pkg = self.parse_pkg_src(pkg)
         pkg_dir = self.get_package_directory(pkg.to_fname())
         unlink_dir = self.get_unlink_directory(pkg.to_fname())
+        db = self.open_db()
         if os.path.exists(unlink_dir):
             util.mkdir(self.get_package_directory())
             os.rename(unlink_dir, pkg_dir)
-            if util.USE_SYMLINKS:
-                util.symlink_dir(os.path.join(pkg_dir, 'install'), self.prefix)
-            else:
-                util.copy_dir(os.path.join(pkg_dir, 'install'), self.prefix)
+            self.link_install(pkg.to_fname())
+            if db: db.set_linked(pkg.to_fname(), True)
         # Relink dependencies
+        if db:
+            for dep in db.unlinked_dependencies(pkg.to_fname()): self.link(fname_to_pkg(dep))
+            return
         for dep in util.ls(self.get_unlink_directory(), os.path.isdir):
             ls = util.ls(self.get_unlink_deps_directory(dep), os.path.isfile)
             if pkg.to_fname() in ls: self.link(dep)
 
     def _list_files(self, pkg=None, top=True):
         if pkg is None:
-            return util.ls(self.get_package_directory(), os.path.isdir)
+            return sorted(util.ls(self.get_package_directory(), os.path.isdir))
         else:
             p = self.parse_pkg_src(pkg)
             ls = util.ls(self.get_deps_directory(p.to_fname()), os.path.isfile)
@@ -498,6 +1021,14 @@ class CarbinPrefix:
                 return ls
 
     def list(self, pkg=None, recursive=False, top=True):
+        # A prefix without an up to date database is listed from its
+        # directories, since listing never changes the prefix
+        db = self.get_db()
+        if db and db.open_read_only():
+            if pkg is None: fnames = db.packages()
+            else: fnames = db.dependents(self.parse_pkg_src(pkg).to_fname(), recursive=recursive, top=top)
+            for fname in fnames: yield fname_to_pkg(fname)
+            return
         for d in self._list_files(pkg, top):
             p = fname_to_pkg(d)
             if os.path.exists(self.get_package_directory(d)): yield p
@@ -506,13 +1037,21 @@ class CarbinPrefix:
                     yield child
 
     def clean(self):
-        if util.USE_SYMLINKS:
+        if self.db: self.db.close()
+        fnames = [fname for fname in self._list_files()
+                  if os.path.exists(self.get_package_directory(fname, 'install'))]
+        if all(os.path.exists(self.get_manifest_file(fname)) for fname in fnames):
+            for fname in fnames: self.unlink_install(fname)
+            util.delete_dir(self.get_private_path())
+            if os.path.isdir(self.prefix) and not os.listdir(self.prefix): os.rmdir(self.prefix)
+        elif util.INSTALL_MODE == 'symlink':
             util.delete_dir(self.get_private_path())
             util.rm_symlink_dir(self.prefix)
             util.rm_empty_dirs(self.prefix)
         else:
             for p in self.list():
                 self.remove(p)
+            if self.db: self.db.close()
             util.delete_dir(self.get_private_path())
 
     def clean_cache(self):
@@ -0,0 +1,76 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os, threading
+
+
+def get_key(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+# Every directory with a package.txt under the roots, by its path relative to
+# the root. A recipe in an earlier root hides the one with the same name in
+# later roots. Links are followed, so a recipe can be an alias of another,
+# but not into a directory the walk is already inside of, which would loop
+# forever.
+def get_id(path):
+    st = os.stat(path)
+    return st.st_dev, st.st_ino
+
+
+def scan(roots):
+    recipes = {}
+    for root in roots:
+        if not os.path.isdir(root): continue
+        parents = {root: frozenset([get_id(root)])}
+        for d, dirs, files in os.walk(root, followlinks=True):
+            if 'package.txt' in files: recipes.setdefault(get_key(os.path.relpath(d, root)), d)
+            for name in list(dirs):
+                child = os.path.join(d, name)
+                key = get_id(child)
+                if key in parents[d]: dirs.remove(name)
+                else: parents[child] = parents[d] | {key}
+    return recipes
+
+
+# The recipes are found with one walk of the roots the first time one is
+# looked up, and each recipe's package is only parsed once. Installing or
+# removing a package can change the recipes, so the prefix resets the index
+# whenever it does.
+class RecipeIndex:
+    def __init__(self, roots):
+        self.roots = roots
+        self.recipes = None
+        self.packages = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.recipes = None
+            self.packages = {}
+
+    def find(self, name):
+        with self.lock:
+            if self.recipes is None: self.recipes = scan(self.roots)
+            return self.recipes.get(get_key(name))
+
+    def get_package(self, recipe, load):
+        with self.lock:
+            pb = self.packages.get(recipe)
+        if pb is None:
+            pb = load(recipe)
+            with self.lock:
+                self.packages[recipe] = pb
+        return pb.clone()
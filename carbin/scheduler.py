@@ -0,0 +1,61 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import collections
+from concurrent import futures
+
+import carbin.util as util
+
+
+class Scheduler:
+    def __init__(self, jobs=None):
+        self.jobs = max(1, jobs or util.cpu_count())
+        self.tasks = collections.OrderedDict()
+        self.deps = {}
+
+    def add(self, key, f, deps=None):
+        self.tasks[key] = f
+        self.deps[key] = set(deps or [])
+
+    def ready(self, pending, done):
+        return [key for key in pending if self.deps[key] <= done]
+
+    # Runs every task once all of its dependencies have finished, yielding
+    # (key, result) pairs in completion order. After a failure no new task is
+    # started, the running ones are drained and the first error is raised.
+    def run(self):
+        pending = collections.OrderedDict(self.tasks)
+        running = {}
+        done = set()
+        error = None
+        with futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while running or (pending and error is None):
+                if error is None:
+                    for key in self.ready(pending, done)[:self.jobs - len(running)]:
+                        running[executor.submit(pending.pop(key))] = key
+                if not running:
+                    error = util.BuildError("Circular dependency between: " + ', '.join(pending))
+                    break
+                finished, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if error is None: error = e
+                        continue
+                    done.add(key)
+                    yield key, result
+        if error is not None: raise error
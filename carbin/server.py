@@ -0,0 +1,73 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os, tempfile, threading
+
+from six.moves import BaseHTTPServer, SimpleHTTPServer, socketserver
+
+import carbin.util as util
+
+
+class CacheRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        p = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.server.root, os.path.relpath(p, os.getcwd()))
+
+    def do_PUT(self):
+        p = self.translate_path(self.path)
+        if os.path.relpath(p, self.server.root).startswith(os.pardir):
+            self.send_error(403)
+            return
+        util.mkdir(os.path.dirname(p))
+        length = int(self.headers.get('Content-Length', 0))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(p), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while length > 0:
+                    data = self.rfile.read(min(length, 1 << 16))
+                    if not data: break
+                    f.write(data)
+                    length -= len(data)
+            # A client that went away early never replaces the stored file
+            if length != 0:
+                os.remove(tmp)
+                self.send_error(400)
+                return
+            os.rename(tmp, p)
+        except:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class CacheServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, host='', port=0):
+        self.root = os.path.abspath(root)
+        util.mkdir(self.root)
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), CacheRequestHandler)
+
+    def get_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{0}:{1}'.format(host if host not in ('', '0.0.0.0') else 'localhost', port)
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return t
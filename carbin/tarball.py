@@ -0,0 +1,205 @@
+#
+# Copyright 2023 The Turbo Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os, shutil, tarfile, importlib, threading, contextlib, subprocess
+from concurrent import futures
+
+import carbin.util as util
+
+# Each codec with the suffixes it is used for, and the tools that can
+# decompress it on more than one thread. These run as a separate process, so
+# even a single threaded tool decompresses while files are being written.
+CODECS = [
+    ('gz', ['.tar.gz', '.tgz'], [['pigz', '-dc']]),
+    ('bz2', ['.tar.bz2', '.tbz2'], [['lbzip2', '-dc'], ['pbzip2', '-dc']]),
+    ('xz', ['.tar.xz', '.txz'], [['xz', '-dc', '-T0']]),
+    ('zst', ['.tar.zst', '.tzst'], [['zstd', '-dc', '-q']]),
+    ('', ['.tar'], [])
+]
+
+# Files up to this size are read into memory and written by the pool, larger
+# ones are copied from the stream directly
+MAX_BUFFERED = 1 << 20
+
+
+def get_codec(name):
+    for codec, suffixes, tools in CODECS:
+        if any(name.endswith(suffix) for suffix in suffixes): return codec
+    return None
+
+
+def get_tool(codec):
+    for codec_, suffixes, tools in CODECS:
+        if codec_ != codec: continue
+        for tool in tools:
+            exe = util.which(tool[0], throws=False)
+            if exe: return [exe] + tool[1:]
+    return None
+
+
+# The modules tarfile needs for a codec, which may not be built with python
+PYTHON_CODECS = {'zst': 'zstandard', 'xz': 'lzma', 'bz2': 'bz2'}
+
+
+def has_python_codec(codec):
+    module = PYTHON_CODECS.get(codec)
+    if module is None: return True
+    try:
+        importlib.import_module(module)
+    except ImportError:
+        return False
+    return True
+
+
+def is_supported(name):
+    codec = get_codec(name)
+    if codec is None: return False
+    return has_python_codec(codec) or get_tool(codec) is not None
+
+
+def copy_stream(src, dst):
+    try:
+        for chunk in util.read_chunks(src): dst.write(chunk)
+    except (IOError, OSError):
+        # The decompressor exited early, its status reports why
+        pass
+    finally:
+        dst.close()
+
+
+# Yields the decompressed tar stream, and the mode tarfile should read it with
+@contextlib.contextmanager
+def decompress(fileobj, codec, jobs):
+    tool = get_tool(codec) if jobs > 1 else None
+    if tool is None and codec == 'zst' and not has_python_codec(codec): tool = get_tool(codec)
+    if tool:
+        p = subprocess.Popen(tool, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        feeder = threading.Thread(target=copy_stream, args=(fileobj, p.stdin))
+        feeder.daemon = True
+        feeder.start()
+        try:
+            yield p.stdout, 'r|'
+            # Drain the padding after the tarball so the tool can exit
+            for chunk in util.read_chunks(p.stdout): pass
+        except:
+            p.stdout.close()
+            feeder.join()
+            p.wait()
+            raise
+        p.stdout.close()
+        feeder.join()
+        if p.wait() != 0: raise util.BuildError("Failed to decompress with: {0}".format(tool[0]))
+    elif codec == 'zst':
+        if not has_python_codec(codec): raise util.BuildError("Extracting .tar.zst requires zstd or zstandard")
+        import zstandard
+        with zstandard.ZstdDecompressor().stream_reader(fileobj) as reader:
+            yield reader, 'r|'
+    else:
+        yield fileobj, 'r|' + codec
+
+
+def get_member_path(dst, member):
+    path = os.path.normpath(os.path.join(dst, member.name))
+    # An archive made with `tar -C dir .` has dst itself as its first member
+    if os.path.isabs(member.name) or (path != dst and not path.startswith(os.path.join(dst, ''))):
+        raise util.BuildError("Archive member outside of destination: {0}".format(member.name))
+    return path
+
+
+def set_attrs(path, member):
+    os.chmod(path, member.mode & 0o7777)
+    os.utime(path, (member.mtime, member.mtime))
+
+
+def write_file(path, data, member):
+    with open(path, 'wb') as f: f.write(data)
+    set_attrs(path, member)
+
+
+def remove_link(path):
+    if os.path.islink(path): os.remove(path)
+
+
+# Reads the members in order on this thread, which is what a compressed
+# stream requires, while a pool of threads creates and writes the files.
+# Links are made once every file exists, and directory attributes are set
+# last since writing into a directory changes its mtime.
+def extract_tar(tar, dst, jobs):
+    dst = os.path.abspath(dst)
+    util.mkdir(dst)
+    # Only look for links to replace when extracting over existing files
+    fresh = not os.listdir(dst)
+    made = set([dst])
+    dirs = []
+    links = []
+
+    def mkdirs(d):
+        if d in made: return
+        util.mkdir(d)
+        made.add(d)
+
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+        for member in tar:
+            path = get_member_path(dst, member)
+            if member.isdir():
+                mkdirs(path)
+                dirs.append((path, member))
+            elif member.issym() or member.islnk():
+                mkdirs(os.path.dirname(path))
+                links.append((path, member))
+            elif member.isreg():
+                mkdirs(os.path.dirname(path))
+                if not fresh: remove_link(path)
+                f = tar.extractfile(member)
+                if member.size > MAX_BUFFERED:
+                    with open(path, 'wb') as out: shutil.copyfileobj(f, out)
+                    set_attrs(path, member)
+                    continue
+                pending.add(pool.submit(write_file, path, f.read(), member))
+                # Bound the memory held by files waiting to be written
+                if len(pending) >= jobs * 16:
+                    done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    for x in done: x.result()
+        for x in futures.as_completed(pending): x.result()
+    for path, member in links:
+        if os.path.lexists(path): os.remove(path)
+        if member.issym():
+            os.symlink(member.linkname, path)
+        else:
+            target = get_member_path(dst, tarfile.TarInfo(member.linkname))
+            try:
+                os.link(target, path)
+            except OSError:
+                shutil.copy2(target, path)
+    for path, member in reversed(dirs):
+        set_attrs(path, member)
+
+
+def extract_stream(fileobj, name, dst, jobs=None):
+    jobs = jobs or util.EXTRACT_JOBS
+    with decompress(fileobj, get_codec(name) or '*', jobs) as (stream, mode):
+        with tarfile.open(fileobj=stream, mode=mode) as tar:
+            extract_tar(tar, dst, jobs)
+
+
+def extract(archive, dst, jobs=None):
+    jobs = jobs or util.EXTRACT_JOBS
+    if get_codec(archive) is None:
+        with tarfile.open(archive) as tar:
+            extract_tar(tar, dst, jobs)
+    else:
+        with open(archive, 'rb') as f:
+            extract_stream(f, archive, dst, jobs)
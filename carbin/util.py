@@ -13,33 +13,49 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import click, os, sys, shutil, json, six, hashlib, ssl
+import click, os, re, sys, shutil, json, six, hashlib, contextlib, tempfile, filecmp
+import tarfile, zipfile, subprocess
 
-if sys.version_info[0] < 3:
-    try:
-        import contextlib
-        import lzma
-    except:
-        try:
-            from backports import lzma
-        except:
-            pass
-import tarfile, zipfile
-
-if os.name == 'posix' and sys.version_info[0] < 3:
-    import subprocess32 as subprocess
-else:
-    import subprocess
+from six.moves.urllib import error, parse, request
 
-from six.moves.urllib import request
+def cpu_count():
+    return os.cpu_count() or 1
 
 def to_bool(value):
     x = str(value).lower()
     if x in ("no",  "n", "false", "f", "0", "0.0", "", "none", "[]", "{}"): return False
     return True
 
+def parse_size(value):
+    if value is None or value == '': return None
+    x = str(value).strip().upper().rstrip('IB')
+    units = 'KMGT'
+    if x and x[-1] in units: return int(float(x[:-1]) * 1024 ** (units.index(x[-1]) + 1))
+    return int(x)
+
 USE_SYMLINKS=to_bool(os.environ.get('CARBIN_USE_SYMLINKS', (os.name == 'posix')))
+INSTALL_MODES=['symlink', 'hardlink', 'reflink', 'copy']
+INSTALL_MODE=os.environ.get('CARBIN_INSTALL_MODE', 'symlink' if USE_SYMLINKS else 'copy').lower()
 USE_CMAKE_TAR=to_bool(os.environ.get('CARBIN_USE_CMAKE_TAR', True))
+EXTRACT_JOBS=int(os.environ.get('CARBIN_EXTRACT_JOBS', 0)) or cpu_count()
+FETCH_JOBS=int(os.environ.get('CARBIN_FETCH_JOBS', 4))
+# Linking and copying wait on the filesystem more than the cpu
+LINK_JOBS=int(os.environ.get('CARBIN_LINK_JOBS', 0)) or min(32, cpu_count() * 4)
+BUILD_JOBS=int(os.environ.get('CARBIN_BUILD_JOBS', 0)) or cpu_count()
+MAX_MEM=parse_size(os.environ.get('CARBIN_MAX_MEM'))
+# Memory assumed for one compile job of a package that hasn't been built yet
+JOB_MEM=parse_size(os.environ.get('CARBIN_JOB_MEM', '1G'))
+USE_ARTIFACT_CACHE=to_bool(os.environ.get('CARBIN_USE_ARTIFACT_CACHE', True))
+ARTIFACT_CACHE=os.environ.get('CARBIN_ARTIFACT_CACHE')
+ARTIFACT_CACHE_SIZE=parse_size(os.environ.get('CARBIN_ARTIFACT_CACHE_SIZE', '10G'))
+REMOTE_CACHE=os.environ.get('CARBIN_REMOTE_CACHE')
+USE_DOWNLOAD_CACHE=to_bool(os.environ.get('CARBIN_USE_DOWNLOAD_CACHE', True))
+USE_STREAM_EXTRACT=to_bool(os.environ.get('CARBIN_USE_STREAM_EXTRACT', True))
+KEEP_BUILDS=to_bool(os.environ.get('CARBIN_KEEP_BUILDS', False))
+BUILD_TREES_SIZE=parse_size(os.environ.get('CARBIN_BUILD_TREES_SIZE', '10G'))
+USE_NINJA=to_bool(os.environ.get('CARBIN_USE_NINJA', (os.name == 'posix')))
+USE_CONFIGURE_CACHE=to_bool(os.environ.get('CARBIN_USE_CONFIGURE_CACHE', True))
+RECIPE_PATH=[p for p in os.environ.get('CARBIN_RECIPE_PATH', '').split(os.pathsep) if p]
 
 __CARBIN_DIR__ = os.path.dirname(os.path.realpath(__file__))
 
@@ -92,7 +108,12 @@ def write_to(file, lines):
             f.writelines(content)
 
 def mkdir(p):
-    if not os.path.exists(p): os.makedirs(p)
+    if not os.path.exists(p):
+        try:
+            os.makedirs(p)
+        except OSError:
+            # Another worker may have created it concurrently
+            if not os.path.isdir(p): raise
     return p
 
 def mkfile(d, file, content, always_write=True):
@@ -120,46 +141,160 @@ def adjust_path(p):
         return "\\\\?\\" + p
     return p
 
-def add_cache_file(key, f):
+def add_cache_file(key, f, digests=None):
     mkdir(get_cache_path(key))
-    shutil.copy2(f, get_cache_path(key, os.path.basename(f)))
+    target = get_cache_path(key, os.path.basename(f))
+    shutil.copy2(f, target + '.tmp')
+    os.rename(target + '.tmp', target)
+    if digests: write_digests(target, digests)
 
 def get_cache_file(key):
     p = get_cache_path(key)
-    if os.path.exists(p):
-        return os.path.join(p, next(ls(p)))
-    else:
-        return None
+    # Skip the digests and any partial copy
+    f = next(iter(ls(p, lambda x: not os.path.basename(x).startswith('.') and not x.endswith('.tmp'))), None)
+    if f: return os.path.join(p, f)
+    return None
+
+# The digests of a cached file are kept next to it, along with its size and
+# mtime so they are only trusted while the file is unchanged
+def get_digests_file(f):
+    return os.path.join(os.path.dirname(f), '.' + os.path.basename(f) + '.digests')
+
+def write_digests(f, digests):
+    st = os.stat(f)
+    with open(get_digests_file(f), 'w') as fp:
+        json.dump(merge(digests, {'size': st.st_size, 'mtime': st.st_mtime}), fp)
+
+def get_digest(f, t):
+    digests = read_json(get_digests_file(f)) or {}
+    st = os.stat(f)
+    if digests.get(t) and digests.get('size') == st.st_size and digests.get('mtime') == st.st_mtime:
+        return digests[t]
+    return hash_file(f, t)
 
 def delete_dir(path):
     if path is not None and os.path.exists(path): shutil.rmtree(adjust_path(path))
 
-def symlink_dir(src, dst):
-    for root, dirs, files in os.walk(src):
-        all_files = (
-            file
-            for x in [dirs, files]
-            for file in x
-            if os.path.islink(os.path.join(root, file)) or os.path.isfile(os.path.join(root, file))
-        )
-        for file in all_files:
-            path = os.path.relpath(root, src)
-            d = os.path.join(dst, path)
-            mkdir(d)
-            relpath = os.path.relpath(os.path.join(root, file), d)
-            try:
-                os.symlink(relpath, os.path.join(d, file))
-            except:
-                raise BuildError("Failed to link: {} -> {}".format(os.path.join(root, file), os.path.join(d, file)))
-
-def copy_dir(src, dst):
+def delete_file(path):
+    if path is not None and os.path.exists(path): os.remove(path)
+
+def get_dir_size(d):
+    size = 0
+    for root, dirs, files in os.walk(d):
+        for name in files:
+            f = os.path.join(root, name)
+            if not os.path.islink(f): size = size + os.path.getsize(f)
+    return size
+
+def is_same_file(src, dst):
+    if os.path.islink(src) or os.path.islink(dst) or not os.path.isfile(dst): return False
+    if os.path.getsize(src) != os.path.getsize(dst): return False
+    return filecmp.cmp(src, dst, shallow=False)
+
+# Moves the files of src into dst, removing what is no longer in src. Files
+# whose content didn't change are left alone, so their timestamps don't
+# cause them to be rebuilt.
+def sync_dir(src, dst):
+    for root, dirs, files in os.walk(dst, topdown=False):
+        for name in files + dirs:
+            p = os.path.join(root, name)
+            s = os.path.join(src, os.path.relpath(p, dst))
+            if os.path.islink(p) or os.path.isfile(p):
+                if not os.path.lexists(s) or os.path.isdir(s) and not os.path.islink(s): os.remove(p)
+            elif not os.path.isdir(s) or os.path.islink(s): shutil.rmtree(p)
     for root, dirs, files in os.walk(src):
-        for file in files:
-            path = os.path.relpath(root, src)
-            d = os.path.join(dst, path)
-            mkdir(d)
-            src_file = os.path.join(root, file)
-            shutil.copy2(adjust_path(src_file), os.path.join(d, file))
+        d = os.path.join(dst, os.path.relpath(root, src))
+        mkdir(d)
+        for name in files + [x for x in dirs if os.path.islink(os.path.join(root, x))]:
+            s = os.path.join(root, name)
+            if is_same_file(s, os.path.join(d, name)): continue
+            if os.path.lexists(os.path.join(d, name)): os.remove(os.path.join(d, name))
+            os.rename(s, os.path.join(d, name))
+
+# Lists the files of a tree relative to it, using the types scandir already
+# read instead of a stat per entry. With links, the links to directories are
+# included as well.
+def scan_tree(src, links=False):
+    files = []
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        for entry in os.scandir(os.path.join(src, rel)):
+            path = os.path.join(rel, entry.name)
+            if entry.is_symlink():
+                if links or entry.is_file(): files.append(path)
+            elif entry.is_dir():
+                stack.append(path)
+            elif entry.is_file():
+                files.append(path)
+    return files
+
+# Creates the directories of the files once, and then runs f on each file
+# from a pool of threads
+def map_tree(f, files, dst, jobs=None):
+    for d in sorted(set(os.path.dirname(path) for path in files)): mkdir(os.path.join(dst, d))
+    jobs = jobs or LINK_JOBS
+    if jobs <= 1 or len(files) < 64:
+        for path in files: f(path)
+        return
+    from concurrent import futures
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for x in pool.map(f, files): pass
+
+# Returns the paths placed in dst, relative to it
+def symlink_dir(src, dst, jobs=None):
+    # Each link climbs out of its directories and then follows the same
+    # relative path from dst to src
+    base = os.path.relpath(src, dst)
+    def link(path):
+        target = os.path.join(dst, path)
+        relpath = os.path.join(*([os.pardir] * path.count(os.sep) + [base, path]))
+        try:
+            os.symlink(relpath, target)
+        except:
+            raise BuildError("Failed to link: {} -> {}".format(os.path.join(src, path), target))
+    files = scan_tree(src, links=True)
+    map_tree(link, files, dst, jobs)
+    return files
+
+# Linux's ioctl to share the extents of a file on btrfs, xfs and others
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+# Places src at dst, falling back from a hardlink to a clone to a copy, and
+# returns the mode that worked so the rest of the tree doesn't retry the ones
+# the filesystem doesn't support
+def install_file(src, dst, mode='copy'):
+    if mode in ['hardlink', 'reflink'] and os.path.lexists(dst): os.remove(dst)
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return mode
+        except OSError:
+            mode = 'reflink'
+    if mode == 'reflink':
+        try:
+            reflink(src, dst)
+            return mode
+        except (ImportError, IOError, OSError):
+            mode = 'copy'
+    shutil.copy2(src, dst)
+    return mode
+
+def copy_dir(src, dst, mode='copy', jobs=None):
+    files = scan_tree(src)
+    if not files: return files
+    # The first file finds the mode the filesystem supports
+    mkdir(os.path.dirname(os.path.join(dst, files[0])))
+    mode = install_file(adjust_path(os.path.join(src, files[0])), os.path.join(dst, files[0]), mode)
+    map_tree(lambda path: install_file(adjust_path(os.path.join(src, path)), os.path.join(dst, path), mode),
+             files[1:], dst, jobs)
+    return files
 
 def readlink(file):
     f = os.readlink(file)
@@ -210,6 +345,36 @@ def rm_empty_dirs(d):
     if not has_files: os.rmdir(d)
     return has_files
 
+# Removes the paths listed in a manifest from prefix, and then the directories
+# they leave empty. With src, only the paths that are still the package's are
+# removed, so a file another package has since placed at the same path is
+# kept: the links into src, or with links=False the files with the size and
+# mtime of the one in src, which copying and hardlinking keep.
+def rm_manifest(prefix, paths, src=None, links=True):
+    parents = set()
+    for path in paths:
+        if os.path.isabs(path) or path.split(os.sep)[0] == '..':
+            raise BuildError('Trying to remove link outside of prefix directory: ' + path)
+        p = os.path.join(prefix, path)
+        if src is not None and links:
+            if not os.path.islink(p) or not readlink(p).startswith(os.path.join(src, '')): continue
+        elif not os.path.lexists(p): continue
+        elif src is not None and os.path.exists(os.path.join(src, path)):
+            placed, installed = os.lstat(p), os.stat(os.path.join(src, path))
+            if (placed.st_size, placed.st_mtime_ns) != (installed.st_size, installed.st_mtime_ns): continue
+        os.remove(p)
+        parents.add(os.path.dirname(p))
+    rm_empty_parents(parents, prefix)
+
+def rm_empty_parents(dirs, top):
+    top = os.path.normpath(top)
+    # Deepest first, so a parent is only checked once its children are gone
+    for d in sorted(dirs, key=lambda x: x.count(os.sep), reverse=True):
+        d = os.path.normpath(d)
+        while d.startswith(os.path.join(top, '')) and os.path.isdir(d) and not os.path.islink(d) and not os.listdir(d):
+            os.rmdir(d)
+            d = os.path.dirname(d)
+
 def get_dirs(d):
     return (os.path.join(d,o) for o in os.listdir(d) if os.path.isdir(os.path.join(d,o)))
 
@@ -225,67 +390,225 @@ def symlink_to(src, dst_dir):
     os.symlink(src, target)
     return target
 
-class CarbinURLOpener(request.FancyURLopener):
-    def http_error_default(self, url, fp, errcode, errmsg, headers):
-        if errcode >= 400:
-            raise BuildError("Download failed with error {0} for: {1}".format(errcode, url))
-        return request.FancyURLopener.http_error_default(self, url, fp, errcode, errmsg, headers)
-
-def download_to(url, download_dir, insecure=False):
+# Returns None when the server answers that the cached copy is still valid
+def open_url(url, insecure=False, headers=None):
+    context = None
+    if insecure:
+        import ssl
+        context = ssl._create_unverified_context()
+    try:
+        return request.urlopen(request.Request(url, headers=headers or {}), context=context)
+    except error.HTTPError as e:
+        if e.code == 304: return None
+        raise BuildError("Download failed with error {0} for: {1}".format(e.code, url))
+    except error.URLError as e:
+        raise BuildError("Download failed with error {0} for: {1}".format(e.reason, url))
+
+def read_chunks(f, size=1 << 16):
+    while True:
+        chunk = f.read(size)
+        if not chunk: break
+        yield chunk
+
+class StreamReader:
+    def __init__(self, f, out=None, digests=None, bar=None):
+        self.f = f
+        self.out = out
+        self.digests = digests
+        self.hashes = dict((t, hashlib.new(t)) for t in digests or {})
+        self.bar = bar
+
+    def read(self, size=-1):
+        chunk = self.f.read(size)
+        if chunk:
+            if self.out: self.out.write(chunk)
+            for h in self.hashes.values(): h.update(chunk)
+            if self.bar: self.bar.update(len(chunk))
+        return chunk
+
+    def finish(self):
+        for t, h in self.hashes.items(): self.digests[t] = h.hexdigest()
+
+# Streams the download, copying it into out as it is read. The hashes named
+# by the keys of digests are computed on the way, and their hex digests are
+# stored back into it.
+@contextlib.contextmanager
+def open_stream(url, insecure=False, progress=True, response=None, digests=None, out=None):
+    click.echo("Downloading {0}".format(url))
+    response = response or open_url(url, insecure=insecure)
+    total = int(response.info().get('Content-Length') or 0)
+    bar = click.progressbar(length=total, width=70) if progress and total else None
+    stream = StreamReader(response, out=out, digests=digests, bar=bar)
+    try:
+        if bar is None: yield stream
+        else:
+            with bar: yield stream
+        # Read whatever the consumer left, such as the padding after a tarball
+        for chunk in read_chunks(stream): pass
+    finally:
+        response.close()
+    stream.finish()
+
+def download_to(url, download_dir, insecure=False, progress=True, response=None, digests=None):
     name = url.split('/')[-1]
     file = os.path.join(download_dir, name)
-    click.echo("Downloading {0}".format(url))
-    bar_len = 1000
-    with click.progressbar(length=bar_len, width=70) as bar:
-        def hook(count, block_size, total_size):
-            percent = int(count*block_size*bar_len/total_size)
-            if percent > 0 and percent < bar_len:
-                # Hack because we can't set the position
-                bar.pos = percent
-                bar.update(0)
-        context = None
-        if insecure: context = ssl._create_unverified_context()
-        CarbinURLOpener(context=context).retrieve(url, filename=file, reporthook=hook, data=None)
-        bar.update(bar_len)
+    with open(file, 'wb') as f:
+        with open_stream(url, insecure=insecure, progress=progress, response=response, digests=digests, out=f):
+            pass
     if not os.path.exists(file):
         raise BuildError("Download failed for: {0}".format(url))
     return file
 
+def is_tar_url(url):
+    import carbin.tarball as tarball
+    return tarball.is_supported(parse.urlparse(url).path)
+
+# Extracts a tarball while it downloads, so the archive is never written and
+# read back. With cache set the archive is also written into the download
+# cache as a side stream, and the cached file is returned.
+def download_extract(url, dst, insecure=False, progress=True, response=None, digests=None, cache=False):
+    import carbin.tarball as tarball
+    digests = digests if digests is not None else {}
+    out = None
+    if cache:
+        digests['sha256'] = None
+        mkdir(get_cache_path('tmp'))
+        fd, tmp = tempfile.mkstemp(dir=get_cache_path('tmp'))
+        out = os.fdopen(fd, 'wb')
+    try:
+        with open_stream(url, insecure=insecure, progress=progress, response=response, digests=digests,
+                         out=out) as stream:
+            tarball.extract_stream(stream, parse.urlparse(url).path, dst)
+    except:
+        if out:
+            out.close()
+            os.remove(tmp)
+        raise
+    if not cache: return None
+    out.close()
+    key = 'sha256-' + digests['sha256']
+    f = get_cache_file(key)
+    if f:
+        os.remove(tmp)
+        return f
+    f = get_cache_path(key, url.split('/')[-1])
+    mkdir(get_cache_path(key))
+    os.rename(tmp, f)
+    write_digests(f, digests)
+    return f
+
+# Archives of a tag, a release or a commit never change, so they don't need
+# to be revalidated
+PINNED_REF = re.compile(r'^(v?[0-9]+(\.[0-9]+)+[\w.+-]*|[0-9a-f]{40})$')
+
+def is_pinned_url(url):
+    path = parse.urlparse(url).path
+    if '/releases/download/' in path or '/refs/tags/' in path: return True
+    ref = path.rstrip('/').split('/')[-1]
+    for ext in ['.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar.zst', '.tar', '.zip']:
+        if ref.endswith(ext): ref = ref[:-len(ext)]
+    return bool(PINNED_REF.match(ref))
+
+def get_url_cache_path(url, *args):
+    return get_cache_path('urls', hashlib.sha256(url.encode('utf-8')).hexdigest(), *args)
+
+def read_json(f):
+    try:
+        with open(f) as fp: return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+# Every download is stored by its sha256 digest, the same key that is used
+# for hashes given with -H, and the url is mapped to the digest along with
+# its ETag so the cached copy can be revalidated
+def download_cached(url, dst, insecure=False, progress=True, digests=None, extract=False):
+    meta_file = get_url_cache_path(url, 'meta.json')
+    meta = read_json(meta_file) or {}
+    cached = meta.get('digest') and get_cache_file('sha256-' + meta['digest'])
+    if cached and is_pinned_url(url):
+        click.echo("Using cached {0}".format(url))
+        return cached
+    headers = {}
+    if cached and meta.get('etag'): headers['If-None-Match'] = meta['etag']
+    if cached and meta.get('last_modified'): headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        response = open_url(url, insecure=insecure, headers=headers)
+    except BuildError as e:
+        if not cached: raise
+        click.echo("WARNING: {0}, using cached download".format(e))
+        return cached
+    if response is None:
+        click.echo("Using cached {0}".format(url))
+        return cached
+    info = response.info()
+    digests = digests if digests is not None else {}
+    digests['sha256'] = None
+    if extract:
+        download_extract(url, dst, insecure=insecure, progress=progress, response=response, digests=digests,
+                         cache=True)
+        f = dst
+    else:
+        f = download_to(url, dst, insecure=insecure, progress=progress, response=response, digests=digests)
+    digest = digests['sha256']
+    if not extract and not get_cache_file('sha256-' + digest): add_cache_file('sha256-' + digest, f, digests)
+    mkdir(os.path.dirname(meta_file))
+    with open(meta_file, 'w') as fp:
+        json.dump({
+            'url': url,
+            'etag': info.get('ETag'),
+            'last_modified': info.get('Last-Modified'),
+            'digest': digest
+        }, fp)
+    return f
 
 def transfer_to(f, dst, copy=False):
     if USE_SYMLINKS and not copy: return symlink_to(f, dst)
     else: return copy_to(f, dst)
 
 
-def retrieve_url(url, dst, copy=False, insecure=False, hash=None):
+# With extract set, tarballs that have to be downloaded are extracted into
+# dst as they stream in and dst is returned instead of the archive
+def retrieve_url(url, dst, copy=False, insecure=False, hash=None, progress=True, extract=False):
     remote = not url.startswith('file://')
     # Retrieve from cache
     if remote and hash:
         f = get_cache_file(hash.replace(':', '-'))
         if f: return f
-    f = download_to(url, dst, insecure=insecure) if remote else transfer_to(url[7:], dst, copy=copy)
-    if os.path.isfile(f) and hash:
+    # Hash the download as it streams in, instead of reading it back
+    digests = dict.fromkeys([hash.lower().split(':')[0]]) if hash else {}
+    stream = remote and extract and USE_STREAM_EXTRACT and is_tar_url(url)
+    if not remote: f = transfer_to(url[7:], dst, copy=copy)
+    elif USE_DOWNLOAD_CACHE:
+        f = download_cached(url, dst, insecure=insecure, progress=progress, digests=digests, extract=stream)
+    elif stream:
+        download_extract(url, dst, insecure=insecure, progress=progress, digests=digests, cache=bool(hash))
+        f = dst
+    else: f = download_to(url, dst, insecure=insecure, progress=progress, digests=digests)
+    extracted = stream and f == dst
+    if hash and (extracted or os.path.isfile(f)):
         click.echo("Computing hash: {}".format(hash))
-        if check_hash(f, hash):
-            if remote: add_cache_file(hash.replace(':', '-'), f)
+        if check_hash(f, hash, digests):
+            # An extracted download was kept in the cache under its sha256
+            archive = get_cache_file('sha256-' + digests['sha256']) if extracted else f
+            if remote and archive and not get_cache_file(hash.replace(':', '-')):
+                add_cache_file(hash.replace(':', '-'), archive, digests)
         else:
             raise BuildError("Hash doesn't match for {0}: {1}".format(url, hash))
     return f
 
 
 def extract_ar(archive, dst, *kwargs):
-    if sys.version_info[0] < 3 and archive.endswith('.xz'):
-        with contextlib.closing(lzma.LZMAFile(archive)) as xz:
-            with tarfile.open(fileobj=xz, *kwargs) as f:
-                f.extractall(dst)
-    elif archive.endswith('.zip'):
+    import carbin.tarball as tarball
+    if archive.endswith('.zip'):
         with zipfile.ZipFile(archive,'r') as f:
             f.extractall(dst)
-    elif tarfile.is_tarfile(archive):
-        if USE_CMAKE_TAR:
+    elif tarball.get_codec(archive) is not None or tarfile.is_tarfile(archive):
+        # Older versions of cmake can't read zstd
+        if USE_CMAKE_TAR and tarball.get_codec(archive) != 'zst':
+            mkdir(dst)
             cmd([which('cmake'), '-E', 'tar', 'xzf', os.path.abspath(archive)], cwd=dst)
         else:
-            tarfile.open(archive, *kwargs).extractall(dst)
+            tarball.extract(archive, dst)
     else:
         # Treat as a single source file
         d = os.path.join(dst, 'header')
@@ -295,12 +618,44 @@ def extract_ar(archive, dst, *kwargs):
 
 def hash_file(f, t):
     h = hashlib.new(t)
-    h.update(open(f, 'rb').read())
+    with open(f, 'rb') as fp:
+        for chunk in read_chunks(fp): h.update(chunk)
+    return h.hexdigest()
+
+# Hashes the names and contents of every file under d, so it changes
+# whenever the tree does. With cache set, the digest of each file is kept in
+# that file along with its size and mtime, and only the files that changed
+# since are read again.
+def hash_dir(d, t='sha256', ignore=('.git', '.hg', '.svn'), cache=None):
+    known = (read_json(cache) or {}) if cache else {}
+    digests = {}
+    h = hashlib.new(t)
+    for root, dirs, files in os.walk(d):
+        dirs[:] = sorted(x for x in dirs if x not in ignore)
+        for file in sorted(files):
+            p = os.path.join(root, file)
+            rel = os.path.relpath(p, d)
+            h.update(rel.encode('utf-8') + b'\0')
+            if os.path.islink(p): h.update(os.readlink(p).encode('utf-8'))
+            elif os.path.isfile(p):
+                st = os.stat(p)
+                entry = known.get(rel) or {}
+                if entry.get(t) and entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime:
+                    digest = entry[t]
+                else: digest = hash_file(p, t)
+                digests[rel] = {t: digest, 'size': st.st_size, 'mtime': st.st_mtime}
+                h.update(digest.encode('utf-8'))
+            h.update(b'\0')
+    if cache and digests != known:
+        mkdir(os.path.dirname(cache))
+        tmp = cache + '.tmp.{0}'.format(os.getpid())
+        with open(tmp, 'w') as f: json.dump(digests, f)
+        os.rename(tmp, cache)
     return h.hexdigest()
 
-def check_hash(f, hash):
+def check_hash(f, hash, digests=None):
     t, h = hash.lower().split(':')
-    return hash_file(f, t) == h
+    return ((digests or {}).get(t) or get_digest(f, t)) == h
 
 def which(p, paths=None, throws=True):
     exes = [p+x for x in ['', '.exe', '.bat']]
@@ -329,7 +684,20 @@ def yield_from(f):
         return flat(f(*args, **kwargs))
     return g
 
-def cmd(args, env=None, capture=None, **kwargs):
+def get_maxrss(usage):
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin': return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+# Reaps the child directly so we get its resource usage, which also covers
+# every process it waited on
+def wait_usage(child):
+    _, status, usage = os.wait4(child.pid, 0)
+    if os.WIFSIGNALED(status): child.returncode = -os.WTERMSIG(status)
+    else: child.returncode = os.WEXITSTATUS(status)
+    return usage
+
+def cmd(args, env=None, capture=None, usage=None, **kwargs):
     e = merge(os.environ, env)
     c = capture or ''
     stdout = None
@@ -337,7 +705,12 @@ def cmd(args, env=None, capture=None, **kwargs):
     if c == 'out' or c == 'all': stdout = subprocess.PIPE
     if c == 'err' or c == 'all': stderr = subprocess.PIPE
     child = subprocess.Popen(args, stdout=stdout, stderr=stderr, env=e, **kwargs)
-    out = child.communicate()
+    # The peak RSS of the largest process the command ran is added to usage
+    if usage is not None and not c and hasattr(os, 'wait4'):
+        usage.append(get_maxrss(wait_usage(child)))
+        out = (None, None)
+    else:
+        out = child.communicate()
     if child.returncode != 0:
         raise BuildError(msg='Command failed: ' + str(args), data=e)
     return out
@@ -14,7 +14,7 @@
 # limitations under the License.
 #
 from setuptools import setup, find_packages
-import os, re, sys
+import os, re
 
 def get_version(package):
     """Return package version as listed in `__version__` in `init.py`."""
@@ -31,8 +31,6 @@ def get_requires(filename):
 
 project_requirements = get_requires("requirements.txt")
 
-if os.name == 'posix' and sys.version_info[0] < 3: project_requirements.append('subprocess32')
-
 setup(
     name="carbin",
     version=get_version("carbin"),
@@ -44,6 +42,7 @@ setup(
     packages=find_packages(),
     package_data={'cmake': ['*.cmake']},
     install_requires=project_requirements,
+    python_requires='>=3.5',
     include_package_data=True,
     entry_points={
         'console_scripts': [
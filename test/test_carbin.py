@@ -1,6 +1,6 @@
 import pytest
 
-import sys, os, tarfile, carbin.util, shutil
+import sys, os, socket, tarfile, json, carbin.util, carbin.artifacts, carbin.tarball, carbin.db, carbin.package, carbin.server, shutil
 
 from six.moves import shlex_quote
 
@@ -51,6 +51,13 @@ class DirForTests:
         if 'cwd' not in kwargs: kwargs['cwd'] = self.tmp_dir
         carbin.util.cmd(*args, shell=True, **kwargs)
 
+    # Runs a command that has to fail and returns its output
+    def cmd_error(self, x, **kwargs):
+        err = self.get_path('error.txt')
+        with pytest.raises(carbin.util.BuildError):
+            self.cmd(x + ' > ' + shlex_quote(err) + ' 2>&1', **kwargs)
+        return open(err).read()
+
     def cmds(self, g, **kwargs):
         for x in g:
             print(x)
@@ -76,7 +83,9 @@ class DirForTests:
         return os.path.join(self.tmp_dir, *ps)
 
 @pytest.fixture
-def d(tmpdir):
+def d(tmpdir, monkeypatch):
+    # Keeps the caches of each test to itself
+    monkeypatch.setenv('XDG_CONFIG_HOME', os.path.join(tmpdir.strpath, 'config'))
     return DirForTests(tmpdir.strpath)
 
 def remove_empty_elements(xs):
@@ -476,6 +485,304 @@ def test_unlink_pkg(d):
     ])
 
 
+def test_unlink_manifest(d):
+    d.cmds([carbin_cmd('install', '--verbose', 'simple,' + get_exists_path('libsimple'))])
+    manifest = d.get_path('carbin', 'carbin', 'pkg', 'simple', 'manifest.txt')
+    lines = [line.strip() for line in open(manifest)]
+    assert lines[0] == '# install-mode: symlink'
+    paths = lines[1:]
+    assert paths
+    assert all(os.path.lexists(d.get_path('carbin', p)) for p in paths)
+    d.write_to(os.path.join('carbin', 'other.txt'), ['other'])
+    d.cmds([carbin_cmd('rm', '--verbose -y --unlink', 'simple')])
+    assert not any(os.path.lexists(d.get_path('carbin', p)) for p in paths)
+    assert not any(os.path.exists(d.get_path('carbin', p.split(os.sep)[0])) for p in paths)
+    d.assert_path('carbin', 'other.txt')
+    # Packages installed before manifests were written are still unlinked
+    d.cmds([carbin_cmd('install', '--verbose', 'simple,' + get_exists_path('libsimple'))])
+    assert all(os.path.lexists(d.get_path('carbin', p)) for p in paths)
+    os.remove(manifest)
+    d.cmds([carbin_cmd('rm', '--verbose -y', 'simple'), carbin_cmd('size', '0')])
+    assert not any(os.path.lexists(d.get_path('carbin', p)) for p in paths)
+    d.assert_path('carbin', 'other.txt')
+
+def test_package_db(d):
+    app = d.get_path('appsrc')
+    shutil.copytree(get_exists_path('basicapp'), app)
+    d.write_to(os.path.join('appsrc', 'carbin_deps.txt'), ['simple,' + get_exists_path('libsimple')])
+    d.cmds([carbin_cmd('install', '--verbose', 'app,' + app), carbin_cmd('size', '2')])
+    def list_():
+        out, err = carbin.util.cmd(carbin_cmd('list'), shell=True, capture='out', cwd=d.tmp_dir)
+        return out.decode('utf-8').split()
+    assert list_() == ['app', 'simple']
+    db = carbin.db.PackageDB(d.get_path('carbin', 'carbin', 'packages.db'), d.get_path('carbin', 'carbin', 'pkg'),
+                             d.get_path('carbin', 'carbin', 'unlink'))
+    assert db.dependents('simple') == ['app', 'simple']
+    assert db.dependencies('app') == ['simple']
+    assert db.get('app')['config']['variant'] == 'Release'
+    db.close()
+    # Changes made without the database are picked up
+    os.mkdir(d.get_path('carbin', 'carbin', 'pkg', 'other'))
+    assert list_() == ['app', 'other', 'simple']
+    os.rmdir(d.get_path('carbin', 'carbin', 'pkg', 'other'))
+    os.remove(d.get_path('carbin', 'carbin', 'packages.db'))
+    assert list_() == ['app', 'simple']
+    db = carbin.db.PackageDB(d.get_path('carbin', 'carbin', 'packages.db'), d.get_path('carbin', 'carbin', 'pkg'),
+                             d.get_path('carbin', 'carbin', 'unlink'))
+    assert db.dependencies('app') == ['simple']
+    db.close()
+    # So are edges removed by hand
+    os.remove(d.get_path('carbin', 'carbin', 'pkg', 'simple', 'deps', 'app'))
+    assert list_() == ['app', 'simple']
+    assert db.dependencies('app') == []
+    db.close()
+    carbin.util.mkfile(d.get_path('carbin', 'carbin', 'pkg', 'simple', 'deps'), 'app', 'app')
+    d.cmds([carbin_cmd('rm', '--verbose -y --unlink', 'app'), carbin_cmd('size', '1')])
+    assert list_() == ['simple']
+    d.cmds([carbin_cmd('rm', '--verbose -y', 'simple'), carbin_cmd('size', '0')])
+    assert list_() == []
+
+def test_package_db_keeps_metadata(d, monkeypatch):
+    carbin.util.mkdir(d.get_path('headersrc'))
+    d.write_to(os.path.join('headersrc', 'CMakeLists.txt'), [
+        'cmake_minimum_required(VERSION 2.8)',
+        'project(header NONE)',
+        'install(FILES CMakeLists.txt DESTINATION share/header)'
+    ])
+    d.cmds([
+        carbin_cmd('install', '--verbose', 'simple,' + get_exists_path('libsimple')),
+        carbin_cmd('install', '--verbose', 'header,' + d.get_path('headersrc'))
+    ])
+    db = carbin.db.PackageDB(d.get_path('carbin', 'carbin', 'packages.db'), d.get_path('carbin', 'carbin', 'pkg'),
+                             d.get_path('carbin', 'carbin', 'unlink'))
+    simple = db.get('simple')
+    assert simple['url'] == 'file://' + get_exists_path('libsimple')
+    assert simple['config']['variant'] == 'Release'
+    db.close()
+    # Changes made by carbin itself don't rebuild the database
+    from carbin.prefix import CarbinPrefix
+    def rebuild(self): raise AssertionError("rebuilt")
+    monkeypatch.setattr(carbin.db.PackageDB, 'rebuild', rebuild)
+    p = CarbinPrefix(d.get_path('carbin'))
+    # Listing only reads the database
+    assert sorted(pkg.name for pkg in p.list()) == ['header', 'simple']
+    assert p.db.read_only
+    p.ignore('other')
+    p.unlink('header')
+    p.remove('other')
+    assert [pkg.name for pkg in p.list()] == ['simple']
+    assert p.db.get('simple')['config']['variant'] == 'Release'
+    p.db.close()
+
+def test_link_relinks_dependencies(d):
+    app = d.get_path('appsrc')
+    shutil.copytree(get_exists_path('basicapp'), app)
+    d.write_to(os.path.join('appsrc', 'carbin_deps.txt'), ['simple,' + get_exists_path('libsimple')])
+    carbin.util.mkdir(d.get_path('headersrc'))
+    d.write_to(os.path.join('headersrc', 'CMakeLists.txt'), [
+        'cmake_minimum_required(VERSION 2.8)',
+        'project(header NONE)',
+        'install(FILES CMakeLists.txt DESTINATION share/header)'
+    ])
+    d.cmds([
+        carbin_cmd('install', '--verbose', 'header,' + d.get_path('headersrc')),
+        carbin_cmd('rm', '--verbose -y --unlink', 'header'),
+        carbin_cmd('install', '--verbose', 'app,' + app),
+        carbin_cmd('size', '2'),
+        carbin_cmd('rm', '--verbose -y --unlink', 'simple'),
+        carbin_cmd('size', '0'),
+        carbin_cmd('install', '--verbose', 'app,' + app),
+        carbin_cmd('size', '2')
+    ])
+    d.assert_path('carbin', 'carbin', 'pkg', 'simple')
+    d.assert_path('carbin', 'carbin', 'unlink', 'header')
+
+def test_link_relinks_without_rebuild(d, monkeypatch):
+    app = d.get_path('appsrc')
+    shutil.copytree(get_exists_path('basicapp'), app)
+    d.write_to(os.path.join('appsrc', 'carbin_deps.txt'), ['simple,' + get_exists_path('libsimple')])
+    d.cmds([carbin_cmd('install', '--verbose', 'app,' + app)])
+    from carbin.prefix import CarbinPrefix
+    def rebuild(self): raise AssertionError("rebuilt")
+    monkeypatch.setattr(carbin.db.PackageDB, 'rebuild', rebuild)
+    p = CarbinPrefix(d.get_path('carbin'))
+    p.unlink('app')
+    p.unlink('simple')
+    assert list(p.list()) == []
+    p.link('app')
+    assert sorted(pkg.name for pkg in p.list()) == ['app', 'simple']
+    assert p.db.get('simple')['url'] == 'file://' + get_exists_path('libsimple')
+    p.db.close()
+
+def test_parse_file(d):
+    f = d.write_to('reqs', [
+        '# comment',
+        'simple@v1.0 -DX=1 --define Y=2 -tb # simple',
+        'app,\'/a dir\'/app --ignore -X cmake/app.cmake \\',
+        '    -H sha256:abc',
+        '-f other.txt'
+    ])
+    pbs = carbin.package.parse_file(f)
+    assert [pb.pkg_src for pb in pbs] == ['simple@v1.0', 'app,/a dir/app', None]
+    assert pbs[0].define == ['X=1', 'Y=2'] and pbs[0].test and pbs[0].build
+    assert pbs[1].cmake == 'cmake/app.cmake' and pbs[1].hash == 'sha256:abc' and pbs[1].ignore_requirements
+    assert pbs[2].file == 'other.txt'
+    # Each caller gets its own records
+    pbs[0].define.append('Z=3')
+    assert carbin.package.parse_file(f)[0].define == ['X=1', 'Y=2']
+    d.write_to('reqs', ['other -DX=2'])
+    os.utime(f, ns=(0, 0))
+    assert [pb.pkg_src for pb in carbin.package.parse_file(f)] == ['other']
+
+def test_recipe_path(d):
+    carbin.util.mkdir(d.get_path('base', 'simple'))
+    carbin.util.mkdir(d.get_path('base', 'other'))
+    carbin.util.mkdir(d.get_path('overlay', 'simple'))
+    d.write_to(os.path.join('base', 'simple', 'package.txt'), [d.get_path('nonexistent')])
+    d.write_to(os.path.join('base', 'other', 'package.txt'), [d.get_path('headersrc')])
+    carbin.util.mkdir(d.get_path('headersrc'))
+    d.write_to(os.path.join('headersrc', 'CMakeLists.txt'), [
+        'cmake_minimum_required(VERSION 2.8)',
+        'project(header NONE)',
+        'install(FILES CMakeLists.txt DESTINATION share/header)'
+    ])
+    d.write_to(os.path.join('overlay', 'simple', 'package.txt'), [get_exists_path('libsimple')])
+    env = {'CARBIN_RECIPE_PATH': os.pathsep.join([d.get_path('overlay'), d.get_path('base')])}
+    d.cmds([
+        carbin_cmd('install', '--verbose', 'simple'),
+        carbin_cmd('install', '--verbose', 'other'),
+        carbin_cmd('size', '2')
+    ], env=env)
+
+def test_recipe_path_links(d):
+    carbin.util.mkdir(d.get_path('recipes', 'simple'))
+    d.write_to(os.path.join('recipes', 'simple', 'package.txt'), [get_exists_path('libsimple')])
+    # A link back to the root is not walked again, but a link to another recipe is an alias
+    os.symlink(d.get_path('recipes'), d.get_path('recipes', 'simple', 'loop'))
+    os.symlink(d.get_path('recipes', 'simple'), d.get_path('recipes', 'alias'))
+    env = {'CARBIN_RECIPE_PATH': d.get_path('recipes')}
+    d.cmds([
+        carbin_cmd('install', '--verbose', 'alias'),
+        carbin_cmd('size', '1')
+    ], env=env)
+
+def test_startup_imports(d):
+    out, err = carbin.util.cmd([sys.executable, '-c', 'import sys, carbin.cli; print(" ".join(sys.modules))'],
+                               capture='out', cwd=d.tmp_dir)
+    modules = out.decode('utf-8').split()
+    for m in ['carbin.prefix', 'carbin.server', 'carbin.creater', 'carbin.artifacts', 'carbin.compiler_cache',
+              'carbin.lockfile', 'http.server', 'ssl', 'concurrent.futures', 'multiprocessing']:
+        assert m not in modules
+    out, err = carbin.util.cmd([sys.executable, '-c', 'import sys, carbin.prefix; print(" ".join(sys.modules))'],
+                               capture='out', cwd=d.tmp_dir)
+    modules = out.decode('utf-8').split()
+    for m in ['carbin.db', 'sqlite3', 'carbin.jobserver', 'carbin.recipes', 'carbin.configure_cache',
+              'carbin.artifacts', 'carbin.lockfile', 'http.server']:
+        assert m not in modules
+
+def test_read_only_commands(d):
+    cmds = [carbin_cmd('list'), carbin_cmd('size', '0')]
+    if __has_pkg_config__: cmds.append(carbin_cmd('pkg-config', '--list-all'))
+    d.cmds(cmds)
+    assert not os.path.exists(d.get_path('carbin'))
+
+def write_locked_app(d):
+    app = d.get_path('appsrc')
+    shutil.copytree(get_exists_path('basicapp'), app)
+    ar = d.get_path('libsimple.tar.gz')
+    create_ar(archive=ar, src=get_exists_path('libsimple'))
+    d.write_to(os.path.join('appsrc', 'carbin_deps.txt'), ['simple,' + ar])
+    carbin.util.mkdir(d.get_path('proj'))
+    d.write_to(os.path.join('proj', 'carbin_deps.txt'), ['app,' + app])
+    d.cmds([carbin_cmd('lock', '--verbose', '-f', d.get_path('proj', 'carbin_deps.txt'))])
+    return ar
+
+def test_install_locked(d):
+    ar = write_locked_app(d)
+    lock = json.load(open(d.get_path('proj', 'carbin.lock')))
+    assert lock['version'] == 1
+    packages = lock['packages']
+    assert sorted(packages) == ['app', 'simple']
+    assert packages['app']['deps'] == ['simple']
+    assert packages['app']['sha256'] is None
+    assert packages['simple']['url'] == 'file://' + ar
+    assert packages['simple']['sha256'] == carbin.util.get_digest(ar, 'sha256')
+    d.cmds([
+        carbin_cmd('install', '--verbose --locked', '-f', d.get_path('proj', 'carbin_deps.txt')),
+        carbin_cmd('size', '2')
+    ])
+
+def test_lock_insecure(d):
+    carbin.util.mkdir(d.get_path('remote'))
+    create_ar(archive=d.get_path('remote', 'libsimple.tar.gz'), src=get_exists_path('libsimple'))
+    server = carbin.server.CacheServer(d.get_path('remote'), host='localhost')
+    server.start()
+    try:
+        url = server.get_url().replace('http', 'https') + '/libsimple.tar.gz'
+        d.write_to('carbin_deps.txt', ['simple,' + url])
+        d.cmds([carbin_cmd('lock', '--verbose --insecure', '-f', d.get_path('carbin_deps.txt'))])
+    finally:
+        server.shutdown()
+        server.server_close()
+    packages = json.load(open(d.get_path('carbin.lock')))['packages']
+    assert packages['simple']['url'] == url
+    assert packages['simple']['sha256'] == carbin.util.get_digest(d.get_path('remote', 'libsimple.tar.gz'), 'sha256')
+
+def test_install_locked_changed_fail(d):
+    ar = write_locked_app(d)
+    create_ar(archive=ar, src=get_exists_path('libsimpledebug'))
+    out = d.cmd_error(carbin_cmd('install', '--verbose --locked', '-f', d.get_path('proj', 'carbin_deps.txt')))
+    assert "Hash doesn't match for" in out
+    assert not os.path.exists(d.get_path('carbin', 'carbin', 'pkg', 'simple'))
+
+@pytest.mark.parametrize('mode', ['hardlink', 'reflink', 'copy'])
+def test_install_mode(d, mode):
+    env = {'CARBIN_INSTALL_MODE': mode}
+    d.cmds([carbin_cmd('install', '--verbose', 'simple,' + get_exists_path('libsimple'))], env=env)
+    paths = [line.strip() for line in open(d.get_path('carbin', 'carbin', 'pkg', 'simple', 'manifest.txt'))][1:]
+    assert paths
+    for p in paths:
+        installed = d.get_path('carbin', p)
+        assert not os.path.islink(installed)
+        same = os.path.samefile(installed, d.get_path('carbin', 'carbin', 'pkg', 'simple', 'install', p))
+        assert same == (mode == 'hardlink')
+    # Removed by the mode the package was installed with
+    d.cmds([carbin_cmd('rm', '--verbose -y', 'simple'), carbin_cmd('size', '0')], env={'CARBIN_INSTALL_MODE': 'symlink'})
+    assert not any(os.path.lexists(d.get_path('carbin', p)) for p in paths)
+
+@pytest.mark.parametrize('mode', ['hardlink', 'copy'])
+def test_install_mode_overwritten(d, mode):
+    env = {'CARBIN_INSTALL_MODE': mode, 'CARBIN_USE_ARTIFACT_CACHE': '0'}
+    for name, content in [('first', ['first']), ('second', ['second', 'second'])]:
+        src = carbin.util.mkdir(d.get_path('src', name))
+        d.write_to(os.path.join('src', name, 'common.txt'), content)
+        d.write_to(os.path.join('src', name, 'CMakeLists.txt'), [
+            'cmake_minimum_required(VERSION 2.8)',
+            'project({} NONE)'.format(name),
+            'install(FILES common.txt DESTINATION share/common)'
+        ])
+        d.cmds([carbin_cmd('install', '--verbose', name + ',' + src)], env=env)
+    # The file the second package placed over the first one's is kept
+    d.cmds([carbin_cmd('rm', '--verbose -y', 'first')], env=env)
+    assert open(d.get_path('carbin', 'share', 'common', 'common.txt')).read().split() == ['second', 'second']
+    d.cmds([carbin_cmd('rm', '--verbose -y', 'second'), carbin_cmd('size', '0')], env=env)
+    assert not os.path.exists(d.get_path('carbin', 'share', 'common'))
+
+@pytest.mark.parametrize('mode', ['symlink', 'hardlink', 'copy'])
+def test_link_dir_parallel(d, mode):
+    src = d.get_path('src')
+    for i in range(200):
+        carbin.util.mkfile(os.path.join(src, 'include', 'dir{}'.format(i // 50)), 'file{}.h'.format(i), [str(i)])
+    os.symlink('dir0', os.path.join(src, 'include', 'latest'))
+    dst = d.get_path('dst')
+    if mode == 'symlink': placed = carbin.util.symlink_dir(src, dst, jobs=4)
+    else: placed = carbin.util.copy_dir(src, dst, mode=mode, jobs=4)
+    assert len(placed) == (201 if mode == 'symlink' else 200)
+    for i in range(200):
+        p = os.path.join(dst, 'include', 'dir{}'.format(i // 50), 'file{}.h'.format(i))
+        assert open(p).read().strip() == str(i)
+        assert os.path.islink(p) == (mode == 'symlink')
+
 @appveyor_skip
 def test_build_dir(d):
     d.cmds(build_cmds(get_exists_path('libsimple')))
@@ -1009,3 +1316,520 @@ def test_cmake_trouble(d):
 
 def test_subdir(d):
     d.cmds(install_cmds(url='-X subdir {}'.format(get_exists_path('libsimplesubdir')), lib='simple', alias=get_exists_path('libsimplesubdir')))
+
+def copy_with_deps(d, src, name, deps):
+    p = d.get_path(name)
+    shutil.copytree(get_exists_path(src), p)
+    carbin.util.write_to(os.path.join(p, 'carbin_deps.txt'), [shlex_quote(dep) for dep in deps])
+    return p
+
+def test_install_jobs(d):
+    reqs_file = d.write_to('reqs', [
+        shlex_quote('simple,'+get_exists_path('libsimple')),
+        shlex_quote('app,'+get_exists_path('simpleapp'))
+    ])
+    d.cmds([
+        carbin_cmd('install', '--verbose -J 2 -f', reqs_file),
+        carbin_cmd('size', '2'),
+        carbin_cmd('install', '--verbose -J 2 -f', reqs_file),
+        carbin_cmd('size', '2'),
+        carbin_cmd('rm', '--verbose -y', 'simple'),
+        carbin_cmd('size', '1')
+    ])
+
+if __has_pkg_config__:
+
+    @appveyor_skip
+    def test_install_jobs_shared_dep(d):
+        simple = 'simple,' + get_exists_path('libsimple')
+        app1 = copy_with_deps(d, 'basicapp', 'app1', [simple])
+        app2 = copy_with_deps(d, 'simpleapp', 'app2', [simple])
+        d.cmds([
+            carbin_cmd('install', '--verbose --test -J 2', app1, app2),
+            carbin_cmd('size', '3'),
+            carbin_cmd('rm', '--verbose -y', 'simple'),
+            carbin_cmd('size', '0')
+        ])
+
+def test_plan(d):
+    simple = 'simple,' + get_exists_path('libsimple')
+    app1 = copy_with_deps(d, 'basicapp', 'app1', [simple])
+    app2 = copy_with_deps(d, 'simpleapp', 'app2', [simple])
+    out, err = carbin.util.cmd(carbin_cmd('plan', app1, app2), shell=True, capture='out', cwd=d.tmp_dir)
+    lines = out.decode('utf-8').splitlines()
+    assert lines[0] == 'simple (build)'
+    assert len(lines) == 3
+    d.cmds([carbin_cmd('size', '0')])
+
+def test_plan_same_source(d):
+    libsimple = get_exists_path('libsimple')
+    app = copy_with_deps(d, 'simpleapp', 'app', ['simple,' + libsimple, 'other,' + libsimple])
+    out, err = carbin.util.cmd(carbin_cmd('plan', app), shell=True, capture='out', cwd=d.tmp_dir)
+    lines = out.decode('utf-8').splitlines()
+    assert 'simple (build)' in lines
+    assert 'other (build)' in lines
+    assert len(lines) == 3
+
+def test_plan_circular(d):
+    copy_with_deps(d, 'simpleapp', 'a', [d.get_path('b')])
+    copy_with_deps(d, 'libsimple', 'b', [d.get_path('a')])
+    assert 'Circular dependency: ' in d.cmd_error(carbin_cmd('plan', d.get_path('a')))
+
+def test_install_jobs_prefetch(d):
+    simple = d.get_path('libsimple.tar.gz')
+    create_ar(archive=simple, src=get_exists_path('libsimple'))
+    app = d.get_path('app.tar.gz')
+    create_ar(archive=app, src=copy_with_deps(d, 'simpleapp', 'app', ['simple,' + simple]))
+    d.cmds([
+        carbin_cmd('install', '--verbose -J 2 --fetch-jobs 2', app),
+        carbin_cmd('size', '2'),
+        carbin_cmd('rm', '--verbose -y', 'simple'),
+        carbin_cmd('size', '0')
+    ])
+
+def test_install_build_jobs(d):
+    simple = 'simple,' + get_exists_path('libsimple')
+    app = copy_with_deps(d, 'simpleapptest', 'app', [simple])
+    d.cmds([
+        carbin_cmd('install', '--verbose --test --build-jobs 2 -J 2', app),
+        carbin_cmd('size', '2')
+    ])
+
+def test_install_make_jobserver(d):
+    src = carbin.util.mkdir(d.get_path('makeproject'))
+    carbin.util.write_to(os.path.join(src, 'Makefile'), [
+        'all: a.txt b.txt',
+        '%.txt:',
+        '\techo $@ > $@',
+        'install: all',
+        '\tmkdir -p $(PREFIX)/share/makeproject',
+        '\tcp a.txt b.txt $(PREFIX)/share/makeproject'
+    ])
+    d.cmds([
+        carbin_cmd('install', '--verbose --build-jobs 2 --cmake make', src),
+        carbin_cmd('size', '1')
+    ])
+    assert os.path.exists(d.get_path('carbin', 'share', 'makeproject', 'b.txt'))
+
+@pytest.mark.skipif(not carbin.util.which('ninja', throws=False), reason="ninja is not installed")
+def test_install_make_jobserver_ninja(d):
+    src = carbin.util.mkdir(d.get_path('makeproject'))
+    carbin.util.write_to(os.path.join(src, 'Makefile'), [
+        'all:',
+        '\techo "$(CARBIN_JOBSERVER)" > jobserver.txt',
+        'install: all',
+        '\tmkdir -p $(PREFIX)/share/makeproject',
+        '\tcp jobserver.txt $(PREFIX)/share/makeproject'
+    ])
+    d.cmds([carbin_cmd('install', '--verbose --build-jobs 2 -G Ninja --cmake make', src)])
+    # The make started by ninja takes its jobs from carbin's jobserver
+    assert open(d.get_path('carbin', 'share', 'makeproject', 'jobserver.txt')).read().strip()
+
+def test_install_max_mem(d):
+    assert carbin.util.parse_size('2G') == 2 * 1024 ** 3
+    simple = 'simple,' + get_exists_path('libsimple')
+    app = copy_with_deps(d, 'simpleapp', 'app', [simple])
+    d.cmds([
+        carbin_cmd('install', '--verbose --max-mem 1G -J 2', app),
+        carbin_cmd('size', '2')
+    ])
+    history = json.load(open(d.get_path('carbin', 'carbin', 'memory.json')))
+    assert history['simple'] > 0
+
+def test_install_artifact_cache(d):
+    simple = 'simple,' + get_exists_path('libsimple')
+    app = copy_with_deps(d, 'simpleapp', 'app', [simple])
+    d.cmds([
+        carbin_cmd('install', '--verbose', app),
+        carbin_cmd('size', '2'),
+        carbin_cmd('rm', '--verbose -y', 'simple'),
+        carbin_cmd('size', '0')
+    ])
+    out, err = carbin.util.cmd(carbin_cmd('install', app), shell=True, capture='out', cwd=d.tmp_dir)
+    assert out.decode('utf-8').count('Using cached build') == 2
+    d.cmds([carbin_cmd('size', '2')])
+    assert os.path.exists(d.get_path('carbin', 'include', 'simple.h'))
+    # Builds configured with other flags are not used
+    d.cmds([carbin_cmd('rm', '--verbose -y', 'simple')])
+    out, err = carbin.util.cmd(carbin_cmd('install', app), shell=True, capture='out', cwd=d.tmp_dir,
+                               env={'CFLAGS': '-DCARBIN_TEST_FLAG'})
+    assert 'Using cached build' not in out.decode('utf-8')
+
+def test_install_remote_cache(d):
+    server = carbin.server.CacheServer(d.get_path('remote'), host='localhost')
+    server.start()
+    try:
+        url = server.get_url()
+        simple = get_exists_path('libsimple')
+        d.cmds([
+            carbin_cmd('install', '--verbose', simple),
+            carbin_cmd('cache', 'push', '-r', url),
+            carbin_cmd('rm', '--verbose -y', simple),
+            carbin_cmd('size', '0')
+        ], env={'CARBIN_ARTIFACT_CACHE': d.get_path('local')})
+        assert len(json.load(open(d.get_path('remote', 'index.json')))) == 1
+        out, err = carbin.util.cmd(carbin_cmd('install', '--remote-cache', url, simple), shell=True, capture='out',
+                                   cwd=d.tmp_dir, env={'CARBIN_ARTIFACT_CACHE': d.get_path('other')})
+        assert 'Using cached build' in out.decode('utf-8')
+        d.cmds([carbin_cmd('size', '1')])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_artifact_cache_evict(d):
+    carbin.util.mkdir(d.get_path('install'))
+    d.write_to(os.path.join('install', 'file.txt'), ['x' * 1000])
+    cache = carbin.artifacts.ArtifactCache(d.get_path('local'))
+    for key, used in [('a', 3), ('b', 1), ('c', 2)]:
+        cache.store(key, d.get_path('install'))
+        cache.write_meta(key, carbin.util.merge(cache.get_meta(key), {'used': used}))
+    cache.size = cache.get_meta('a')['size'] * 2
+    cache.evict()
+    assert list(cache.keys()) == ['a', 'c']
+    # Restoring a build marks it as used
+    assert cache.restore('c', d.get_path('restored'))
+    cache.store('d', d.get_path('install'))
+    assert list(cache.keys()) == ['c', 'd']
+
+def test_hash_dir_cache(d):
+    src = carbin.util.mkdir(d.get_path('src'))
+    d.write_to(os.path.join('src', 'a.txt'), ['a'])
+    cache = d.get_path('digests.json')
+    h = carbin.util.hash_dir(src, cache=cache)
+    assert carbin.util.hash_dir(src) == h
+    assert 'a.txt' in carbin.util.read_json(cache)
+    # A cached digest is only used while the size and mtime match
+    d.write_to(os.path.join('src', 'a.txt'), ['b'])
+    assert carbin.util.hash_dir(src, cache=cache) == carbin.util.hash_dir(src) != h
+
+def test_remote_cache_sha256(d):
+    carbin.util.mkdir(d.get_path('install', 'include'))
+    d.write_to(os.path.join('install', 'include', 'simple.h'), ['int simple();'])
+    local = carbin.artifacts.ArtifactCache(d.get_path('local'))
+    local.store('key', d.get_path('install'), name='simple')
+    server = carbin.server.CacheServer(d.get_path('remote'), host='localhost')
+    server.start()
+    try:
+        remote = carbin.artifacts.RemoteCache(server.get_url())
+        assert remote.push(local) == ['key']
+        other = carbin.artifacts.ArtifactCache(d.get_path('other'))
+        assert remote.pull(other) == ['key']
+        assert other.restore('key', d.get_path('restored'))
+        d.assert_path('restored', 'include', 'simple.h')
+        # A blob changed on the server is never kept
+        with open(d.get_path('remote', 'blobs', 'key.tar.gz'), 'ab') as f: f.write(b'x')
+        changed = carbin.artifacts.ArtifactCache(d.get_path('changed'))
+        with pytest.raises(carbin.util.BuildError):
+            remote.get('key', changed)
+        assert not changed.has('key')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_cache_server_truncated_put(d):
+    server = carbin.server.CacheServer(d.get_path('remote'), host='localhost')
+    server.start()
+    try:
+        d.write_to(os.path.join('remote', 'blob'), ['stored'])
+        host, port = server.server_address[:2]
+        s = socket.create_connection((host, port))
+        s.sendall(b'PUT /blob HTTP/1.1\r\nHost: localhost\r\nContent-Length: 100\r\n\r\npartial')
+        s.shutdown(socket.SHUT_WR)
+        assert s.recv(1024).split()[1] == b'400'
+        s.close()
+        assert open(d.get_path('remote', 'blob')).read().strip() == 'stored'
+        assert os.listdir(d.get_path('remote')) == ['blob']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_artifact_restore_outside(d):
+    cache = carbin.artifacts.ArtifactCache(d.get_path('local'))
+    carbin.util.mkdir(cache.path)
+    d.write_to('evil', ['evil'])
+    with tarfile.open(cache.get_path('key'), 'w:gz') as tar:
+        tar.add(d.get_path('evil'), arcname='../evil2')
+    with pytest.raises(carbin.util.BuildError):
+        cache.restore('key', d.get_path('install'))
+    assert not os.path.exists(d.get_path('evil2'))
+
+def test_install_download_cache(d):
+    server = carbin.server.CacheServer(d.get_path('www'), host='localhost')
+    create_ar(archive=d.get_path('www', 'v1.0.tar.gz'), src=get_exists_path('libsimple'))
+    create_ar(archive=d.get_path('www', 'master.tar.gz'), src=get_exists_path('libsimple'))
+    env = {'XDG_CONFIG_HOME': d.get_path('config'), 'CARBIN_USE_ARTIFACT_CACHE': '0'}
+    server.start()
+    try:
+        for name in ['v1.0.tar.gz', 'master.tar.gz']:
+            url = server.get_url() + '/' + name
+            d.cmds([
+                carbin_cmd('install', '--verbose', 'simple,' + url),
+                carbin_cmd('rm', '--verbose -y', 'simple')
+            ], env=env)
+            out, err = carbin.util.cmd(carbin_cmd('install', 'simple,' + url), shell=True, capture='out',
+                                       cwd=d.tmp_dir, env=env)
+            assert 'Using cached ' + url in out.decode('utf-8')
+            d.cmds([carbin_cmd('rm', '--verbose -y', 'simple')], env=env)
+    finally:
+        server.shutdown()
+        server.server_close()
+    # Pinned archives don't need the server anymore
+    url = server.get_url() + '/v1.0.tar.gz'
+    d.cmds([carbin_cmd('install', '--verbose', 'simple,' + url), carbin_cmd('size', '1')], env=env)
+
+def test_install_download_hash(d):
+    server = carbin.server.CacheServer(d.get_path('www'), host='localhost')
+    ar = d.get_path('www', 'libsimple.tar.gz')
+    create_ar(archive=ar, src=get_exists_path('libsimple'))
+    h = carbin.util.hash_file(ar, 'sha256')
+    env = {'XDG_CONFIG_HOME': d.get_path('config'), 'CARBIN_USE_ARTIFACT_CACHE': '0'}
+    server.start()
+    try:
+        url = server.get_url() + '/libsimple.tar.gz'
+        reqs_file = d.write_to('reqs', ["simple,{0} --hash=sha256:{1}".format(url, h)])
+        d.cmds([
+            carbin_cmd('install', '--verbose -f', reqs_file),
+            carbin_cmd('rm', '--verbose -y', 'simple')
+        ], env=env)
+    finally:
+        server.shutdown()
+        server.server_close()
+    digests = json.load(open(d.get_path('config', 'carbin', 'cache', 'sha256-' + h, '.libsimple.tar.gz.digests')))
+    assert digests['sha256'] == h
+    d.cmds([
+        carbin_cmd('install', '--verbose -f', reqs_file),
+        carbin_cmd('size', '1')
+    ], env=env)
+
+def test_install_stream_extract(d):
+    server = carbin.server.CacheServer(d.get_path('www'), host='localhost')
+    ar = d.get_path('www', 'libsimple.tar.gz')
+    create_ar(archive=ar, src=get_exists_path('libsimple'))
+    h = carbin.util.hash_file(ar, 'sha256')
+    env = {
+        'XDG_CONFIG_HOME': d.get_path('config'),
+        'CARBIN_USE_ARTIFACT_CACHE': '0',
+        'CARBIN_USE_DOWNLOAD_CACHE': '0'
+    }
+    server.start()
+    try:
+        url = server.get_url() + '/libsimple.tar.gz'
+        d.cmds([
+            carbin_cmd('install', '--verbose', 'simple,' + url),
+            carbin_cmd('rm', '--verbose -y', 'simple')
+        ], env=env)
+        # Without the download cache the archive is only kept when it has a hash
+        assert not os.path.exists(d.get_path('config', 'carbin', 'cache', 'sha256-' + h))
+        reqs_file = d.write_to('reqs', ["simple,{0} --hash=sha256:{1}".format(url, h)])
+        d.cmds([carbin_cmd('install', '--verbose -f', reqs_file)], env=env)
+        assert os.path.exists(d.get_path('config', 'carbin', 'cache', 'sha256-' + h, 'libsimple.tar.gz'))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_tarball_extract(d, jobs):
+    src = d.get_path('src')
+    shutil.copytree(get_exists_path('libsimple'), os.path.join(src, 'libsimple'))
+    os.symlink('CMakeLists.txt', os.path.join(src, 'libsimple', 'link'))
+    ar = d.get_path('libsimple.tar.xz')
+    with tarfile.open(ar, mode='w:xz') as f:
+        f.add(os.path.join(src, 'libsimple'), arcname='libsimple')
+    carbin.tarball.extract(ar, d.get_path('out'), jobs=jobs)
+    for root, dirs, files in os.walk(os.path.join(src, 'libsimple')):
+        for name in files:
+            f = os.path.join(root, name)
+            out = d.get_path('out', os.path.relpath(f, src))
+            if os.path.islink(f): assert os.readlink(out) == os.readlink(f)
+            else: assert open(out, 'rb').read() == open(f, 'rb').read()
+
+def test_tarball_extract_dot(d):
+    ar = d.get_path('libsimple.tar.gz')
+    carbin.util.cmd(['tar', '-C', get_exists_path('libsimple'), '-czf', ar, '.'])
+    carbin.tarball.extract(ar, d.get_path('out'))
+    assert open(d.get_path('out', 'CMakeLists.txt'), 'rb').read() == \
+        open(os.path.join(get_exists_path('libsimple'), 'CMakeLists.txt'), 'rb').read()
+    with pytest.raises(carbin.util.BuildError):
+        carbin.tarball.get_member_path(d.get_path('out'), tarfile.TarInfo('../out2/x'))
+
+@pytest.mark.skipif(not carbin.tarball.is_supported('.tar.zst'), reason="zstd is not available")
+def test_install_tar_zst(d):
+    ar = d.get_path('libsimple.tar.zst')
+    tar = d.get_path('libsimple.tar')
+    with tarfile.open(tar, mode='w') as f:
+        f.add(get_exists_path('libsimple'), arcname='libsimple')
+    carbin.util.cmd([carbin.util.which('zstd'), '-q', tar, '-o', ar])
+    d.cmds(install_cmds(url=ar, lib='simple'))
+
+def test_build_fingerprint(d):
+    def build(*args):
+        out, err = carbin.util.cmd(carbin_cmd('build', '--verbose', *args), shell=True, capture='out',
+                                   cwd=d.tmp_dir)
+        return 'fingerprint changed' in out.decode('utf-8')
+    app = d.get_path('app')
+    shutil.copytree(get_exists_path('basicapp'), app)
+    d.write_to(os.path.join('app', 'carbin_deps.txt'), ['simple,' + get_exists_path('libsimple')])
+    assert build(app)
+    assert not build(app)
+    assert build('-DSOME_FLAG=1', app)
+    assert not build('-DSOME_FLAG=1', app)
+    assert build('--debug', '-DSOME_FLAG=1', app)
+    # A dependency removed from the prefix is installed again
+    d.cmds([carbin_cmd('rm', '--verbose -y', 'simple')])
+    assert build('--debug', '-DSOME_FLAG=1', app)
+    d.cmds([carbin_cmd('size', '1')])
+    # The dependencies are compared once parsed, so moving them into an
+    # included file changes nothing but a change to that file is seen
+    d.write_to(os.path.join('app', 'carbin_deps.txt'), ['-f deps.txt'])
+    d.write_to(os.path.join('app', 'deps.txt'), ['simple,' + get_exists_path('libsimple')])
+    assert not build('--debug', '-DSOME_FLAG=1', app)
+    d.write_to(os.path.join('app', 'deps.txt'), ['simple,' + get_exists_path('libsimple') + ' -DSIMPLE_FLAG=1'])
+    assert build('--debug', '-DSOME_FLAG=1', app)
+    # Settings made with build --configure are kept when a define is added
+    out, err = carbin.util.cmd(carbin_cmd('build', '--path', app), shell=True, capture='out', cwd=d.tmp_dir)
+    cache = os.path.join(out.decode('utf-8').strip(), 'CMakeCache.txt')
+    with open(cache, 'a') as f: f.write('USER_SETTING:STRING=1\n')
+    assert build('--debug', '-DSOME_FLAG=1', '-DOTHER_FLAG=1', app)
+    assert 'USER_SETTING:STRING=1' in open(cache).read()
+
+def test_build_fingerprint_define_removed(d):
+    d.cmds([carbin_cmd('build', '--verbose', '-DCARBIN_FLAG=1', get_exists_path('libsimpleflag'))])
+    out = d.cmd_error(carbin_cmd('build', '--verbose', get_exists_path('libsimpleflag')))
+    assert 'build: fingerprint changed, configuring' in out
+    assert 'CARBIN_FLAG not defined' in out
+
+def test_install_keep_build(d):
+    env = {'XDG_CONFIG_HOME': d.get_path('config'), 'CARBIN_USE_ARTIFACT_CACHE': '0'}
+    app = d.get_path('app')
+    shutil.copytree(get_exists_path('simpleapp'), app)
+    create_ar(archive=d.get_path('app-1.tar.gz'), src=app)
+    d.write_to(os.path.join('app', 'NEWS'), ['1.1'])
+    create_ar(archive=d.get_path('app-2.tar.gz'), src=app)
+    tree = d.get_path('carbin', 'carbin', 'build', 'keep-app')
+    d.cmds([carbin_cmd('install', '--verbose --keep-build', 'app,' + d.get_path('app-1.tar.gz'))], env=env)
+    objects = [os.path.join(root, f) for root, dirs, files in os.walk(os.path.join(tree, 'build'))
+               for f in files if f.endswith('.o')]
+    assert objects
+    mtimes = [os.path.getmtime(f) for f in objects]
+    d.cmds([
+        carbin_cmd('install', '--verbose --keep-build -U', 'app,' + d.get_path('app-2.tar.gz')),
+        carbin_cmd('size', '1')
+    ], env=env)
+    assert os.path.exists(os.path.join(tree, 'src', 'NEWS'))
+    # Unchanged sources are not compiled again
+    assert [os.path.getmtime(f) for f in objects] == mtimes
+    env['CARBIN_BUILD_TREES_SIZE'] = '1'
+    d.cmds([carbin_cmd('install', '--verbose --keep-build', get_exists_path('libsimple'))], env=env)
+    assert not os.path.exists(tree)
+
+def test_install_compiler_cache(d):
+    bin_dir = carbin.util.mkdir(d.get_path('bin'))
+    carbin.util.write_to(os.path.join(bin_dir, 'ccache'), [
+        '#!/bin/sh',
+        'mkdir -p "$CCACHE_DIR"',
+        'n=$(cat "$CCACHE_DIR/count" 2>/dev/null || echo 0)',
+        'if [ "$1" = "--print-stats" ]; then printf "direct_cache_hit\\t0\\ncache_miss\\t%s\\n" $n; exit 0; fi',
+        'echo $((n+1)) > "$CCACHE_DIR/count"',
+        'exec "$@"'
+    ])
+    os.chmod(os.path.join(bin_dir, 'ccache'), 0o755)
+    src = carbin.util.mkdir(d.get_path('makeproject'))
+    carbin.util.write_to(os.path.join(src, 'Makefile'), [
+        'all:',
+        '\techo "$(CC)" > cc.txt',
+        'install: all',
+        '\tmkdir -p $(PREFIX)/share/makeproject',
+        '\tcp cc.txt $(PREFIX)/share/makeproject'
+    ])
+    env = {
+        'PATH': bin_dir + os.pathsep + os.environ['PATH'],
+        'XDG_CONFIG_HOME': d.get_path('config'),
+        'CARBIN_USE_ARTIFACT_CACHE': '0'
+    }
+    d.cmds([carbin_cmd('init', '--compiler-cache auto')], env=env)
+    assert 'CMAKE_CXX_COMPILER_LAUNCHER' in open(d.get_path('carbin', 'carbin', 'carbin.cmake')).read()
+    out, err = carbin.util.cmd(carbin_cmd('install', get_exists_path('simpleapp')), shell=True, capture='out',
+                               cwd=d.tmp_dir, env=env)
+    assert 'Compiler cache: 0 hits' in out.decode('utf-8')
+    assert int(open(d.get_path('config', 'carbin', 'cache', 'ccache', 'count')).read()) > 0
+    d.cmds([carbin_cmd('install', '--verbose --cmake make', src)], env=env)
+    assert 'ccache' in open(d.get_path('carbin', 'share', 'makeproject', 'cc.txt')).read()
+
+def test_install_configure_cache(d):
+    env = {'XDG_CONFIG_HOME': d.get_path('config'), 'CARBIN_USE_ARTIFACT_CACHE': '0'}
+    def install(name, *args):
+        src = carbin.util.mkdir(d.get_path(name))
+        carbin.util.write_to(os.path.join(src, 'CMakeLists.txt'), [
+            'cmake_minimum_required(VERSION 2.8)',
+            'project({} C)'.format(name),
+            'include(CheckIncludeFile)',
+            'check_include_file(stdint.h HAVE_STDINT_H)',
+            'install(FILES CMakeLists.txt DESTINATION share/{})'.format(name)
+        ])
+        out, err = carbin.util.cmd(carbin_cmd('install', '--verbose', *(args + (src,))), shell=True,
+                                   capture='out', cwd=d.tmp_dir, env=env)
+        return out.decode('utf-8')
+    assert 'compiler identification' in install('first')
+    out = install('second')
+    assert 'compiler identification' not in out
+    # The checks depend on each package's flags, so they run again
+    assert 'Looking for stdint.h' in out
+    caches = os.listdir(d.get_path('carbin', 'carbin', 'configure-cache'))
+    assert len(caches) == 1
+    cache = d.get_path('carbin', 'carbin', 'configure-cache', caches[0])
+    checks = carbin.util.read_json(os.path.join(cache, 'checks.json'))
+    assert 'HAVE_STDINT_H' not in open(os.path.join(cache, 'init.cmake')).read()
+    # Ninja relinks on install unless it knows the executables are ELF
+    if sys.platform.startswith('linux'): assert checks['platform']['CMAKE_EXECUTABLE_FORMAT'][1] == 'ELF'
+    # Autotools packages see the tools found by the ones configured before them
+    for name, deps in [('conf1', []), ('conf2', ['simple,' + get_exists_path('libsimple')])]:
+        src = carbin.util.mkdir(d.get_path(name))
+        carbin.util.write_to(os.path.join(src, 'configure'), [
+            '#!/bin/sh',
+            'if [ "$1" = "--help" ]; then exit 0; fi',
+            'for arg; do case $arg in --cache-file=*) cache=${arg#--cache-file=};; --prefix=*) prefix=${arg#--prefix=};; esac; done',
+            'test -f "$cache" && . "$cache"',
+            'echo "${ac_cv_path_GREP-unset} ${ac_cv_header_stdint_h-unset}" > seen.txt',
+            'echo \'ac_cv_path_GREP=${ac_cv_path_GREP=grep}\' > "$cache"',
+            'echo \'ac_cv_header_stdint_h=${ac_cv_header_stdint_h=yes}\' >> "$cache"',
+            'echo \'ac_cv_prog_{0}=${{ac_cv_prog_{0}=yes}}\' >> "$cache"'.format(name),
+            'printf "all:\\n\\ninstall:\\n\\tmkdir -p %s/share/{0}\\n\\tcp seen.txt %s/share/{0}\\n" "$prefix" "$prefix" > Makefile'.format(name)
+        ])
+        os.chmod(os.path.join(src, 'configure'), 0o755)
+        d.write_to(os.path.join(name, 'carbin_deps.txt'), deps)
+        d.cmds([carbin_cmd('install', '--verbose --cmake autotools', src)], env=env)
+    assert open(d.get_path('carbin', 'share', 'conf1', 'seen.txt')).read().strip() == 'unset unset'
+    assert open(d.get_path('carbin', 'share', 'conf2', 'seen.txt')).read().strip() == 'grep unset'
+    # Removing a package drops only what was found by the packages depending on it
+    checks = carbin.util.read_json(os.path.join(cache, 'checks.json'))
+    assert sorted(checks['autoconf']) == ['ac_cv_path_GREP', 'ac_cv_prog_conf1', 'ac_cv_prog_conf2']
+    d.cmds([carbin_cmd('rm', '-y', 'conf1')], env=env)
+    checks = carbin.util.read_json(os.path.join(cache, 'checks.json'))
+    assert sorted(checks['autoconf']) == ['ac_cv_path_GREP', 'ac_cv_prog_conf1', 'ac_cv_prog_conf2']
+    d.cmds([carbin_cmd('rm', '-y', 'simple')], env=env)
+    checks = carbin.util.read_json(os.path.join(cache, 'checks.json'))
+    assert sorted(checks['autoconf']) == ['ac_cv_path_GREP', 'ac_cv_prog_conf1']
+    assert 'compiler identification' not in install('third')
+
+def test_build_keep_going(d):
+    src = carbin.util.mkdir(d.get_path('keepgoing'))
+    carbin.util.write_to(os.path.join(src, 'CMakeLists.txt'), [
+        'cmake_minimum_required(VERSION 2.8)',
+        'project(keepgoing)',
+        'add_executable(bad bad.cpp)',
+        'add_executable(good good.cpp)'
+    ])
+    carbin.util.write_to(os.path.join(src, 'bad.cpp'), ['int main() { return x; }'])
+    carbin.util.write_to(os.path.join(src, 'good.cpp'), ['int main() { return 0; }'])
+    with pytest.raises(carbin.util.BuildError):
+        d.cmds([carbin_cmd('build', '--verbose --keep-going', src)])
+    build_dir = carbin.util.cmd(carbin_cmd('build', '--path', src), shell=True, capture='out',
+                                cwd=d.tmp_dir)[0].decode('utf-8').strip()
+    assert any(f.startswith('good') for f in os.listdir(build_dir))
+
+@pytest.mark.skipif(not carbin.util.which('ninja', throws=False), reason="ninja is not installed")
+def test_build_ninja_default(d):
+    d.cmds([carbin_cmd('build', '--verbose', get_exists_path('libsimple'))])
+    build_dir = carbin.util.cmd(carbin_cmd('build', '--path', get_exists_path('libsimple')), shell=True,
+                                capture='out', cwd=d.tmp_dir)[0].decode('utf-8').strip()
+    assert os.path.exists(os.path.join(build_dir, 'build.ninja'))
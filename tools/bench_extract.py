@@ -0,0 +1,76 @@
+import argparse, os, shutil, subprocess, sys, tarfile, tempfile, time
+
+__dir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(__dir__, '..'))
+
+import carbin.tarball as tarball
+import carbin.util as util
+
+# Compares extracting an archive with many small files, like boost, through
+# 'cmake -E tar', tarfile and carbin.tarball, eg:
+#   python tools/bench_extract.py --files 100000 --codec xz
+
+def make_tree(d, files):
+    for i in range(files):
+        sub = os.path.join(d, 'src', 'dir{0}'.format(i // 100))
+        if i % 100 == 0: os.makedirs(sub)
+        with open(os.path.join(sub, 'file{0}.hpp'.format(i)), 'w') as f:
+            f.write('// file {0}\n'.format(i) * (i % 200 + 1))
+
+
+def make_archive(tree, archive, codec):
+    if codec == 'zst':
+        with open(archive, 'wb') as f:
+            tar = subprocess.Popen(['tar', 'cf', '-', '-C', tree, 'src'], stdout=subprocess.PIPE)
+            subprocess.check_call(['zstd', '-q', '-c'], stdin=tar.stdout, stdout=f)
+            tar.wait()
+    else:
+        with tarfile.open(archive, 'w:' + codec) as tar: tar.add(os.path.join(tree, 'src'), arcname='src')
+
+
+def run_cmake(archive, dst):
+    subprocess.check_call(['cmake', '-E', 'tar', 'xf', archive], cwd=dst)
+
+
+def run_tarfile(archive, dst):
+    with tarfile.open(archive) as tar: tar.extractall(dst)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--codec', default='gz', choices=['gz', 'bz2', 'xz', 'zst'])
+    parser.add_argument('--jobs', type=int, default=util.EXTRACT_JOBS)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        make_tree(os.path.join(tmp, 'tree'), args.files)
+        archive = os.path.join(tmp, 'bench.tar.' + args.codec)
+        make_archive(os.path.join(tmp, 'tree'), archive, args.codec)
+        print('{0} files, {1} bytes, decompressor: {2}'.format(args.files, os.path.getsize(archive),
+                                                             ' '.join(tarball.get_tool(args.codec) or ['python'])))
+        runs = [
+            ('cmake -E tar', run_cmake),
+            ('tarfile', run_tarfile),
+            ('tarball -j1', lambda a, d: tarball.extract(a, d, jobs=1)),
+            ('tarball -j{0}'.format(args.jobs), lambda a, d: tarball.extract(a, d, jobs=args.jobs))
+        ]
+        for name, f in runs:
+            if name == 'tarfile' and args.codec == 'zst': continue
+            times = []
+            for i in range(args.repeat):
+                dst = os.path.join(tmp, 'out')
+                os.makedirs(dst)
+                start = time.time()
+                f(archive, dst)
+                times.append(time.time() - start)
+                shutil.rmtree(dst)
+            print('{0:<16} {1:8.3f}s'.format(name, min(times)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import argparse, os, shutil, sys, tempfile, time
+
+__dir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(__dir__, '..'))
+
+import carbin.util as util
+
+# Compares placing an install tree into a prefix one file at a time, the way
+# symlink_dir and copy_dir used to, with the batched and threaded versions,
+# eg:
+#   python tools/bench_link.py --files 10000 100000 --dir /mnt/nfs/tmp
+
+def make_tree(d, files):
+    for i in range(files):
+        sub = os.path.join(d, 'include', 'dir{0}'.format(i // 100))
+        if i % 100 == 0: os.makedirs(sub)
+        with open(os.path.join(sub, 'file{0}.hpp'.format(i)), 'w') as f:
+            f.write('// file {0}\n'.format(i) * (i % 200 + 1))
+
+
+def serial_symlink_dir(src, dst):
+    for root, dirs, files in os.walk(src):
+        for file in dirs + files:
+            if not (os.path.islink(os.path.join(root, file)) or os.path.isfile(os.path.join(root, file))): continue
+            d = os.path.join(dst, os.path.relpath(root, src))
+            util.mkdir(d)
+            os.symlink(os.path.relpath(os.path.join(root, file), d), os.path.join(d, file))
+
+
+def serial_copy_dir(src, dst):
+    for root, dirs, files in os.walk(src):
+        for file in files:
+            d = os.path.join(dst, os.path.relpath(root, src))
+            util.mkdir(d)
+            shutil.copy2(os.path.join(root, file), os.path.join(d, file))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--jobs', type=int, default=util.LINK_JOBS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dir', help='Directory to create the trees in, such as one on a network filesystem')
+    args = parser.parse_args()
+
+    runs = [
+        ('symlink serial', serial_symlink_dir),
+        ('symlink -j1', lambda s, d: util.symlink_dir(s, d, jobs=1)),
+        ('symlink -j{0}'.format(args.jobs), lambda s, d: util.symlink_dir(s, d, jobs=args.jobs)),
+        ('copy serial', serial_copy_dir),
+        ('copy -j{0}'.format(args.jobs), lambda s, d: util.copy_dir(s, d, jobs=args.jobs)),
+        ('hardlink -j{0}'.format(args.jobs), lambda s, d: util.copy_dir(s, d, mode='hardlink', jobs=args.jobs)),
+        ('reflink -j{0}'.format(args.jobs), lambda s, d: util.copy_dir(s, d, mode='reflink', jobs=args.jobs))
+    ]
+    for files in args.files:
+        tmp = tempfile.mkdtemp(dir=args.dir)
+        try:
+            src = os.path.join(tmp, 'install')
+            make_tree(src, files)
+            print('{0} files'.format(files))
+            for name, f in runs:
+                times = []
+                for i in range(args.repeat):
+                    dst = os.path.join(tmp, 'prefix')
+                    start = time.time()
+                    f(src, dst)
+                    times.append(time.time() - start)
+                    shutil.rmtree(dst)
+                print('  {0:<16} {1:8.3f}s'.format(name, min(times)))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse, os, shutil, subprocess, sys, tempfile, time
+
+__dir__ = os.path.dirname(os.path.realpath(__file__))
+
+# Times starting carbin for the commands build scripts call over and over,
+# eg:
+#   python tools/bench_startup.py --repeat 20
+# and lists the slowest imports of carbin.cli with -X importtime.
+
+def run(args, env, cwd):
+    start = time.time()
+    subprocess.check_call([sys.executable] + args, env=env, cwd=cwd, stdout=subprocess.DEVNULL)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--imports', type=int, default=10, help='Number of the slowest imports to show')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(__dir__, '..'), os.environ.get('PYTHONPATH', '')]))
+    tmp = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(tmp, 'prefix')
+        cli = ['-c', 'from carbin.cli import cli; cli()']
+        runs = [
+            ('python', ['-c', 'pass']),
+            ('import carbin.cli', ['-c', 'import carbin.cli']),
+            ('carbin --version', cli + ['--version']),
+            ('carbin list', cli + ['list', '-p', prefix])
+        ]
+        if shutil.which('pkg-config'): runs.append(('carbin pkg-config', cli + ['pkg-config', '-p', prefix, '--version']))
+        for name, command in runs:
+            print('{0:<20} {1:8.3f}s'.format(name, min(run(command, env, tmp) for i in range(args.repeat))))
+        print('{0} created by carbin list: {1}'.format(prefix, os.path.exists(prefix)))
+        out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import carbin.cli'], env=env, cwd=tmp,
+                             stderr=subprocess.PIPE, universal_newlines=True).stderr
+        imports = []
+        for line in out.splitlines()[1:]:
+            self_us, cumulative, name = line.split('|')
+            imports.append((int(cumulative.split(':')[-1]), name.rstrip()))
+        print('slowest imports of carbin.cli:')
+        for cumulative, name in sorted(imports, reverse=True)[:args.imports]:
+            print('  {0:<40} {1:8.3f}s'.format(name, cumulative / 1e6))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
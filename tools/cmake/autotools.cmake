@@ -5,9 +5,6 @@ enable_language(C CXX)
 
 include(CTest)
 
-include(ProcessorCount)
-ProcessorCount(AUTOTOOLS_JOBS)
-
 find_program(MAKE_EXE make)
 if(NOT MAKE_EXE)
     message(FATAL_ERROR "Make build system not installed.")
@@ -55,15 +52,38 @@ endif()
 
 message(STATUS "Configure options: ${CONFIGURE_OPTIONS}")
 
+# Start from the results other packages found with the same toolchain, and
+# configure again without them if that fails
+if(CARBIN_AUTOTOOLS_CACHE_FILE)
+    if(EXISTS ${CARBIN_AUTOTOOLS_CACHE_FILE} AND NOT EXISTS ${BUILD_DIR}/config.cache)
+        configure_file(${CARBIN_AUTOTOOLS_CACHE_FILE} ${BUILD_DIR}/config.cache COPYONLY)
+    endif()
+    execute_process(COMMAND ${AUTOTOOLS_ENV_COMMAND} ${CMAKE_CURRENT_SOURCE_DIR}/configure
+        --prefix=${CMAKE_INSTALL_PREFIX}
+        --cache-file=${BUILD_DIR}/config.cache
+        ${CONFIGURE_OPTIONS}
+        WORKING_DIRECTORY ${BUILD_DIR}
+        RESULT_VARIABLE AUTOTOOLS_CONFIGURE_RESULT)
+    if(NOT AUTOTOOLS_CONFIGURE_RESULT EQUAL 0)
+        message(STATUS "Configure failed with the cached results, retrying without them")
+        file(REMOVE ${BUILD_DIR}/config.cache)
+        exec(COMMAND ${AUTOTOOLS_ENV_COMMAND} ${CMAKE_CURRENT_SOURCE_DIR}/configure
+            --prefix=${CMAKE_INSTALL_PREFIX}
+            --cache-file=${BUILD_DIR}/config.cache
+            ${CONFIGURE_OPTIONS}
+            WORKING_DIRECTORY ${BUILD_DIR})
+    endif()
+else()
 # TODO: Check flags of configure script
 exec(COMMAND ${AUTOTOOLS_ENV_COMMAND} ${CMAKE_CURRENT_SOURCE_DIR}/configure
     --prefix=${CMAKE_INSTALL_PREFIX}
     ${CONFIGURE_OPTIONS}
     WORKING_DIRECTORY ${BUILD_DIR})
+endif()
 
 add_custom_target(autotools ALL
-    COMMAND ${MAKE_EXE} -j ${AUTOTOOLS_JOBS}
-    COMMENT "${MAKE_EXE} -j ${AUTOTOOLS_JOBS}"
+    COMMAND ${MAKE_JOBS_COMMAND}
+    COMMENT "${MAKE_EXE} -j ${PREAMBLE_JOBS}"
     VERBATIM
     WORKING_DIRECTORY ${BUILD_DIR}
 )
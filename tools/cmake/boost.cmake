@@ -5,9 +5,6 @@ enable_language(C CXX)
 
 include(CTest)
 
-include(ProcessorCount)
-ProcessorCount(B2_JOBS)
-
 @PREAMBLE@
 auto_search()
 preamble(B2)
@@ -145,7 +142,6 @@ set(BOOST_BUILD_FLAGS "" CACHE STRING "Additional flags to pass to boost build")
 set(BUILD_FLAGS
     -q
     ${B2_VERBOSE_FLAG}
-    -j ${B2_JOBS}
     --ignore-site-config
     --user-config=${B2_CONFIG}
     --build-dir=${B2_BUILD_DIR}
@@ -173,15 +169,15 @@ set(BUILD_FLAGS
 string(REPLACE ";" " " BUILD_FLAGS_STR "${BUILD_FLAGS}")
 
 add_custom_target(boost ALL
-    COMMAND ${B2_ENV_COMMAND} ${B2_EXE} ${BUILD_FLAGS}
-    COMMENT "${B2_EXE} ${BUILD_FLAGS_STR}"
+    COMMAND ${B2_ENV_COMMAND} ${JOBS_LAUNCHER} ${B2_EXE} ${BUILD_FLAGS} ${JOBS_FLAG}
+    COMMENT "${B2_EXE} -j ${PREAMBLE_JOBS} ${BUILD_FLAGS_STR}"
     VERBATIM
     WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
 )
 
 add_custom_target(boost_install
-    COMMAND ${B2_ENV_COMMAND} ${B2_EXE} ${BUILD_FLAGS} install
-    COMMENT "${B2_EXE} ${BUILD_FLAGS_STR} install"
+    COMMAND ${B2_ENV_COMMAND} ${JOBS_LAUNCHER} ${B2_EXE} ${BUILD_FLAGS} install ${JOBS_FLAG}
+    COMMENT "${B2_EXE} -j ${PREAMBLE_JOBS} ${BUILD_FLAGS_STR} install"
     VERBATIM
     WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
 )
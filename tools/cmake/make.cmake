@@ -5,9 +5,6 @@ enable_language(C CXX)
 
 include(CTest)
 
-include(ProcessorCount)
-ProcessorCount(MAKE_JOBS)
-
 find_program(MAKE_EXE make)
 if(NOT MAKE_EXE)
     message(FATAL_ERROR "Make build system not installed.")
@@ -18,8 +15,8 @@ auto_search()
 preamble(MAKE)
 
 set(MAKE_VARIABLES
-        "CC=${CMAKE_C_COMPILER}"
-        "CXX=${CMAKE_CXX_COMPILER}"
+        "CC=${MAKE_C_COMPILER}"
+        "CXX=${MAKE_CXX_COMPILER}"
         "CFLAGS=${MAKE_C_FLAGS}"
         "CXXFLAGS=${MAKE_CXX_FLAGS}"
         "LDFLAGS=${MAKE_LINK_FLAGS}"
@@ -30,8 +27,8 @@ set(BUILD_DIR ${CMAKE_CURRENT_BINARY_DIR}/build)
 file(MAKE_DIRECTORY ${BUILD_DIR})
 
 add_custom_target(make_build ALL
-    COMMAND ${MAKE_ENV_COMMAND} ${MAKE_EXE} -C ${CMAKE_SOURCE_DIR} -j ${MAKE_JOBS} ${MAKE_VARIABLES}
-    COMMENT "${MAKE_EXE} -j ${MAKE_JOBS}"
+    COMMAND ${MAKE_ENV_COMMAND} ${MAKE_JOBS_COMMAND} -C ${CMAKE_SOURCE_DIR} ${MAKE_VARIABLES}
+    COMMENT "${MAKE_EXE} -j ${PREAMBLE_JOBS}"
     VERBATIM
     WORKING_DIRECTORY ${BUILD_DIR}
 )
@@ -94,10 +94,17 @@ set(MESON_ENDIAN little)
 if(BIG_ENDIAN)
     set(MESON_ENDIAN big)
 endif()
+foreach(LANG C CXX)
+    set(MESON_${LANG}_BINARY "'${CMAKE_${LANG}_COMPILER}'")
+    if(CMAKE_${LANG}_COMPILER_LAUNCHER)
+        string(REPLACE ";" "', '" MESON_${LANG}_LAUNCHER "${CMAKE_${LANG}_COMPILER_LAUNCHER}")
+        set(MESON_${LANG}_BINARY "['${MESON_${LANG}_LAUNCHER}', '${CMAKE_${LANG}_COMPILER}']")
+    endif()
+endforeach()
 file(WRITE ${CMAKE_CURRENT_BINARY_DIR}/cross-file.txt "
 [binaries]
-c = '${CMAKE_C_COMPILER}'
-cpp = '${CMAKE_CXX_COMPILER}'
+c = ${MESON_C_BINARY}
+cpp = ${MESON_CXX_BINARY}
 ar = '${CMAKE_AR}'
 pkgconfig = '${PKG_CONFIG}'
 ${EXE_WRAPPER}
@@ -144,8 +151,8 @@ exec(COMMAND ${MESON_ENV_COMMAND} ${MESON_CMD})
 endif()
 
 add_custom_target(meson ALL
-    COMMAND ${NINJA_EXE}
-    COMMENT "${NINJA_EXE}"
+    COMMAND ${JOBS_LAUNCHER} ${NINJA_EXE} ${JOBS_FLAG}
+    COMMENT "${NINJA_EXE} -j ${PREAMBLE_JOBS}"
     VERBATIM
     WORKING_DIRECTORY ${BUILD_DIR}
 )